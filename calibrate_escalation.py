@@ -0,0 +1,72 @@
+import json
+import pandas as pd
+from utils import (
+AnnoMIDataset,
+iter_state_actions,
+DialogueActClassifier,
+calibrate_escalation_thresholds
+)
+import openai
+from utils import OPENAI_API_KEY
+openai.api_key = OPENAI_API_KEY
+
+
+def main(args):
+
+    # held-out dialogues, e.g. the ones after those used for training
+    data = AnnoMIDataset(args.data_path)
+    dialogue_ids = list(pd.read_csv(args.index_dir)['id'])
+    num_ids = len(dialogue_ids)
+    dialogue_ids = dialogue_ids[args.begin_dialogue_position:args.begin_dialogue_position+args.num_dialogues_to_use]
+    if len(dialogue_ids) == 0:
+        raise ValueError(f'{args.index_dir} has {num_ids} dialogue ids, nothing at position {args.begin_dialogue_position}')
+    sessions = data.sessions(dialogue_ids)
+
+    contexts_and_turns = [(state, gold_action) for _, _, state, gold_action in iter_state_actions(sessions)]
+    print('num therapist turns: ', len(contexts_and_turns))
+
+    # reference labels: always ask the llm, the classifier runs once over all sentences
+    dialog_act_classifier = DialogueActClassifier(classifier_backend=args.classifier_backend)
+    probas = []
+    reference_labels = []
+    total_cost = 0
+    for sentences, labels, cost, turn_probas in dialog_act_classifier.annotate_dialogue_turns(contexts_and_turns, with_probas=True):
+        probas += turn_probas
+        reference_labels += labels
+        total_cost += cost
+    print(f'num sentences: {len(reference_labels)}, cost: {total_cost}')
+    if len(reference_labels) == 0:
+        raise ValueError(f'no therapist sentences in dialogues {dialogue_ids} of {args.data_path}, nothing to calibrate on')
+
+    config = calibrate_escalation_thresholds(
+        probas,
+        reference_labels,
+        target_agreement=args.target_agreement,
+        min_support=args.min_support
+    )
+    print(config)
+    with open(args.output_json, 'w') as ofp:
+        json.dump(config, ofp, indent=2)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Calibrate when the dialogue act classifier should ask the LLM')
+    parser.add_argument('--data_path', type=str, default='AnnoMI/train.csv',
+                        help='csv to the held-out data')
+    parser.add_argument('--index_dir', type=str, default='AnnoMI/random_order_high_quality_dialogue_ids.csv',
+                        help='csv to the order of dialog ids')
+    parser.add_argument('--num_dialogues_to_use', type=int, default=5,
+                        help='how many dialogue to use')
+    parser.add_argument('--begin_dialogue_position', type=int, default=28,
+                        help='where to begin, pick a range that does not overlap with training (default: the last 5 of the 33 high quality ids)')
+    parser.add_argument('--target_agreement', type=float, default=0.95,
+                        help='how often the classifier alone should agree with the llm on the sentences it keeps')
+    parser.add_argument('--min_support', type=int, default=20,
+                        help='minimum number of sentences for a label to get its own threshold')
+    parser.add_argument('--classifier_backend', type=str, default='torch', choices=['torch', 'torch-int8', 'onnx', 'onnx-int8'],
+                        help='how to run the dialogue act classifier')
+    parser.add_argument('--output_json', type=str, default='escalation_config.json',
+                        help='where to write the thresholds, pass it to train_agent.py --escalation_config')
+    args = parser.parse_args()
+    print(args)
+    main(args)
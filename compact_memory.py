@@ -0,0 +1,37 @@
+import pandas as pd
+from utils import compact_memory, build_sentence_encoder
+
+
+def main(args):
+
+    memory = pd.read_csv(args.training_memory_path, index_col=0)
+    sentence_encoder = build_sentence_encoder(args.encoder_name, cache_dir=args.embedding_cache_dir)
+
+    compacted = compact_memory(
+        memory,
+        sentence_encoder,
+        rule_threshold=args.rule_threshold,
+        tom_threshold=args.tom_threshold
+    )
+    print(f'{len(memory)} rules compacted into {len(compacted)}')
+    print('largest clusters: ', sorted(compacted['cluster size'], reverse=True)[:10])
+    compacted.to_csv(args.output_csv_file)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge near-duplicate rules of a training memory')
+    parser.add_argument('--training_memory_path', type=str, default=None,
+                        help='path to the csv file generated by training (or merge_memory.py)')
+    parser.add_argument('--output_csv_file', type=str, default=None,
+                        help='compacted memory, use it as inference.py --training_memory_path')
+    parser.add_argument('--rule_threshold', type=float, default=0.9,
+                        help='rules at least this cosine similar are considered duplicates')
+    parser.add_argument('--tom_threshold', type=float, default=0.9,
+                        help='and only if their client toms are at least this cosine similar')
+    parser.add_argument('--encoder_name', type=str, default='all-MiniLM-L6-v2',
+                        help='sentence-transformers model used to compare rules and client toms')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None,
+                        help='persistent cache of sentence embeddings, only texts not seen before are encoded, no caching if not set')
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -2,74 +2,113 @@ import pandas as pd
 from utils import (
 OpenaiSequencialDialogue,
 Session,
-display_annomi_dialogue
+AnnoMIDataset,
+iter_state_actions,
+RequestScheduler,
+LLMEngine,
+set_llm_engine,
+LLMResponseCache,
+set_llm_cache,
+default_retry_policy,
+set_llm_backend,
+build_backend,
+TomStore,
+set_tom_store,
+PendingBatchRequest,
+run_batch_round,
+num_batch_rounds,
+ResultJournal,
+state_action_id,
+MemoryBundle,
+sync_memory_bundle,
+GPTReranker,
+HybridReranker,
+build_reranker,
+Stage,
+Pipeline,
+CachedSentenceEncoder,
+build_sentence_encoder
 )
-from nltk.util import flatten
-from sentence_transformers import SentenceTransformer
 from tom_detector import determine_toms
 
 from tom_detector import determine_toms_inference_mode
 from utils import OPENAI_API_KEY
 import openai
 openai.api_key = OPENAI_API_KEY
-from sentence_transformers import util
 from utils import OpenaiSequencialDialogue
-import numpy as np
 from tqdm import tqdm
 
 
-def rerank(state, client_tom, rules):
-    reranker = OpenaiSequencialDialogue(model='gpt-3.5-turbo')
-    reranker_prompt = """Look at the following description of a current situation (of a dialogue context), and a set of guidelines that might help in such situation. Response with the id of the single most applicable rule.
-Dialogue Context:
-@state@
+def load_memory_bundle(training_memory_path, memory_bundle_dir, sentence_encoder, encoder_name):
+    """
+    the bundle of a training memory csv (kept in sync with it), or an existing bundle if no csv is given
+    """
+    memory_bundle_dir = memory_bundle_dir or training_memory_path+'.bundle'
+    if training_memory_path:
+        # client toms are only encoded the first time (or the new rows, when the memory grew)
+        training_memory = pd.read_csv(training_memory_path, index_col=0)
+        return sync_memory_bundle(memory_bundle_dir, training_memory, sentence_encoder, encoder_name)
+    return MemoryBundle(memory_bundle_dir)
 
-Current Situation:
-@client_tom@
+def retrieve_rules(client_toms, memory_bundle, sentence_encoder, k=10):
+    """
+    top-k rules for a batch of client toms, one encoder call and one matrix product for all of them
+    """
+    if len(client_toms) == 0:
+        return []
+    retrieved_indices, _ = memory_bundle.search(sentence_encoder.encode(client_toms), k=k)
+    return [[memory_bundle.rules[i] for i in row] for row in retrieved_indices]
 
-Guidelines:
-@rules@
+def choose_rule(state, client_tom, top_rules, reranker=None):
+    """
+    rerank the retrieved rules (with the gpt reranker if none is given), returns the chosen rule and the reranking cost
+    """
+    reranker = reranker if reranker is not None else GPTReranker()
+    reranker_cost = 0
+    try:
+        reranker_output, reranker_cost = reranker.rerank(state, client_tom, top_rules)
+        # vprint('Reranker Selected Rule Number (starting from 1):\n'+str(reranker_output+1))
+        retrieved_rule = top_rules[reranker_output]
+        # vprint('Reranker Selected Rule:\n'+retrieved_rule)
+    except PendingBatchRequest:
+        raise
+    except Exception as e:
+        # e.g. the local reranker failing on an input, fall back to the best retrieved rule
+        print('oops, something is off with the reranking step')
+        print(e)
+        retrieved_rule = top_rules[0]
+    return retrieved_rule, reranker_cost
 
-Which rule applies the best in this situation? Answer with a single number only, do not explain anything, do not add punctuation."""
-    reranker_prompt = reranker_prompt.replace('@state@', state).replace('@client_tom@', client_tom).replace('@rules@', rules)
-    model_response = reranker.send_user_message(reranker_prompt)
-    model_response = ''.join([str(i) for i in str(model_response) if i.isnumeric()])
-    model_response = int(model_response)-1
-    
-    return model_response, reranker.cost()['total']
+def choose_rules_batch(states, client_toms, top_rules_lists, reranker):
+    """
+    choose_rule for many states at once, for rerankers that score a whole batch in one pass (rerank_batch)
+    """
+    try:
+        reranker_outputs = reranker.rerank_batch(states, client_toms, top_rules_lists)
+    except PendingBatchRequest:
+        raise
+    except Exception as e:
+        print('oops, something is off with the reranking step')
+        print(e)
+        reranker_outputs = [(0, 0) for _ in states]
+    return [(top_rules[index], cost) for top_rules, (index, cost) in zip(top_rules_lists, reranker_outputs)]
 
-def inference_state(
+def respond_with_rule(
     state,
-    training_memory,
-    client_tom_embeddings,
-    sentence_encoder,
+    client_tom,
+    retrieved_rule,
+    determine_tom_cost=0,
+    reranker_cost=0,
     verbose=True,
     receiver_lm_name = 'gpt-3.5-turbo-1106'
 ):
+    """
+    let the receiver respond, then respond again following the chosen rule
+    """
 
     def vprint(x): 
         if verbose:
             print('''---\n'''+x)
-    client_stage, client_tom, determine_tom_cost = determine_toms_inference_mode(state)
-    rules = list(training_memory['rule'])
-    training_client_toms = list(training_memory['client tom'])
-    
-    # retrieve relevant training experience
-    retriever_ranked_list = np.argsort(-util.dot_score(sentence_encoder.encode(client_tom), client_tom_embeddings).flatten(), axis=-1)
-    top_rules = np.array(rules)[retriever_ranked_list[:10]]
-    top_rules_text = '\n'.join([str(i+1)+': '+top_rules[i]+'\n' for i in range(len(top_rules))])
-    # vprint('Top Retrieved Rules:\n'+top_rules_text)
-    try:
-        reranker_output, reranker_cost = rerank(state, client_tom, top_rules_text)
-        # vprint('Reranker Selected Rule Number (starting from 1):\n'+str(reranker_output+1))
-        retrieved_rule = top_rules[reranker_output]
-        # vprint('Reranker Selected Rule:\n'+retrieved_rule)
-    except Exception as e:
-        # this is caused by not having enough relevant pieces in the training data
-        # or the rerank model somehow returned something that cannot be parsed to a dictionary
-        print('oops, something is off with the reranking step')
-        print(e)
-        retrieved_rule = top_rules[0]
 
     # setup the receiver
     receiver = OpenaiSequencialDialogue(model=receiver_lm_name, stop=['\n'])
@@ -102,71 +141,243 @@ def inference_state(
     return output
 
 
+def respond_state(
+    state,
+    client_tom,
+    top_rules,
+    determine_tom_cost=0,
+    verbose=True,
+    receiver_lm_name = 'gpt-3.5-turbo-1106',
+    reranker = None
+):
+    """
+    rerank the retrieved rules and let the receiver respond following the chosen one
+    """
+    retrieved_rule, reranker_cost = choose_rule(state, client_tom, top_rules, reranker=reranker)
+    return respond_with_rule(
+        state, 
+        client_tom, 
+        retrieved_rule, 
+        determine_tom_cost = determine_tom_cost, 
+        reranker_cost = reranker_cost, 
+        verbose = verbose, 
+        receiver_lm_name = receiver_lm_name
+    )
+
+
+def inference_state(
+    state,
+    memory_bundle,
+    sentence_encoder,
+    verbose=True,
+    receiver_lm_name = 'gpt-3.5-turbo-1106',
+    tom_mode = 'multi_turn',
+    reranker = None
+):
+    """
+    run inference on a single state, main() runs the same steps as a pipeline over all states
+    """
+    client_stage, client_tom, determine_tom_cost = determine_toms_inference_mode(state, mode=tom_mode)
+    top_rules = retrieve_rules([client_tom], memory_bundle, sentence_encoder)[0]
+    return respond_state(
+        state, 
+        client_tom, 
+        top_rules, 
+        determine_tom_cost = determine_tom_cost, 
+        verbose = verbose, 
+        receiver_lm_name = receiver_lm_name,
+        reranker = reranker
+    )
+
+
 def main(args):
     
     # load the data
-    test_data = pd.read_csv(args.data_path)
-    test_dialogue_ids = sorted(list(test_data['transcript_id'].unique()))
+    test_data = AnnoMIDataset(args.data_path)
+    test_dialogue_ids = test_data.transcript_ids
 
-    sessions_to_play = []
-    for i in test_dialogue_ids:
-        sessions_to_play.append(Session(display_annomi_dialogue(test_data, i)))
+    sessions_to_play = test_data.sessions(test_dialogue_ids)
         
     print('successfully built a bunch of sessions: ', len(sessions_to_play))
     num_dialogues_to_use = args.num_dialogues_to_use
     print(f'using {num_dialogues_to_use}')
     sessions_to_play = sessions_to_play[:num_dialogues_to_use]
+    session_ids = test_dialogue_ids[:num_dialogues_to_use]
 
-    all_test_states = []
-    all_test_gold_actions = []
+    # setup embeddings, training memory lookup, etc...
+    sentence_encoder = build_sentence_encoder(args.encoder_name, cache_dir=args.embedding_cache_dir)
+    memory_bundle = load_memory_bundle(args.training_memory_path, args.memory_bundle_dir, sentence_encoder, args.encoder_name)
+    print(f'training memory: {len(memory_bundle)} rules')
+    reranker = build_reranker(
+        args.reranker, 
+        cross_encoder_name=args.cross_encoder_name, 
+        hybrid_margin=args.hybrid_margin, 
+        hybrid_workers=args.stage_workers or args.concurrency
+    )
 
-    for session in sessions_to_play:
-        session_states = []
-        session_gold_actions = []
-        
-        session.state_tracker = 3
-        session.skip_to_next_utt_by('therapist')
+    default_retry_policy.max_retry_time = args.max_retry_time
+    set_llm_backend(build_backend(args.llm_backend, args.llm_traffic_path, args.mock_latency))
+
+    # reuse TOMs inferred in training or previous runs
+    tom_store = None
+    if args.tom_store_path is not None:
+        tom_store = TomStore(args.tom_store_path)
+        set_tom_store(tom_store)
+
+    # reuse responses of deterministic requests from previous runs
+    llm_cache = None
+    if args.llm_cache_path is not None:
+        llm_cache = LLMResponseCache(args.llm_cache_path, max_size_bytes=args.llm_cache_max_mb*1024**2)
+        set_llm_cache(llm_cache)
+
+    # run many states at once, requests share one scheduler
+    engine = None
+    if args.concurrency > 1 and args.batch_dir is None:
+        engine = LLMEngine(RequestScheduler(
+            max_concurrency=args.concurrency,
+            default_rate_limit={'rpm':args.max_requests_per_minute, 'tpm':args.max_tokens_per_minute}
+        ))
+        set_llm_engine(engine)
+
+    # every output is journaled as it completes, --resume skips states already done
+    # (implied by the later rounds of a batch run, which continue the states of the earlier ones)
+    journal_path = args.journal_path or args.output_csv_file+'.journal.jsonl'
+    resume = args.resume or (args.batch_dir is not None and num_batch_rounds(args.batch_dir) > 0)
+    journal = ResultJournal(journal_path, resume=resume)
+    print(f'journal: {journal_path}, {len(journal)} states already done')
+
+    # start testing, as a pipeline: network stages run many states at once, cpu stages work on batches,
+    # and full queues hold back the stages before them, down to the extraction of state-action pairs
+    def infer_tom(state_action):
+        result_id, session_id, turn_index, state, gold_action = state_action
         try:
-            while True:
-                state, gold_action = session.state(), session.gold_action()
-                if len(session.gold_action()) > 35:
-                    session_states.append(state)
-                    session_gold_actions.append(gold_action)
-                session.skip_to_next_utt_by('therapist')
-        except IndexError:
-            all_test_states.append(session_states)
-            all_test_gold_actions.append(session_gold_actions)
+            client_stage, client_tom, determine_tom_cost = determine_toms_inference_mode(state, mode=args.tom_mode)
+        except PendingBatchRequest:
+            # waiting on the batch api, this state resumes in the next round
+            return None
+        return {'state action': state_action, 'client tom': client_tom, 'determine_tom_cost': determine_tom_cost}
 
-    all_test_states = flatten(all_test_states)
-    all_test_gold_actions = flatten(all_test_gold_actions)
-    print('num state and actions: ', len(all_test_states))
+    def retrieve(items):
+        all_top_rules = retrieve_rules([item['client tom'] for item in items], memory_bundle, sentence_encoder)
+        for item, top_rules in zip(items, all_top_rules):
+            item['top rules'] = top_rules
+        return items
 
+    def rerank(item):
+        try:
+            item['retrieved rule'], item['reranker_cost'] = choose_rule(
+                item['state action'][3], item['client tom'], item['top rules'], reranker=reranker
+            )
+        except PendingBatchRequest:
+            return None
+        return item
 
-    # setup embeddings, training memory lookup, etc...
-    training_memory = pd.read_csv(args.training_memory_path)
-    from sentence_transformers import SentenceTransformer
-    sentence_encoder = SentenceTransformer('all-MiniLM-L6-v2')
-    client_tom_embeddings = sentence_encoder.encode(list(training_memory['client tom']))
-
-    # start testing
-    total_cost = 0
-    num_state_action_pairs = len(all_test_states)
-    play_outcomes = []
-    for i in tqdm(list(range(num_state_action_pairs))):
-        inference_output = inference_state(
-            state = all_test_states[i],
-            training_memory = training_memory,
-            client_tom_embeddings = client_tom_embeddings,
-            sentence_encoder = sentence_encoder,
-            verbose=True,
-            receiver_lm_name = args.receiver_lm_name
-        )
-        inference_output['gold action'] = all_test_gold_actions[i]
-        play_outcomes.append(inference_output)
-        total_cost += inference_output['cost']
-        print(f'Total Cost So Far: {total_cost}')
-
-    # saving
+    def rerank_batch(items):
+        try:
+            chosen = choose_rules_batch(
+                [item['state action'][3] for item in items], 
+                [item['client tom'] for item in items], 
+                [item['top rules'] for item in items], 
+                reranker
+            )
+        except PendingBatchRequest:
+            # some llm escalation waits on the batch api, only those states resume in the next round
+            return [rerank(item) for item in items]
+        for item, (retrieved_rule, reranker_cost) in zip(items, chosen):
+            item['retrieved rule'], item['reranker_cost'] = retrieved_rule, reranker_cost
+        return items
+
+    def respond(item):
+        result_id, session_id, turn_index, state, gold_action = item['state action']
+        try:
+            inference_output = respond_with_rule(
+                state = state,
+                client_tom = item['client tom'],
+                retrieved_rule = item['retrieved rule'],
+                determine_tom_cost = item['determine_tom_cost'],
+                reranker_cost = item['reranker_cost'],
+                verbose = args.concurrency == 1 and args.batch_dir is None,
+                receiver_lm_name = args.receiver_lm_name
+            )
+        except PendingBatchRequest:
+            return None
+        inference_output['gold action'] = gold_action
+        inference_output['transcript id'] = session_id
+        inference_output['turn index'] = turn_index
+        journal.append(result_id, inference_output)
+        return inference_output
+
+    num_network_workers = args.stage_workers or args.concurrency
+    if hasattr(reranker, 'rerank_batch'):
+        rerank_stage = Stage('rerank', rerank_batch, batch_size=args.rerank_batch_size)
+    else:
+        rerank_stage = Stage('rerank', rerank, num_workers=num_network_workers)
+    pipeline = Pipeline([
+        Stage('client tom', infer_tom, num_workers=num_network_workers),
+        Stage('retrieve', retrieve, batch_size=args.retrieval_batch_size),
+        rerank_stage,
+        Stage('respond', respond, num_workers=num_network_workers)
+    ], queue_size=args.pipeline_queue_size)
+
+    result_ids = []
+    def unfinished_state_actions():
+        result_ids.clear()
+        for session_id, turn_index, state, gold_action in iter_state_actions(
+            sessions_to_play, 
+            session_ids = session_ids, 
+            min_action_length = args.min_action_length, 
+            max_prev_turns = args.max_prev_turns
+        ):
+            result_id = state_action_id(session_id, turn_index, state, gold_action)
+            result_ids.append(result_id)
+            if result_id not in journal:
+                yield result_id, session_id, turn_index, state, gold_action
+
+    def run_all_states():
+        total_cost = 0
+        for inference_output in pipeline.run(unfinished_state_actions()):
+            total_cost += inference_output['cost']
+            print(f'Total Cost So Far: {total_cost}')
+        return journal.compact(result_ids)
+
+    pending_requests_path = None
+    if args.batch_dir is not None:
+        # offline batch api mode, every run advances all states by one round of requests
+        def run_batch_pipeline(collector):
+            set_llm_engine(collector)
+            try:
+                return run_all_states()
+            finally:
+                set_llm_engine(None)
+        play_outcomes, pending_requests_path = run_batch_round(args.batch_dir, run_batch_pipeline)
+    else:
+        play_outcomes = run_all_states()
+
+    if engine is not None:
+        set_llm_engine(None)
+        engine.close()
+    print('Retry metrics: ', default_retry_policy.metrics.snapshot())
+    if tom_store is not None:
+        print('TOM store: ', tom_store.stats())
+        set_tom_store(None)
+        tom_store.close()
+    if llm_cache is not None:
+        print('LLM response cache: ', llm_cache.stats())
+        set_llm_cache(None)
+        llm_cache.close()
+
+    print('Pipeline: ', pipeline.stats())
+    if isinstance(sentence_encoder, CachedSentenceEncoder):
+        print('Embedding cache: ', sentence_encoder.stats())
+        sentence_encoder.close()
+    if isinstance(reranker, HybridReranker):
+        print(f'Reranker escalation rate: {reranker.escalation_rate()}')
+    print('num state and actions: ', len(result_ids))
+    if pending_requests_path is not None:
+        print(f'{len(play_outcomes)} of {len(result_ids)} states done, not saving until all batch results are in')
+        return
+
+    # saving, compacts the journal into the output file
     pd.DataFrame(play_outcomes).to_csv(args.output_csv_file)
 
 if __name__ == '__main__':
@@ -182,6 +393,62 @@ if __name__ == '__main__':
                         help='how many dialogue to use, if you have more than you want')
     parser.add_argument('--training_memory_path', type=str, default='',
                         help='path to the csv file generated by training')
+    parser.add_argument('--memory_bundle_dir', type=str, default=None,
+                        help='training memory with precomputed embeddings, built from (and kept in sync with) --training_memory_path if that is given, '+\
+                        'defaults to training_memory_path + .bundle')
+    parser.add_argument('--encoder_name', type=str, default='all-MiniLM-L6-v2',
+                        help='sentence-transformers model used to retrieve rules by client tom')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None,
+                        help='persistent cache of sentence embeddings, only texts not seen before are encoded, no caching if not set')
+    parser.add_argument('--retrieval_batch_size', type=int, default=256,
+                        help='up to how many states to encode and retrieve rules for at once')
+    parser.add_argument('--rerank_batch_size', type=int, default=32,
+                        help='up to how many states the local cross-encoder reranker scores at once')
+    parser.add_argument('--stage_workers', type=int, default=None,
+                        help='workers of each llm stage (client tom, gpt rerank, respond), defaults to --concurrency')
+    parser.add_argument('--pipeline_queue_size', type=int, default=64,
+                        help='how many states may wait between two stages, bounds memory use')
+    parser.add_argument('--reranker', type=str, default='gpt', choices=['gpt', 'cross_encoder', 'hybrid'],
+                        help='how to pick one of the retrieved rules: ask gpt, score them with a local cross-encoder, '+\
+                        'or the cross-encoder asking gpt only when its top scores are close')
+    parser.add_argument('--cross_encoder_name', type=str, default='cross-encoder/ms-marco-MiniLM-L-6-v2',
+                        help='sentence-transformers cross-encoder used by the cross_encoder/hybrid rerankers')
+    parser.add_argument('--hybrid_margin', type=float, default=1.0,
+                        help='hybrid reranker asks gpt about the rules scoring within this margin of the best one')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='how many states to run inference on at the same time')
+    parser.add_argument('--max_requests_per_minute', type=int, default=None,
+                        help='per-model request budget when running concurrently')
+    parser.add_argument('--max_tokens_per_minute', type=int, default=None,
+                        help='per-model token budget when running concurrently')
+    parser.add_argument('--llm_cache_path', type=str, default=None,
+                        help='sqlite file to cache llm responses in, no caching if not set')
+    parser.add_argument('--llm_cache_max_mb', type=int, default=1024,
+                        help='size limit of the llm response cache, least recently used entries are evicted first')
+    parser.add_argument('--max_retry_time', type=float, default=600,
+                        help='give up on a request after retrying it for this many seconds')
+    parser.add_argument('--batch_dir', type=str, default=None,
+                        help='offline batch api mode: export prompts to / ingest results from this directory, one stage per run '+\
+                        '(runs after the first resume the journal)')
+    parser.add_argument('--llm_backend', type=str, default='openai', choices=['openai', 'mock', 'record', 'replay'],
+                        help='where llm requests go, mock/replay run without network (e.g. for benchmarking)')
+    parser.add_argument('--llm_traffic_path', type=str, default=None,
+                        help='jsonl file the record backend writes to and the replay backend reads from')
+    parser.add_argument('--mock_latency', type=float, default=0.0,
+                        help='mean latency in seconds of the mock backend')
+    parser.add_argument('--tom_mode', type=str, default='multi_turn', choices=['multi_turn', 'single'],
+                        help='infer the client TOM with one request per field (the original prompts), or in one cheaper json request')
+    parser.add_argument('--tom_store_path', type=str, default=None,
+                        help='sqlite file of inferred TOMs shared across runs (see precompute_toms.py), not used if not set')
+    parser.add_argument('--min_action_length', type=int, default=35,
+                        help='only evaluate on therapist turns longer than this many characters')
+    parser.add_argument('--max_prev_turns', type=int, default=4,
+                        help='how many previous turns make up the dialogue state')
+    parser.add_argument('--journal_path', type=str, default=None,
+                        help='jsonl file each output is appended to as it completes, defaults to output_csv_file + .journal.jsonl')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a crashed or killed run (or a batch api round), states already in the journal are not run again '+\
+                        '(without it, a run stops rather than overwrite a journal with results)')
     args = parser.parse_args()
     print(args)
     main(args)
\ No newline at end of file
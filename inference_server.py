@@ -0,0 +1,340 @@
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import (
+RequestScheduler,
+LLMEngine,
+set_llm_engine,
+LLMResponseCache,
+set_llm_cache,
+default_retry_policy,
+set_llm_backend,
+build_backend,
+TomStore,
+set_tom_store,
+build_reranker,
+CachedSentenceEncoder,
+build_sentence_encoder
+)
+from utils import OPENAI_API_KEY
+import openai
+openai.api_key = OPENAI_API_KEY
+from tom_detector import determine_toms_inference_mode
+from inference import load_memory_bundle, retrieve_rules, choose_rule, respond_with_rule
+
+
+class InferenceService:
+
+    """
+    Memory bundle, sentence encoder and reranker loaded once, answers dialogue contexts from many threads.
+    At most max_concurrency contexts are worked on at once, others wait up to queue_timeout seconds.
+    """
+
+    def __init__(
+        self,
+        memory_bundle,
+        sentence_encoder,
+        reranker,
+        receiver_lm_name = 'gpt-3.5-turbo-1106',
+        tom_mode = 'multi_turn',
+        max_concurrency = 8,
+        queue_timeout = 30
+    ):
+        self.memory_bundle = memory_bundle
+        self.sentence_encoder = sentence_encoder
+        self.reranker = reranker
+        self.receiver_lm_name = receiver_lm_name
+        self.tom_mode = tom_mode
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.encoder_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        # every request, then how each one ended
+        self.num_requests = 0
+        self.num_succeeded = 0
+        self.num_errors = 0
+        self.num_rejected = 0
+        self.num_bad_requests = 0
+        self.num_in_flight = 0
+        self.total_cost = 0
+        self.latencies = deque(maxlen=1000)
+
+    def respond(self, context, receiver_lm_name=None):
+        """
+        client tom, retrieved rule and therapist response for a dialogue context (formatted like the training states),
+        None if the service is too busy
+        """
+        with self.lock:
+            self.num_requests += 1
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            with self.lock:
+                self.num_rejected += 1
+            return None
+        start = time.time()
+        with self.lock:
+            self.num_in_flight += 1
+        try:
+            client_stage, client_tom, determine_tom_cost = determine_toms_inference_mode(context, mode=self.tom_mode)
+            with self.encoder_lock:
+                top_rules = retrieve_rules([client_tom], self.memory_bundle, self.sentence_encoder)[0]
+            retrieved_rule, reranker_cost = choose_rule(context, client_tom, top_rules, reranker=self.reranker)
+            output = respond_with_rule(
+                context,
+                client_tom,
+                retrieved_rule,
+                determine_tom_cost = determine_tom_cost,
+                reranker_cost = reranker_cost,
+                verbose = False,
+                receiver_lm_name = receiver_lm_name or self.receiver_lm_name
+            )
+            output['client stage'] = client_stage
+            output['top rules'] = top_rules
+        except Exception:
+            with self.lock:
+                self.num_errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.num_in_flight -= 1
+            self.slots.release()
+        with self.lock:
+            self.num_succeeded += 1
+            self.total_cost += output['cost']
+            self.latencies.append(time.time()-start)
+        return output
+
+    def record_bad_request(self):
+        """
+        count a request rejected before it reached respond (malformed body)
+        """
+        with self.lock:
+            self.num_requests += 1
+            self.num_bad_requests += 1
+
+    def metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            metrics = {
+                'uptime seconds': time.time()-self.start_time,
+                'requests': self.num_requests,
+                'succeeded': self.num_succeeded,
+                'errors': self.num_errors,
+                'rejected': self.num_rejected,
+                'bad requests': self.num_bad_requests,
+                'in flight': self.num_in_flight,
+                'total cost': self.total_cost,
+                'num rules': len(self.memory_bundle)
+            }
+        if len(latencies) > 0:
+            metrics['latency seconds'] = {
+                'mean': sum(latencies)/len(latencies),
+                'p50': latencies[len(latencies)//2],
+                'p95': latencies[min(int(len(latencies)*0.95), len(latencies)-1)]
+            }
+        metrics['retry metrics'] = default_retry_policy.metrics.snapshot()
+        return metrics
+
+
+def parse_respond_request(body):
+    """
+    context and receiver lm name of a POST /respond body, ValueError if it is malformed
+    """
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise ValueError('the body is not valid json')
+    if not isinstance(request, dict):
+        raise ValueError('expected a json object')
+    context = request.get('context')
+    if not isinstance(context, str) or context.strip() == '':
+        raise ValueError('expected a non-empty "context" string')
+    receiver_lm_name = request.get('receiver_lm_name')
+    if receiver_lm_name is not None and not isinstance(receiver_lm_name, str):
+        raise ValueError('"receiver_lm_name" should be a string')
+    return context, receiver_lm_name
+
+
+def build_inference_server(service, host='127.0.0.1', port=8080, extra_metrics=None):
+    """
+    HTTP interface of an InferenceService, port 0 picks a free port (see server.server_address)
+
+    POST /respond   {"context": "...", "receiver_lm_name": optional}
+    GET  /health
+    GET  /metrics   (plus whatever extra_metrics() returns, e.g. cache stats)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, obj):
+            body = json.dumps(obj, default=str).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.rstrip('/')
+            if path == '/health':
+                self._send_json(200, {'status': 'ok', 'num rules': len(service.memory_bundle)})
+            elif path == '/metrics':
+                metrics = service.metrics()
+                if extra_metrics is not None:
+                    metrics.update(extra_metrics())
+                self._send_json(200, metrics)
+            else:
+                self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/respond':
+                self._send_json(404, {'error': f'unknown endpoint {self.path}'})
+                return
+            try:
+                content_length = int(self.headers.get('Content-Length', 0))
+                context, receiver_lm_name = parse_respond_request(self.rfile.read(content_length))
+            except ValueError as e:
+                service.record_bad_request()
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                output = service.respond(context, receiver_lm_name=receiver_lm_name)
+            except Exception as e:
+                self._send_json(500, {'error': repr(e)})
+                return
+            if output is None:
+                self._send_json(503, {'error': 'too many requests in flight, retry later'})
+                return
+            self._send_json(200, output)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def serve_inference(service, host='127.0.0.1', port=8080, extra_metrics=None):
+    """
+    serve an InferenceService over HTTP (blocks, call from the main thread), see build_inference_server
+    """
+    server = build_inference_server(service, host=host, port=port, extra_metrics=extra_metrics)
+    print(f'serving on http://{host}:{server.server_address[1]} (POST /respond, GET /health, GET /metrics)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(args):
+
+    # everything slow happens once, here
+    sentence_encoder = build_sentence_encoder(args.encoder_name, cache_dir=args.embedding_cache_dir)
+    memory_bundle = load_memory_bundle(args.training_memory_path, args.memory_bundle_dir, sentence_encoder, args.encoder_name)
+    print(f'training memory: {len(memory_bundle)} rules')
+    reranker = build_reranker(args.reranker, cross_encoder_name=args.cross_encoder_name, hybrid_margin=args.hybrid_margin)
+
+    default_retry_policy.max_retry_time = args.max_retry_time
+    set_llm_backend(build_backend(args.llm_backend, args.llm_traffic_path, args.mock_latency))
+    tom_store = None
+    if args.tom_store_path is not None:
+        tom_store = TomStore(args.tom_store_path)
+        set_tom_store(tom_store)
+    llm_cache = None
+    if args.llm_cache_path is not None:
+        llm_cache = LLMResponseCache(args.llm_cache_path, max_size_bytes=args.llm_cache_max_mb*1024**2)
+        set_llm_cache(llm_cache)
+    # requests of all clients share one scheduler
+    engine = LLMEngine(RequestScheduler(
+        max_concurrency=args.concurrency,
+        default_rate_limit={'rpm':args.max_requests_per_minute, 'tpm':args.max_tokens_per_minute}
+    ))
+    set_llm_engine(engine)
+
+    def extra_metrics():
+        metrics = dict()
+        if tom_store is not None:
+            metrics['tom store'] = tom_store.stats()
+        if llm_cache is not None:
+            metrics['llm response cache'] = llm_cache.stats()
+        if isinstance(sentence_encoder, CachedSentenceEncoder):
+            metrics['embedding cache'] = sentence_encoder.stats()
+        return metrics
+
+    service = InferenceService(
+        memory_bundle,
+        sentence_encoder,
+        reranker,
+        receiver_lm_name = args.receiver_lm_name,
+        tom_mode = args.tom_mode,
+        max_concurrency = args.concurrency,
+        queue_timeout = args.queue_timeout
+    )
+    try:
+        serve_inference(service, host=args.host, port=args.port, extra_metrics=extra_metrics)
+    finally:
+        set_llm_engine(None)
+        engine.close()
+        if tom_store is not None:
+            set_tom_store(None)
+            tom_store.close()
+        if llm_cache is not None:
+            set_llm_cache(None)
+            llm_cache.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve the learned dialogue strategies over HTTP')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--training_memory_path', type=str, default='',
+                        help='path to the csv file generated by training')
+    parser.add_argument('--memory_bundle_dir', type=str, default=None,
+                        help='training memory with precomputed embeddings (see inference.py), defaults to training_memory_path + .bundle')
+    parser.add_argument('--encoder_name', type=str, default='all-MiniLM-L6-v2',
+                        help='sentence-transformers model used to retrieve rules by client tom')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None,
+                        help='persistent cache of sentence embeddings, only texts not seen before are encoded, no caching if not set')
+    parser.add_argument('--reranker', type=str, default='gpt', choices=['gpt', 'cross_encoder', 'hybrid'],
+                        help='how to pick one of the retrieved rules')
+    parser.add_argument('--cross_encoder_name', type=str, default='cross-encoder/ms-marco-MiniLM-L-6-v2',
+                        help='sentence-transformers cross-encoder used by the cross_encoder/hybrid rerankers')
+    parser.add_argument('--hybrid_margin', type=float, default=1.0,
+                        help='hybrid reranker asks gpt about the rules scoring within this margin of the best one')
+    parser.add_argument('--receiver_lm_name', type=str, default='gpt-3.5-turbo-1106',
+                        help='openai name of the receiver lm, requests can override it')
+    parser.add_argument('--tom_mode', type=str, default='multi_turn', choices=['multi_turn', 'single'],
+                        help='infer the client TOM with one request per field (the original prompts), or in one cheaper json request')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='how many dialogue contexts to work on at the same time')
+    parser.add_argument('--queue_timeout', type=float, default=30,
+                        help='seconds a request may wait for a free slot before getting a 503')
+    parser.add_argument('--max_requests_per_minute', type=int, default=None,
+                        help='per-model request budget')
+    parser.add_argument('--max_tokens_per_minute', type=int, default=None,
+                        help='per-model token budget')
+    parser.add_argument('--llm_cache_path', type=str, default=None,
+                        help='sqlite file to cache llm responses in, no caching if not set')
+    parser.add_argument('--llm_cache_max_mb', type=int, default=1024,
+                        help='size limit of the llm response cache, least recently used entries are evicted first')
+    parser.add_argument('--max_retry_time', type=float, default=600,
+                        help='give up on a request after retrying it for this many seconds')
+    parser.add_argument('--llm_backend', type=str, default='openai', choices=['openai', 'mock', 'record', 'replay'],
+                        help='where llm requests go, mock/replay run without network')
+    parser.add_argument('--llm_traffic_path', type=str, default=None,
+                        help='jsonl file the record backend writes to and the replay backend reads from')
+    parser.add_argument('--mock_latency', type=float, default=0.0,
+                        help='mean latency in seconds of the mock backend')
+    parser.add_argument('--tom_store_path', type=str, default=None,
+                        help='sqlite file of inferred TOMs shared across runs, not used if not set')
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,63 @@
+import ast
+import json
+import pandas as pd
+from collections import defaultdict
+from utils.journal import state_action_id
+
+
+def main(args):
+
+    # shards in a fixed order, so the copy kept of a duplicated pair does not depend on how they were passed
+    shard_paths = sorted(args.memory_shards)
+    shards = []
+    for path in shard_paths:
+        shard = pd.read_csv(path, index_col=0)
+        if 'state action id' not in shard.columns:
+            shard['state action id'] = [
+                state_action_id(*row) for row in zip(shard['transcript id'], shard['turn index'], shard['context'], shard['gold response'])
+            ]
+        print(f'{path}: {len(shard)} state-action pairs')
+        shards.append(shard)
+    memory = pd.concat(shards, ignore_index=True)
+    num_rows = len(memory)
+    memory = memory.drop_duplicates(subset='state action id', keep='first')
+
+    # dialogue order, then turn order, the same whatever the number of shards
+    if args.index_dir is not None:
+        dialogue_position = {dialogue_id: i for i, dialogue_id in enumerate(pd.read_csv(args.index_dir)['id'])}
+        memory['dialogue position'] = [dialogue_position.get(i, len(dialogue_position)) for i in memory['transcript id']]
+    else:
+        memory['dialogue position'] = memory['transcript id']
+    memory = memory.sort_values(['dialogue position', 'transcript id', 'turn index', 'state action id'], kind='mergesort')
+    memory = memory.drop(columns=['dialogue position']).reset_index(drop=True)
+    memory.to_csv(args.output_csv_file)
+
+    cost_breakdown = defaultdict(float)
+    for breakdown in memory['cost breakdown']:
+        for k, v in ast.literal_eval(breakdown).items():
+            cost_breakdown[k] += v
+    metadata = {
+        'memory shards': {path: len(shard) for path, shard in zip(shard_paths, shards)},
+        'num state and actions': len(memory),
+        'num duplicates dropped': num_rows-len(memory),
+        'total cost': float(memory['cost'].sum()),
+        'cost breakdown': dict(cost_breakdown),
+        'sender lm names': sorted(set(memory['sender lm name'])),
+        'receiver lm names': sorted(set(memory['receiver lm name']))
+    }
+    print(metadata)
+    with open(args.output_csv_file+'.meta.json', 'w') as ofp:
+        json.dump(metadata, ofp, indent=2)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Merge the memory shards of a sharded training run (train_agent.py --num_shards)')
+    parser.add_argument('memory_shards', type=str, nargs='+',
+                        help='csv files written by the shards')
+    parser.add_argument('--output_csv_file', type=str, default=None,
+                        help='merged memory csv, cost metadata is written next to it (.meta.json)')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='csv to the order of dialog ids used for training, dialogues are ordered by transcript id if not set')
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,60 @@
+from utils import (
+AnnoMIDataset,
+iter_state_actions,
+RequestScheduler,
+LLMEngine,
+set_llm_engine,
+ordered_parallel_map,
+TomStore,
+set_tom_store
+)
+import openai
+from utils import OPENAI_API_KEY
+openai.api_key = OPENAI_API_KEY
+from tom_detector import determine_toms, determine_toms_inference_mode
+
+
+def main(args):
+
+    # every state of every dialogue in the csv
+    dataset = AnnoMIDataset(args.data_path)
+    state_actions = iter_state_actions(dataset.sessions(), session_ids=dataset.transcript_ids)
+
+    tom_store = TomStore(args.tom_store_path)
+    set_tom_store(tom_store)
+    engine = LLMEngine(RequestScheduler(max_concurrency=args.concurrency))
+    set_llm_engine(engine)
+
+    def precompute(state_action):
+        session_id, turn_index, state, gold_action = state_action
+        if args.with_gold_actions:
+            return determine_toms(state, gold_action, llm_name=args.llm_name, mode=args.tom_mode)[-1]
+        return determine_toms_inference_mode(state, llm_name=args.llm_name, mode=args.tom_mode)[-1]
+
+    total_cost = sum(ordered_parallel_map(precompute, state_actions, concurrency=args.concurrency))
+
+    set_llm_engine(None)
+    engine.close()
+    set_tom_store(None)
+    print(f'Total Cost: {total_cost}')
+    print('TOM store: ', tom_store.stats())
+    tom_store.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Precompute TOMs for a whole csv split')
+    parser.add_argument('--data_path', type=str, default=None,
+                        help='AnnoMI csv split')
+    parser.add_argument('--tom_store_path', type=str, default=None,
+                        help='sqlite file to store the TOMs in, pass the same file to train_agent.py / inference.py')
+    parser.add_argument('--with_gold_actions', action='store_true',
+                        help='training-style TOMs with the gold response (for train_agent.py only), client fields for inference otherwise')
+    parser.add_argument('--llm_name', type=str, default='gpt-3.5-turbo-1106',
+                        help='openai name of the lm used for TOM inference')
+    parser.add_argument('--tom_mode', type=str, default='multi_turn', choices=['multi_turn', 'single'],
+                        help='infer the TOM fields with one request per field (the original prompts), or all in one cheaper json request')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='how many states to work on at the same time')
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+# the scripts and utils/ live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+TINY_CLASSIFIER_LABELS = ['Affirm', 'Question', 'Support']
+TINY_CLASSIFIER_WORDS = ['what', 'would', 'help', 'you', 'can', 'do', 'it', 'great', 'job', 'i', 'am', 'here', 'for', '?', '!', '.']
+
+
+@pytest.fixture(scope='session')
+def tiny_classifier_dir(tmp_path_factory):
+    """
+    a randomly initialized, very small bert classifier saved like a fine-tuned one
+    """
+    import joblib
+    import torch
+    from sklearn.preprocessing import LabelEncoder
+    from transformers import BertConfig, BertForSequenceClassification, BertTokenizerFast
+    path = tmp_path_factory.mktemp('tiny_classifier')
+    with open(path/'vocab.txt', 'w') as ofp:
+        ofp.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']+TINY_CLASSIFIER_WORDS)+'\n')
+    BertTokenizerFast(vocab_file=str(path/'vocab.txt')).save_pretrained(str(path))
+    torch.manual_seed(0)
+    config = BertConfig(
+        vocab_size=len(TINY_CLASSIFIER_WORDS)+5, hidden_size=16, num_hidden_layers=1, num_attention_heads=2,
+        intermediate_size=32, max_position_embeddings=512, num_labels=len(TINY_CLASSIFIER_LABELS)
+    )
+    BertForSequenceClassification(config).save_pretrained(str(path))
+    joblib.dump(LabelEncoder().fit(TINY_CLASSIFIER_LABELS), path/'label_encoder.joblib')
+    return str(path)
+
+
+@pytest.fixture
+def llm_globals():
+    """
+    lets a test install its own llm backend / cache, the previous ones are put back afterwards
+    """
+    from utils import openai_dialogue
+    saved = openai_dialogue._llm_backend, openai_dialogue._llm_cache, openai_dialogue._llm_engine
+    yield
+    openai_dialogue._llm_backend, openai_dialogue._llm_cache, openai_dialogue._llm_engine = saved
@@ -0,0 +1,70 @@
+import os
+
+import pandas as pd
+import pytest
+
+from utils.annomi_utils import AnnoMIDataset, display_annomi_dialogue
+from utils.session import Session
+
+
+ANNOMI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'AnnoMI')
+
+
+def write_csv(path, rows):
+    pd.DataFrame(rows, columns=['transcript_id', 'timestamp', 'interlocutor', 'utterance_text', 'topic', 'extra']).to_csv(path)
+
+
+ROWS = [
+    # out of time order, with a duplicated timestamp and a cut-off utterance
+    (7, '00:00:05', 'client', 'I guess I could try.', 'smoking', 'x'),
+    (7, '00:00:01', 'therapist', 'How are you?', 'smoking', 'x'),
+    (7, '00:00:01', 'therapist', 'duplicate row, dropped', 'smoking', 'y'),
+    (7, '00:00:03', 'client', 'Fine, I-', 'smoking', 'x'),
+    (7, '00:00:04', 'therapist', 'Mm-hmm.', 'smoking', 'x'),
+    (3, '00:00:02', 'client', 'Hello.', 'alcohol', 'x'),
+    (3, '00:00:01', 'therapist', 'Welcome.', 'alcohol', 'x'),
+]
+
+
+@pytest.mark.parametrize('csv_name', ['train.csv', 'test.csv'])
+def test_same_dialogues_as_display_annomi_dialogue(csv_name, tmp_path):
+    csv_path = os.path.join(ANNOMI_DIR, csv_name)
+    dataframe = pd.read_csv(csv_path)
+    dataset = AnnoMIDataset(csv_path, cache_dir=str(tmp_path))
+    assert dataset.transcript_ids == sorted(dataframe['transcript_id'].unique())
+    for transcript_id in dataset.transcript_ids:
+        assert dataset.dialogue(transcript_id) == display_annomi_dialogue(dataframe, transcript_id)
+
+
+def test_small_csv(tmp_path):
+    csv_path = str(tmp_path/'small.csv')
+    write_csv(csv_path, ROWS)
+    dataset = AnnoMIDataset(csv_path)
+    assert dataset.transcript_ids == [3, 7]
+    assert dataset.dialogue(7) == display_annomi_dialogue(pd.read_csv(csv_path), 7)
+    assert dataset.dialogue(7)['turns'][0] == {'role': 'therapist', 'utterance': 'How are you?'}
+    assert 3 in dataset and 4 not in dataset
+
+
+def test_cache_is_used_and_invalidated(tmp_path):
+    csv_path = str(tmp_path/'small.csv')
+    write_csv(csv_path, ROWS)
+    first = AnnoMIDataset(csv_path)
+    assert os.path.exists(first.cache_path)
+    assert AnnoMIDataset(csv_path).dialogues == first.dialogues
+
+    write_csv(csv_path, ROWS[:2])
+    changed = AnnoMIDataset(csv_path)
+    assert changed.cache_path != first.cache_path
+    assert changed.transcript_ids == [7]
+
+
+def test_sessions_are_fresh(tmp_path):
+    csv_path = str(tmp_path/'small.csv')
+    write_csv(csv_path, ROWS)
+    dataset = AnnoMIDataset(csv_path, use_cache=False)
+    session = dataset[7]
+    assert isinstance(session, Session)
+    session.state_tracker = 3
+    assert dataset[7].state_tracker == 0
+    assert [s.topic for s in dataset.sessions()] == ['alcohol', 'smoking']
@@ -0,0 +1,151 @@
+import asyncio
+import random
+import threading
+import time
+
+import openai
+import pytest
+
+from utils.async_dialogue import LLMEngine, RequestScheduler, TokenBucket, ordered_parallel_map
+from utils.llm_backends import MockBackend
+from utils.openai_dialogue import BilledCostMeter, OpenaiSequencialDialogue, set_llm_backend, set_llm_engine
+from utils.retry_policy import RetryPolicy
+
+
+class CountingBackend(MockBackend):
+
+    """
+    MockBackend that remembers how many requests were in flight at most
+    """
+
+    def __init__(self, *args, error=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.error = error
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def acomplete(self, request_kwargs, timeout_tolerance=15):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._latency())
+            if self.error is not None:
+                raise self.error
+            return self._response(request_kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def request(content, model='gpt-3.5-turbo-1106'):
+    return {'model': model, 'messages': [{'role': 'user', 'content': content}], 'max_tokens': 16, 'stop': None}
+
+
+@pytest.fixture
+def engine():
+    engine = LLMEngine(RequestScheduler(max_concurrency=3))
+    yield engine
+    engine.close()
+
+
+def test_ordered_parallel_map_keeps_the_input_order():
+    def fn(item):
+        time.sleep(random.random()*0.01)
+        return item*item
+    assert list(ordered_parallel_map(fn, range(50), concurrency=8, disable_tqdm=True)) == [i*i for i in range(50)]
+
+
+def test_ordered_parallel_map_reads_the_input_lazily():
+    consumed = []
+    def items():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+    results = ordered_parallel_map(lambda item: item, items(), concurrency=2, max_pending=4, disable_tqdm=True)
+    assert next(results) == 0
+    assert len(consumed) <= 4
+    assert list(results) == list(range(1, 100))
+
+
+def test_ordered_parallel_map_raises_a_worker_error():
+    def fn(item):
+        if item == 7:
+            raise ValueError('item 7')
+        return item
+    results = ordered_parallel_map(fn, range(20), concurrency=4, disable_tqdm=True)
+    with pytest.raises(ValueError, match='item 7'):
+        list(results)
+
+
+def test_engine_bounds_the_requests_in_flight(engine):
+    backend = CountingBackend(latency=0.02)
+    results = list(ordered_parallel_map(
+        lambda i: engine.complete(request(f'request {i}'), backend=backend, retry_policy=RetryPolicy()),
+        range(20), concurrency=10, disable_tqdm=True
+    ))
+    assert backend.num_requests == 20
+    assert 1 < backend.max_in_flight <= 3
+    # each worker gets the response to its own request
+    assert [r['usage']['prompt_tokens'] for r in results] == [len(f'request {i}')//4 for i in range(20)]
+
+
+def test_engine_raises_a_request_error_in_the_calling_thread(engine):
+    backend = CountingBackend(error=openai.error.InvalidRequestError('prompt too long', None))
+    with pytest.raises(openai.error.InvalidRequestError):
+        engine.complete(request('hi'), backend=backend, retry_policy=RetryPolicy())
+
+
+def test_engine_close_closes_the_loop():
+    engine = LLMEngine()
+    engine.complete(request('hi'), backend=MockBackend(), retry_policy=RetryPolicy())
+    engine.close()
+    assert not engine.thread.is_alive() and engine.loop.is_closed()
+
+
+def test_requests_through_the_engine_are_billed(engine, llm_globals):
+    set_llm_backend(MockBackend())
+    set_llm_engine(engine)
+    billed = []
+    def play(i):
+        with BilledCostMeter() as meter:
+            dialogue = OpenaiSequencialDialogue(model='gpt-3.5-turbo-1106')
+            dialogue.send_user_message(f'question {i} '*40)
+        billed.append((meter.total, dialogue.cost()['billed']))
+    threads = [threading.Thread(target=play, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(billed) == 6
+    assert all(total > 0 and total == pytest.approx(cost) for total, cost in billed)
+
+
+def test_token_bucket_waits_for_the_refill():
+    async def run():
+        # 600 per minute: starts full, then refills 10 per second
+        bucket = TokenBucket(600)
+        start = time.monotonic()
+        await bucket.acquire(600)
+        assert time.monotonic()-start < 0.05
+        await bucket.acquire(3)
+        return time.monotonic()-start
+    assert 0.25 < asyncio.run(run()) < 1
+
+
+def test_token_bucket_lets_an_oversized_request_through_alone():
+    async def run():
+        bucket = TokenBucket(60)
+        await asyncio.wait_for(bucket.acquire(1000), timeout=0.5)
+        return bucket.available
+    assert asyncio.run(run()) < 1
+
+
+def test_scheduler_refunds_the_unused_token_estimate():
+    async def run():
+        scheduler = RequestScheduler(default_rate_limit={'tpm': 1000})
+        backend = MockBackend(completion_tokens=5)
+        response = await scheduler.run('m', 400, lambda: backend.acomplete(request('hi', model='m')))
+        return response, scheduler.buckets['m']['tpm'].available
+    response, available = asyncio.run(run())
+    assert available == pytest.approx(1000-response['usage']['total_tokens'], abs=1)
@@ -0,0 +1,147 @@
+import glob
+import json
+import os
+from argparse import Namespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import inference
+import sentence_transformers
+from utils.batch_api import BatchCollector, PendingBatchRequest, num_batch_rounds
+from utils.llm_backends import MockBackend
+from utils.llm_cache import request_key
+
+
+class LengthEncoder:
+
+    """
+    tiny deterministic sentence encoder
+    """
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False):
+        embeddings = np.array([[len(text), 1+text.count(' ')] for text in texts], dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+class TiedCrossEncoder:
+
+    """
+    sentence_transformers.CrossEncoder stand-in that scores every pair the same
+    """
+
+    def __init__(self, model_name, device='cpu'):
+        pass
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=False):
+        return np.zeros(len(pairs))
+
+
+def request(content):
+    return {'model': 'gpt-3.5-turbo-1106', 'messages': [{'role': 'user', 'content': content}], 'max_tokens': 16, 'stop': None}
+
+
+def answer_batch(requests_path, results_path, fail=()):
+    """
+    what the batch api would return for a requests file, answered by MockBackend
+    """
+    backend = MockBackend()
+    with open(requests_path) as ifp, open(results_path, 'w') as ofp:
+        for line in ifp:
+            entry = json.loads(line)
+            if entry['custom_id'] in fail:
+                result = {'custom_id': entry['custom_id'], 'response': None, 'error': {'message': 'server error'}}
+            else:
+                response = backend.complete(entry['body'])
+                result = {'custom_id': entry['custom_id'], 'response': {'status_code': 200, 'body': response}, 'error': None}
+            ofp.write(json.dumps(result)+'\n')
+
+
+def test_collector_round_trip(tmp_path):
+    collector = BatchCollector()
+    with pytest.raises(PendingBatchRequest):
+        collector.complete(request('a'))
+    with pytest.raises(PendingBatchRequest):
+        collector.complete(request('b'))
+    assert collector.export(str(tmp_path/'requests.jsonl')) == 2
+    answer_batch(str(tmp_path/'requests.jsonl'), str(tmp_path/'results.jsonl'), fail={request_key(request('b'))})
+
+    collector = BatchCollector()
+    assert collector.ingest(str(tmp_path/'results.jsonl')) == 1
+    assert collector.complete(request('a'))['choices'][0]['message']['content']
+    # failed requests are asked again
+    with pytest.raises(PendingBatchRequest):
+        collector.complete(request('b'))
+
+
+def inference_args(tmp_path, name, **kwargs):
+    args = dict(
+        data_path='AnnoMI/test.csv', num_dialogues_to_use=1, output_csv_file=str(tmp_path/f'{name}.csv'),
+        receiver_lm_name='gpt-3.5-turbo-1106', training_memory_path=str(tmp_path/'memory.csv'),
+        memory_bundle_dir=str(tmp_path/f'{name}.bundle'), encoder_name='length', embedding_cache_dir=None,
+        retrieval_batch_size=256, rerank_batch_size=32, stage_workers=None, pipeline_queue_size=64,
+        reranker='gpt', cross_encoder_name=None, hybrid_margin=1.0, concurrency=1,
+        max_requests_per_minute=None, max_tokens_per_minute=None, llm_cache_path=None, llm_cache_max_mb=1024,
+        max_retry_time=600, batch_dir=None, llm_backend='mock', llm_traffic_path=None, mock_latency=0.0,
+        tom_mode='multi_turn', tom_store_path=None, min_action_length=35, max_prev_turns=4,
+        journal_path=None, resume=False
+    )
+    args.update(kwargs)
+    return Namespace(**args)
+
+
+@pytest.fixture
+def offline_inference(tmp_path, monkeypatch, llm_globals):
+    monkeypatch.setattr(inference, 'build_sentence_encoder', lambda name, cache_dir=None: LengthEncoder())
+    pd.DataFrame({
+        'rule': [f'rule {i}' for i in range(5)],
+        'client tom': ['hesitant '*i for i in range(1, 6)]
+    }).to_csv(tmp_path/'memory.csv')
+
+
+@pytest.mark.parametrize('reranker', ['gpt', 'hybrid'])
+def test_batch_rounds_match_an_online_run(tmp_path, offline_inference, monkeypatch, reranker):
+    monkeypatch.setattr(sentence_transformers, 'CrossEncoder', TiedCrossEncoder)
+    rerankers = []
+    build_reranker = inference.build_reranker
+    def build_and_keep_reranker(*args, **kwargs):
+        rerankers.append(build_reranker(*args, **kwargs))
+        return rerankers[-1]
+    monkeypatch.setattr(inference, 'build_reranker', build_and_keep_reranker)
+
+    batch_dir = str(tmp_path/'batch')
+    args = inference_args(tmp_path, 'batch', batch_dir=batch_dir, reranker=reranker)
+    for round_id in range(20):
+        inference.main(args)
+        if os.path.exists(args.output_csv_file):
+            break
+        assert num_batch_rounds(batch_dir) == round_id+1
+        requests_path = os.path.join(batch_dir, f'requests_{round_id:03d}.jsonl')
+        answer_batch(requests_path, os.path.join(batch_dir, f'results_{round_id:03d}.jsonl'))
+    assert os.path.exists(args.output_csv_file), 'batch run did not finish'
+    # client tom (2 requests), rerank and respond (2 requests) are one round each,
+    # the last run had nothing left to export
+    assert num_batch_rounds(batch_dir) == 5
+    assert len(glob.glob(os.path.join(batch_dir, 'results_*.jsonl'))) == 5
+
+    inference.main(inference_args(tmp_path, 'online', reranker=reranker))
+    if reranker == 'hybrid':
+        # every state was escalated, in the batch run as its own round of llm requests
+        assert rerankers[-1].escalation_rate() == 1
+    batch = pd.read_csv(args.output_csv_file, index_col=0)
+    online = pd.read_csv(str(tmp_path/'online.csv'), index_col=0)
+    assert len(batch) == len(online) == 22
+    columns = ['transcript id', 'turn index', 'client tom', 'retrieved_rule', 'receiver response', 'cost']
+    pd.testing.assert_frame_equal(batch[columns], online[columns])
+
+
+def test_first_batch_round_does_not_overwrite_a_journal(tmp_path, offline_inference):
+    inference.main(inference_args(tmp_path, 'run'))
+    with pytest.raises(FileExistsError):
+        inference.main(inference_args(tmp_path, 'run', batch_dir=str(tmp_path/'batch')))
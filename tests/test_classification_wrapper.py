@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from utils.classification_wrapper import ClassificationWrapper, default_onnx_dir
+
+
+@pytest.fixture(scope='module')
+def classifier(tiny_classifier_dir):
+    return ClassificationWrapper(tiny_classifier_dir, device='cpu')
+
+
+def test_empty_input(classifier):
+    assert classifier([], disable_tqdm=True) == []
+    assert classifier([], return_type='class proba', disable_tqdm=True) == []
+
+
+def test_single_sentence(classifier):
+    output = classifier('great job !', disable_tqdm=True)
+    assert output['input'] == 'great job !'
+    assert output['predicted'] in classifier.label_encoder.classes_
+
+
+def test_batching_keeps_order_and_predictions(classifier):
+    sentences = ['what would help you ?', 'great job !', 'i am here for you .', 'you can do it', 'great job !']
+    one_by_one = [classifier(s, return_type='class proba', disable_tqdm=True) for s in sentences]
+    batched = classifier(sentences, return_type='class proba', batch_size=2, max_batch_tokens=16, disable_tqdm=True)
+    assert [o['input'] for o in batched] == sentences
+    for a, b in zip(one_by_one, batched):
+        assert a['predicted'].keys() == b['predicted'].keys()
+        for label in classifier.label_encoder.classes_:
+            assert a['predicted'][label] == pytest.approx(b['predicted'][label], abs=1e-5)
+
+
+def test_default_onnx_dir_is_a_writable_cache(tiny_classifier_dir, tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path/'cache'))
+    hub_dir = default_onnx_dir('mental/mental-bert-base-uncased')
+    local_dir = default_onnx_dir(tiny_classifier_dir)
+    assert hub_dir.startswith(str(tmp_path/'cache'))
+    assert local_dir.startswith(str(tmp_path/'cache'))
+    assert not local_dir.startswith(tiny_classifier_dir)
+    assert hub_dir != local_dir
+    assert default_onnx_dir(tiny_classifier_dir) == local_dir
+
+
+def test_onnx_backend_agrees_with_torch(tiny_classifier_dir, classifier, tmp_path, monkeypatch):
+    pytest.importorskip('onnxruntime')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path/'cache'))
+    onnx_classifier = ClassificationWrapper(tiny_classifier_dir, backend='onnx')
+    assert os.path.exists(os.path.join(default_onnx_dir(tiny_classifier_dir), 'model.onnx'))
+    sentences = ['what would help you ?', 'great job !']
+    assert [o['predicted'] for o in onnx_classifier(sentences, disable_tqdm=True)] == \
+        [o['predicted'] for o in classifier(sentences, disable_tqdm=True)]
@@ -0,0 +1,110 @@
+import re
+import threading
+import time
+
+import nltk
+import pytest
+
+import train_agent
+from utils.cost_budget import CostBudget
+from utils.llm_backends import MockBackend
+from utils.llm_cache import LLMResponseCache
+from utils import openai_dialogue
+from utils.openai_dialogue import BilledCostMeter, OpenaiSequencialDialogue, count_tokens, set_llm_backend, set_llm_cache
+
+
+STATE = 'Topic: smoking cessation\n[client]: I have been thinking about quitting.\n[therapist]: That is great.\n[client]: Yeah, maybe after the holidays.'
+GOLD_ACTION = '[therapist]: What would make it easier to start? You have done hard things before.'
+
+
+def test_reserve_first_prefers_the_first_amount_that_can_fit():
+    budget = CostBudget(max_cost=10)
+    assert budget.reserve_first([4, 1]) == 0
+    budget.settle(4, 9)
+    # 4 can never fit anymore, 1 still can
+    assert budget.reserve_first([4, 1]) == 1
+    budget.settle(1, 1)
+    assert budget.reserve_first([4, 1]) is None
+    assert budget.stats()['rejected reservations'] == 1
+
+
+def test_reserve_first_waits_for_outstanding_reservations():
+    budget = CostBudget(max_cost=10)
+    assert budget.reserve_first([8]) == 0
+    settled = threading.Timer(0.1, budget.settle, (8, 2))
+    settled.start()
+    started = time.monotonic()
+    # fits once the first reservation settles below its estimate
+    assert budget.reserve_first([8, 1]) == 0
+    assert time.monotonic()-started >= 0.05
+    assert budget.projected() == 10
+
+
+def test_no_cap():
+    budget = CostBudget()
+    assert budget.reserve_first([1e9]) == 0
+
+
+def test_billed_cost_meter_skips_cached_responses(tmp_path, llm_globals):
+    set_llm_backend(MockBackend(replies=['hello there'], completion_tokens=10))
+    set_llm_cache(LLMResponseCache(str(tmp_path/'cache.sqlite')))
+    with BilledCostMeter() as first:
+        dialogue = OpenaiSequencialDialogue(model='gpt-3.5-turbo-1106')
+        dialogue.send_user_message('hi')
+    with BilledCostMeter() as second:
+        dialogue = OpenaiSequencialDialogue(model='gpt-3.5-turbo-1106')
+        dialogue.send_user_message('hi')
+    assert first.total > 0
+    assert second.total == 0
+    assert dialogue.cost()['total'] == first.total
+    assert dialogue.cost()['billed'] == 0
+
+
+class WorstCaseBackend(MockBackend):
+
+    """
+    every reply as long as max_tokens allows, prompt tokens counted like the estimate counts them
+    (count_tokens, exact with tiktoken, utf-8 bytes without) plus chat overhead
+    """
+
+    def _response(self, request_kwargs):
+        response = super()._response(request_kwargs)
+        messages = request_kwargs['messages']
+        response['usage']['prompt_tokens'] = sum([
+            count_tokens(m['content'] or '', request_kwargs['model'])+train_agent.MESSAGE_TOKENS for m in messages
+        ])+train_agent.REPLY_PRIMING_TOKENS
+        response['usage']['completion_tokens'] = request_kwargs['max_tokens']
+        return response
+
+
+class FakeClassifier:
+
+    def annotate_dialogue_turn(self, context, turn):
+        sentences = nltk.sent_tokenize(turn)
+        return sentences, ['Question']*len(sentences), 0
+
+
+class WordEncoding:
+
+    """
+    stands in for a tiktoken encoding: one token per word or punctuation mark
+    """
+
+    def encode(self, text):
+        return re.findall(r'\w+|[^\w\s]', text)
+
+
+@pytest.mark.parametrize('tokenizer', ['utf-8 bytes', 'tiktoken'])
+@pytest.mark.parametrize('tom_mode', ['single', 'multi_turn'])
+def test_estimate_is_an_upper_bound(tom_mode, tokenizer, llm_globals, monkeypatch):
+    encoding = WordEncoding() if tokenizer == 'tiktoken' else None
+    monkeypatch.setattr(openai_dialogue, '_tiktoken_encoding', lambda model: encoding)
+    # no punkt data needed
+    monkeypatch.setattr(nltk, 'sent_tokenize', lambda text: [s+'?' for s in text.split('?') if s.strip()])
+    # never aligned and never valid json: every loop and every fallback is taken
+    set_llm_backend(WorstCaseBackend(replies=['no, [therapist]: ok']))
+    with BilledCostMeter() as billed:
+        result = train_agent.play_state(STATE, GOLD_ACTION, FakeClassifier(), verbose=False, max_align_loop=3, tom_mode=tom_mode)
+    assert result['num alignment loop'] == 3
+    estimate = train_agent.estimate_play_state_cost(STATE, GOLD_ACTION, max_align_loop=3, tom_mode=tom_mode)
+    assert billed.total <= estimate
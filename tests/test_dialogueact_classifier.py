@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from utils.dialogueact_classifier import calibrate_escalation_thresholds, canonical_label, parse_label_list
+
+
+def test_calibration_needs_sentences():
+    with pytest.raises(ValueError):
+        calibrate_escalation_thresholds([], [])
+
+
+def test_calibration_threshold_keeps_agreement():
+    probas = [
+        {'Question': 0.9, 'Affirm': 0.1},
+        {'Question': 0.8, 'Affirm': 0.2},
+        {'Affirm': 0.6, 'Question': 0.4},
+        {'Question': 0.55, 'Affirm': 0.45}
+    ]
+    reference_labels = ['Question', 'Question', 'Affirm', 'Affirm']
+    config = calibrate_escalation_thresholds(probas, reference_labels, target_agreement=1.0, min_support=10)
+    assert config['threshold'] == 0.6
+    assert config['label_thresholds'] == dict()
+    assert config['escalation rate'] == 0.25
+    assert config['agreement'] == 1.0
+
+
+@pytest.mark.parametrize('reply', [
+    '["Question", "Advise with Permission"]',
+    "['question', 'advise with permission']",
+    'Sure! ["Question", "Advise with Permission"] hope this helps',
+    '1. Question\n2) Advise with Permission',
+    'Labels: [Question] and [Advise with Permission]'
+])
+def test_parse_label_list_formats(reply):
+    assert parse_label_list(reply, 2) == ['Question', 'Advise with Permission']
+
+
+@pytest.mark.parametrize('reply', ['["Question"]', '["Question", "Banana"]', 'Question, Affirm', ''])
+def test_parse_label_list_needs_exactly_the_right_labels(reply):
+    assert parse_label_list(reply, 2) is None
+
+
+def test_canonical_label():
+    assert canonical_label(' [Simple Reflection]. ') == 'Simple Reflection'
+    # the longest label contained wins
+    assert canonical_label('probably Advise with permission') == 'Advise with Permission'
+    assert canonical_label('Advise') == 'Advise'
+    assert canonical_label('banana') is None
+
+
+@pytest.fixture
+def tiny_dialogue_act_classifier(tiny_classifier_dir, monkeypatch, llm_globals):
+    """
+    DialogueActClassifier on the tiny bert, a mock llm, and nltk's sentence splitter without its punkt data
+    """
+    import nltk
+    from utils import dialogueact_classifier
+    from utils.llm_backends import MockBackend
+    from utils.openai_dialogue import set_llm_backend
+    monkeypatch.setattr(dialogueact_classifier, 'annomi_classifier_path', tiny_classifier_dir)
+    monkeypatch.setattr(nltk, 'sent_tokenize', lambda text: [s.strip()+'.' for s in text.split('.') if s.strip()])
+    backend = MockBackend()
+    set_llm_backend(backend)
+    return backend
+
+
+def test_bulk_annotation_returns_the_classifier_probas(tiny_dialogue_act_classifier):
+    from utils.dialogueact_classifier import DialogueActClassifier
+    # never escalates, labels are the classifier's
+    classifier = DialogueActClassifier(escalation_threshold=0)
+    contexts_and_turns = [('context', 'great job. you can do it.'), ('context', 'what would help you.')]
+    annotated = classifier.annotate_dialogue_turns(contexts_and_turns, with_probas=True)
+    assert [len(a) for a in annotated] == [4, 4]
+    probas = classifier.get_label_probas_batch(['great job.', 'you can do it.', 'what would help you.'])
+    assert annotated[0][3]+annotated[1][3] == pytest.approx(probas)
+    assert annotated[0][1] == [max(p, key=p.get) for p in probas[:2]]
+    assert tiny_dialogue_act_classifier.num_requests == 0
+    assert classifier.annotate_dialogue_turns(contexts_and_turns) == [a[:3] for a in annotated]
+
+
+def test_calibration_classifies_every_sentence_once(tiny_dialogue_act_classifier, tmp_path, monkeypatch):
+    from argparse import Namespace
+    import calibrate_escalation
+    from utils.dialogueact_classifier import DialogueActClassifier
+
+    classifier_calls = []
+    class CountingClassifier(DialogueActClassifier):
+        def get_label_probas_batch(self, sentences):
+            classifier_calls.append(len(sentences))
+            return super().get_label_probas_batch(sentences)
+    monkeypatch.setattr(calibrate_escalation, 'DialogueActClassifier', CountingClassifier)
+
+    output_json = str(tmp_path/'escalation_config.json')
+    calibrate_escalation.main(Namespace(
+        data_path='AnnoMI/train.csv', index_dir='AnnoMI/random_order_high_quality_dialogue_ids.csv',
+        num_dialogues_to_use=1, begin_dialogue_position=28, target_agreement=0.95, min_support=20,
+        classifier_backend='torch', output_json=output_json
+    ))
+    assert len(classifier_calls) == 1
+    # every sentence was sent to the llm for its reference label
+    assert tiny_dialogue_act_classifier.num_requests == classifier_calls[0]
+    assert os.path.exists(output_json)
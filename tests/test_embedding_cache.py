@@ -0,0 +1,119 @@
+import hashlib
+import itertools
+
+import numpy as np
+import pytest
+
+from utils import embedding_cache
+from utils.embedding_cache import CachedSentenceEncoder
+
+
+class FakeEncoder:
+
+    """
+    deterministic pseudo-random embedding per text, remembers what it was asked to encode
+    """
+
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        self.encoded += list(texts)
+        return np.stack([
+            np.random.default_rng(int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)).normal(size=self.dim)
+            for text in texts
+        ]).astype(np.float32)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # strictly increasing access times, LRU order does not depend on timer resolution
+    ticks = itertools.count()
+    monkeypatch.setattr(embedding_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def open_cache(tmp_path, encoder, max_entries=100):
+    loads = []
+    def load_encoder():
+        loads.append(1)
+        return encoder
+    cache = CachedSentenceEncoder('org/model', str(tmp_path), load_encoder, max_entries=max_entries)
+    return cache, loads
+
+
+def test_only_missing_texts_are_encoded(tmp_path):
+    encoder = FakeEncoder()
+    cache, _ = open_cache(tmp_path, encoder)
+    first = cache.encode(['a', 'b', 'a'])
+    np.testing.assert_array_equal(first, FakeEncoder().encode(['a', 'b', 'a']))
+    assert encoder.encoded == ['a', 'b']
+
+    second = cache.encode(['b', 'c', 'a', 'c'])
+    np.testing.assert_array_equal(second, FakeEncoder().encode(['b', 'c', 'a', 'c']))
+    assert encoder.encoded == ['a', 'b', 'c']
+
+    single = cache.encode('c', normalize_embeddings=True)
+    assert single.shape == (8,) and single == pytest.approx(second[1]/np.linalg.norm(second[1]))
+    # hits and misses both in texts
+    assert cache.stats() == {'hits': 0+2+1, 'misses': 3+2, 'entries': 3, 'max entries': 100}
+
+
+def test_reopening_reuses_the_cache_without_loading_the_model(tmp_path):
+    cache, loads = open_cache(tmp_path, FakeEncoder())
+    embeddings = cache.encode(['a', 'b'])
+    cache.close()
+
+    encoder = FakeEncoder()
+    reopened, loads = open_cache(tmp_path, encoder)
+    assert reopened.get_sentence_embedding_dimension() == 8
+    np.testing.assert_array_equal(reopened.encode(['b', 'a']), embeddings[::-1])
+    assert loads == [] and encoder.encoded == []
+    # new entries go after the existing ones
+    reopened.encode(['c'])
+    assert loads == [1] and reopened.next_slot == 3
+    assert reopened.stats()['entries'] == 3
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    encoder = FakeEncoder()
+    cache, _ = open_cache(tmp_path, encoder, max_entries=3)
+    cache.encode(['a'])
+    cache.encode(['b'])
+    cache.encode(['c'])
+    cache.encode(['a'])
+    # full: d takes the slot of b, the least recently used
+    slots_before = dict(cache.conn.execute('SELECT key, slot FROM entries').fetchall())
+    d = cache.encode(['d'])
+    slots_after = dict(cache.conn.execute('SELECT key, slot FROM entries').fetchall())
+    assert set(slots_after) == {embedding_cache.text_key(t) for t in 'acd'}
+    assert slots_after[embedding_cache.text_key('d')] == slots_before[embedding_cache.text_key('b')]
+    assert cache.next_slot == 3
+    np.testing.assert_array_equal(cache.embeddings[slots_after[embedding_cache.text_key('d')]], d[0])
+
+    encoder.encoded = []
+    cache.encode(['a', 'c', 'd'])
+    assert encoder.encoded == []
+    cache.encode(['b'])
+    assert encoder.encoded == ['b']
+
+
+def test_a_batch_does_not_evict_its_own_hits(tmp_path, clock):
+    encoder = FakeEncoder()
+    cache, _ = open_cache(tmp_path, encoder, max_entries=3)
+    cache.encode(['a', 'b', 'c'])
+    embeddings = cache.encode(['a', 'd', 'e'])
+    np.testing.assert_array_equal(embeddings, FakeEncoder().encode(['a', 'd', 'e']))
+    keys = {key for key, in cache.conn.execute('SELECT key FROM entries').fetchall()}
+    assert embedding_cache.text_key('a') in keys and len(keys) == 3
+
+
+def test_a_batch_larger_than_the_cache(tmp_path):
+    cache, _ = open_cache(tmp_path, FakeEncoder(), max_entries=3)
+    texts = [f'text {i}' for i in range(5)]
+    np.testing.assert_array_equal(cache.encode(texts), FakeEncoder().encode(texts))
+    keys = {key for key, in cache.conn.execute('SELECT key FROM entries').fetchall()}
+    assert keys == {embedding_cache.text_key(t) for t in texts[-3:]}
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# only imported once a component that needs them is built
+HEAVY_MODULES = ['torch', 'transformers', 'joblib', 'nltk', 'sentence_transformers', 'onnxruntime', 'hnswlib']
+
+# train_agent builds the dialogue act classifier in main(), not at import
+ENTRY_POINTS = ['utils', 'tom_detector', 'inference', 'inference_server', 'train_agent']
+SCRIPTS = ['train_agent.py', 'inference.py', 'inference_server.py']
+
+# the timings are printed for information only, they depend on the machine
+IMPORT_CODE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter()-start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+HELP_CODE = """
+import sys, time, json, runpy
+sys.argv = [{script!r}, '--help']
+start = time.perf_counter()
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+seconds = time.perf_counter()-start
+print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {forbidden!r} if m in sys.modules]}}))
+"""
+
+
+def check(code):
+    """
+    seconds taken and forbidden modules loaded, measured in a fresh interpreter
+    """
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=ROOT).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize('module', ENTRY_POINTS)
+def test_import_is_light(module):
+    result = check(IMPORT_CODE.format(module=module, forbidden=HEAVY_MODULES))
+    print(f'import {module}: {result["seconds"]:.2f}s')
+    assert result['loaded'] == [], f'import {module} loads {result["loaded"]}'
+
+
+@pytest.mark.parametrize('script', SCRIPTS)
+def test_help_is_light(script):
+    result = check(HELP_CODE.format(script=script, forbidden=HEAVY_MODULES))
+    print(f'{script} --help: {result["seconds"]:.2f}s')
+    assert result['loaded'] == [], f'{script} --help loads {result["loaded"]}'
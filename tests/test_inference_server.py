@@ -0,0 +1,107 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from inference_server import InferenceService, build_inference_server
+from utils.llm_backends import MockBackend
+from utils.memory_bundle import MemoryBundle
+from utils.openai_dialogue import set_llm_backend
+from utils.rerankers import GPTReranker
+
+
+CONTEXT = 'Topic: smoking cessation\n[client]: Yeah, I-I think that would be very helpful.'
+
+
+class LengthEncoder:
+
+    """
+    tiny deterministic sentence encoder
+    """
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False):
+        embeddings = np.array([[len(text), 1+text.count(' ')] for text in texts], dtype=np.float32)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+@pytest.fixture
+def server(tmp_path, llm_globals):
+    set_llm_backend(MockBackend())
+    memory = pd.DataFrame({
+        'rule': [f'rule {i}' for i in range(5)],
+        'client tom': ['hesitant '*i for i in range(1, 6)]
+    })
+    bundle = MemoryBundle.create(str(tmp_path/'bundle'), memory, LengthEncoder(), 'length')
+    service = InferenceService(bundle, LengthEncoder(), GPTReranker(), max_concurrency=2, queue_timeout=0.1)
+    server = build_inference_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, service
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def call(server, path, body=None):
+    url = f'http://127.0.0.1:{server.server_address[1]}{path}'
+    data = None if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode('utf-8'))
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_respond(server):
+    server, service = server
+    status, output = call(server, '/respond', {'context': CONTEXT})
+    assert status == 200
+    assert output['receiver response'] and output['retrieved_rule'] in output['top rules']
+    assert len(output['top rules']) == 5
+    assert call(server, '/health') == (200, {'status': 'ok', 'num rules': 5})
+
+
+@pytest.mark.parametrize('body', [
+    b'not json',
+    b'\xff\xfe',
+    ['a list'],
+    {'no context': CONTEXT},
+    {'context': '   '},
+    {'context': 5},
+    {'context': CONTEXT, 'receiver_lm_name': 5}
+])
+def test_malformed_requests_are_rejected(server, body):
+    server, service = server
+    status, output = call(server, '/respond', body)
+    assert status == 400 and 'error' in output
+    assert service.num_bad_requests == 1
+
+
+def test_metrics_count_every_request(server):
+    server, service = server
+    call(server, '/respond', {'context': CONTEXT})
+    call(server, '/respond', {'context': 5})
+    # a model without pricing fails inside respond
+    assert call(server, '/respond', {'context': CONTEXT, 'receiver_lm_name': 'unknown-model'})[0] == 500
+    # every slot taken: rejected once queue_timeout runs out
+    for _ in range(2):
+        service.slots.acquire()
+    assert call(server, '/respond', {'context': CONTEXT})[0] == 503
+    for _ in range(2):
+        service.slots.release()
+
+    status, metrics = call(server, '/metrics')
+    assert status == 200
+    assert metrics['requests'] == 4
+    assert (metrics['succeeded'], metrics['errors'], metrics['rejected'], metrics['bad requests']) == (1, 1, 1, 1)
+    assert metrics['in flight'] == 0 and metrics['total cost'] > 0
+    assert call(server, '/nowhere')[0] == 404
@@ -0,0 +1,77 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from utils.journal import ResultJournal, state_action_id
+
+
+def test_state_action_id_is_stable_and_content_addressed():
+    assert state_action_id(3, 5, 'state', 'action') == state_action_id(3, 5, 'state', 'action')
+    assert state_action_id(3, 5, 'state', 'action').startswith('3:5:')
+    # same position, different context window
+    assert state_action_id(3, 5, 'longer state', 'action') != state_action_id(3, 5, 'state', 'action')
+
+
+def test_resume_keeps_finished_results(tmp_path):
+    path = str(tmp_path/'run.journal.jsonl')
+    journal = ResultJournal(path)
+    journal.append('a', {'cost': 1})
+    journal.append('b', {'cost': 2, 'transcript id': np.int64(7)})
+
+    resumed = ResultJournal(path, resume=True)
+    assert len(resumed) == 2 and 'a' in resumed and 'c' not in resumed
+    assert resumed.results['b'] == {'cost': 2, 'transcript id': 7}
+
+
+def test_resume_does_not_touch_a_clean_journal(tmp_path):
+    path = str(tmp_path/'run.journal.jsonl')
+    journal = ResultJournal(path)
+    journal.append('a', {'cost': 1})
+    with open(path) as ifp:
+        before = ifp.read()
+    ResultJournal(path, resume=True)
+    ResultJournal(path, resume=True)
+    with open(path) as ifp:
+        assert ifp.read() == before
+
+
+def test_resume_after_a_line_cut_short(tmp_path):
+    path = str(tmp_path/'run.journal.jsonl')
+    journal = ResultJournal(path)
+    journal.append('a', {'cost': 1})
+    with open(path, 'a') as ofp:
+        ofp.write(json.dumps({'id': 'b', 'result': {'cost': 2}})[:-5])
+
+    resumed = ResultJournal(path, resume=True)
+    assert 'a' in resumed and 'b' not in resumed
+    resumed.append('b', {'cost': 2})
+    assert set(ResultJournal(path, resume=True).results) == {'a', 'b'}
+
+
+def test_without_resume_finished_results_are_not_overwritten(tmp_path):
+    path = str(tmp_path/'run.journal.jsonl')
+    ResultJournal(path).append('a', {'cost': 1})
+    with pytest.raises(FileExistsError, match='--resume'):
+        ResultJournal(path)
+    assert 'a' in ResultJournal(path, resume=True)
+
+
+def test_without_resume_an_empty_journal_starts_over(tmp_path):
+    path = str(tmp_path/'run.journal.jsonl')
+    open(path, 'w').close()
+    journal = ResultJournal(path)
+    assert len(journal) == 0 and not os.path.exists(path)
+    journal.append('a', {'cost': 1})
+    assert len(ResultJournal(path, resume=True)) == 1
+
+
+def test_compact_follows_the_given_order(tmp_path):
+    journal = ResultJournal(str(tmp_path/'run.journal.jsonl'))
+    # completion order differs from the order of the data
+    for result_id in ['c', 'a', 'b']:
+        journal.append(result_id, {'id': result_id})
+    assert [r['id'] for r in journal.compact(['a', 'b', 'c', 'd'])] == ['a', 'b', 'c']
+    assert [r['id'] for r in journal.compact(['b', 'a'])] == ['b', 'a']
+
@@ -0,0 +1,52 @@
+import pytest
+
+import tom_detector
+from utils.dialogueact_classifier import CLASSIFY_TURN_ACTIONS_PROMPT, parse_label_list
+from utils.llm_backends import MockBackend, RecordReplayBackend
+from utils.openai_dialogue import OpenaiSequencialDialogue, set_llm_backend
+
+
+STATE = 'Topic: smoking cessation\n[client]: Yeah, I-I think that would be very helpful.'
+GOLD_ACTION = '[therapist]: Glad you think that is helpful!'
+
+
+@pytest.fixture
+def mock_backend(llm_globals):
+    backend = MockBackend()
+    set_llm_backend(backend)
+    return backend
+
+
+def test_mock_tom_reply_is_valid_in_single_request_mode(mock_backend):
+    toms, _ = tom_detector.determine_toms_single_request(STATE, GOLD_ACTION)
+    assert toms is not None
+    assert set(toms) == {'client_stage', 'client_mental_state', 'therapist_behavior', 'contextual_instruction'}
+    client_toms, _ = tom_detector.determine_toms_single_request(STATE)
+    assert set(client_toms) == {'client_stage', 'client_mental_state'}
+
+
+def test_mock_takes_the_single_request_path(mock_backend):
+    tom_detector.determine_toms(STATE, GOLD_ACTION, mode='single')
+    tom_detector.determine_toms_inference_mode(STATE, mode='single')
+    # no multi-turn fallback
+    assert mock_backend.num_requests == 2
+
+
+def test_mock_turn_labels_parse(mock_backend):
+    prompt = CLASSIFY_TURN_ACTIONS_PROMPT.replace('@num_sentences@', '3')
+    reply = OpenaiSequencialDialogue().send_user_message(prompt)
+    assert parse_label_list(reply, 3) == ['Question']*3
+
+
+def test_mock_default_reply_elsewhere(mock_backend):
+    assert OpenaiSequencialDialogue().send_user_message('Which rule applies the best?') == "{'prediction': '1'}"
+
+
+def test_record_then_replay(tmp_path):
+    path = str(tmp_path/'traffic.jsonl')
+    request = {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': 'hi'}], 'max_tokens': 5, 'stop': None}
+    recorded = RecordReplayBackend(path, mode='record', backend=MockBackend(replies=['hello'])).complete(request)
+    replayed = RecordReplayBackend(path, mode='replay').complete(request)
+    assert replayed == recorded
+    with pytest.raises(KeyError):
+        RecordReplayBackend(path, mode='replay').complete(dict(request, max_tokens=6))
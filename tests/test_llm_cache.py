@@ -0,0 +1,77 @@
+import itertools
+import json
+
+import pytest
+
+from utils import llm_cache
+from utils.llm_backends import MockBackend
+from utils.llm_cache import LLMResponseCache, request_key
+from utils.openai_dialogue import OpenaiSequencialDialogue, set_llm_backend, set_llm_cache
+
+
+def request(content, **kwargs):
+    return dict({
+        'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': content}],
+        'max_tokens': 16, 'temperature': 0.0, 'stop': None
+    }, **kwargs)
+
+
+def response(text):
+    return {'choices': [{'message': {'role': 'assistant', 'content': text}}], 'usage': {'prompt_tokens': 1, 'completion_tokens': 1}}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # strictly increasing access times, LRU order does not depend on timer resolution
+    ticks = itertools.count()
+    monkeypatch.setattr(llm_cache.time, 'time', lambda: float(next(ticks)))
+
+
+def test_request_key_covers_what_changes_the_reply():
+    assert request_key(request('hi')) == request_key(request('hi', temperature=0.0, extra='ignored'))
+    assert request_key(request('hi')) != request_key(request('hello'))
+    assert request_key(request('hi')) != request_key(request('hi', max_tokens=17))
+    assert request_key(request('hi')) != request_key(request('hi', stop=['\n']))
+    assert request_key(request('hi')) != request_key(request('hi', model='gpt-4'))
+
+
+def test_only_deterministic_requests_are_cacheable():
+    assert LLMResponseCache.cacheable(request('hi'))
+    assert not LLMResponseCache.cacheable(request('hi', temperature=0.7))
+
+
+def test_hit_miss_and_persistence(tmp_path):
+    path = str(tmp_path/'cache.sqlite')
+    cache = LLMResponseCache(path)
+    assert cache.get(request('hi')) is None
+    cache.put(request('hi'), response('hello'))
+    assert cache.get(request('hi')) == response('hello')
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+    cache = LLMResponseCache(path)
+    assert cache.get(request('hi')) == response('hello')
+    cache.close()
+
+
+def test_evicts_least_recently_used_first(tmp_path, clock):
+    entry_size = len(json.dumps(response('a')))
+    cache = LLMResponseCache(str(tmp_path/'cache.sqlite'), max_size_bytes=2*entry_size)
+    cache.put(request('a'), response('a'))
+    cache.put(request('b'), response('b'))
+    # a is now more recently used than b
+    assert cache.get(request('a')) is not None
+    cache.put(request('c'), response('c'))
+    assert cache.get(request('b')) is None
+    assert cache.get(request('a')) is not None
+    assert cache.get(request('c')) is not None
+    assert cache.stats()['entries'] == 2
+    cache.close()
+
+
+def test_dialogues_reuse_cached_responses(tmp_path, llm_globals):
+    backend = MockBackend(replies=['hello'])
+    set_llm_backend(backend)
+    set_llm_cache(LLMResponseCache(str(tmp_path/'cache.sqlite')))
+    for _ in range(3):
+        assert OpenaiSequencialDialogue().send_user_message('hi') == 'hello'
+    assert backend.num_requests == 1
@@ -0,0 +1,161 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.memory_bundle import MemoryBundle, sync_memory_bundle
+
+
+class FakeEncoder:
+
+    """
+    deterministic pseudo-random embedding per text, remembers what it was asked to encode
+    """
+
+    def __init__(self, dim=16):
+        self.dim = dim
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False):
+        self.encoded += list(texts)
+        embeddings = np.stack([
+            np.random.default_rng(int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)).normal(size=self.dim)
+            for text in texts
+        ])
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+
+def memory_frame(start, stop):
+    return pd.DataFrame({
+        'rule': [f'rule {i}' for i in range(start, stop)],
+        'client tom': [f'client tom {i}' for i in range(start, stop)],
+        'cost': [0.1]*(stop-start),
+        'transcript id': np.arange(start, stop)
+    })
+
+
+def brute_force(bundle, queries, k):
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    scores = queries @ np.asarray(bundle.embeddings).T
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k], -np.sort(-scores, axis=1)[:, :k]
+
+
+def test_search_matches_brute_force(tmp_path):
+    encoder = FakeEncoder()
+    bundle = MemoryBundle.create(str(tmp_path/'bundle'), memory_frame(0, 50), encoder, 'fake')
+    queries = encoder.encode([f'query {i}' for i in range(5)])
+
+    indices, scores = bundle.search(queries, k=7)
+    expected_indices, expected_scores = brute_force(bundle, queries, 7)
+    assert indices.shape == scores.shape == (5, 7)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+    # one query, unnormalized, gives the same as its row of the batch
+    index, score = bundle.search(3*queries[2], k=7)
+    assert index.shape == (7,)
+    np.testing.assert_array_equal(index, indices[2])
+    np.testing.assert_allclose(score, scores[2], rtol=1e-5)
+
+    # an exact match of a stored client tom comes first
+    index, score = bundle.search(encoder.encode(['client tom 17'])[0], k=3)
+    assert index[0] == 17 and abs(score[0]-1) < 1e-5
+
+
+def test_search_with_k_past_the_memory_size(tmp_path):
+    encoder = FakeEncoder()
+    bundle = MemoryBundle.create(str(tmp_path/'bundle'), memory_frame(0, 4), encoder, 'fake')
+    queries = encoder.encode(['query'])
+    indices, scores = bundle.search(queries, k=10)
+    assert indices.shape == (1, 4) and sorted(indices[0]) == [0, 1, 2, 3]
+    assert np.all(np.diff(scores, axis=1) <= 0)
+
+
+def test_append_and_reload(tmp_path):
+    path = str(tmp_path/'bundle')
+    encoder = FakeEncoder()
+    bundle = MemoryBundle.create(path, memory_frame(0, 10), encoder, 'fake')
+    bundle.append(memory_frame(10, 15), encoder)
+    assert encoder.encoded == [f'client tom {i}' for i in range(15)]
+
+    reloaded = MemoryBundle(path)
+    assert len(reloaded) == 15
+    assert reloaded.rules == [f'rule {i}' for i in range(15)]
+    assert reloaded.rows[12]['transcript id'] == 12
+    np.testing.assert_array_equal(np.asarray(reloaded.embeddings), np.asarray(bundle.embeddings))
+    queries = encoder.encode(['query a', 'query b'])
+    np.testing.assert_array_equal(reloaded.search(queries, k=5)[0], bundle.search(queries, k=5)[0])
+
+
+def test_interrupted_append_is_ignored_and_overwritten(tmp_path):
+    path = str(tmp_path/'bundle')
+    encoder = FakeEncoder()
+    bundle = MemoryBundle.create(path, memory_frame(0, 10), encoder, 'fake')
+    embeddings = np.asarray(bundle.embeddings).copy()
+    # a crash after writing (part of) the data but before meta.json
+    with open(os.path.join(path, 'embeddings.f32'), 'ab') as ofp:
+        ofp.write(b'\x00'*30)
+    with open(os.path.join(path, 'rows.jsonl'), 'ab') as ofp:
+        ofp.write(b'{"rule": "half writ')
+
+    reloaded = MemoryBundle(path)
+    assert len(reloaded) == 10 and reloaded.rules[-1] == 'rule 9'
+    np.testing.assert_array_equal(np.asarray(reloaded.embeddings), embeddings)
+
+    reloaded.append(memory_frame(10, 12), encoder)
+    assert os.path.getsize(os.path.join(path, 'embeddings.f32')) == 12*encoder.dim*4
+    again = MemoryBundle(path)
+    assert again.rules == [f'rule {i}' for i in range(12)]
+    np.testing.assert_array_equal(np.asarray(again.embeddings)[:10], embeddings)
+
+
+def test_sync_appends_new_rows_and_rebuilds_changed_ones(tmp_path):
+    path = str(tmp_path/'bundle')
+    encoder = FakeEncoder()
+    sync_memory_bundle(path, memory_frame(0, 10), encoder, 'fake')
+    assert len(encoder.encoded) == 10
+
+    # unchanged, nothing encoded
+    bundle = sync_memory_bundle(path, memory_frame(0, 10), encoder, 'fake')
+    assert len(bundle) == 10 and len(encoder.encoded) == 10
+
+    # the memory gained rows, only those are encoded
+    bundle = sync_memory_bundle(path, memory_frame(0, 13), encoder, 'fake')
+    assert len(bundle) == 13 and encoder.encoded[10:] == ['client tom 10', 'client tom 11', 'client tom 12']
+
+    # an earlier rule changed, rebuilt from scratch
+    changed = memory_frame(0, 13)
+    changed.loc[2, 'rule'] = 'rewritten rule'
+    encoder.encoded = []
+    bundle = sync_memory_bundle(path, changed, encoder, 'fake')
+    assert len(encoder.encoded) == 13 and bundle.rules[2] == 'rewritten rule'
+
+    # another encoder, rebuilt too
+    encoder.encoded = []
+    bundle = sync_memory_bundle(path, changed, encoder, 'other encoder')
+    assert len(encoder.encoded) == 13 and MemoryBundle(path).meta['encoder name'] == 'other encoder'
+
+    # a memory that shrank (e.g. compacted), rebuilt
+    bundle = sync_memory_bundle(path, memory_frame(0, 5), encoder, 'other encoder')
+    assert len(bundle) == 5 and len(MemoryBundle(path)) == 5
+
+
+def test_ann_index_agrees_with_exact_search(tmp_path):
+    pytest.importorskip('hnswlib')
+    encoder = FakeEncoder()
+    bundle = MemoryBundle.create(str(tmp_path/'bundle'), memory_frame(0, 40), encoder, 'fake', ann_threshold=20)
+    assert bundle.ann_index is not None
+    bundle.append(memory_frame(40, 60), encoder)
+    queries = encoder.encode([f'query {i}' for i in range(5)])
+    indices, scores = bundle.search(queries, k=5)
+    expected_indices, expected_scores = brute_force(bundle, queries, 5)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-4)
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.memory_compaction import cluster_near_duplicates, cluster_representative, compact_memory
+
+
+def unit(degrees):
+    radians = np.deg2rad(np.asarray(degrees, dtype=np.float32))
+    return np.stack([np.cos(radians), np.sin(radians)], axis=-1)
+
+
+class AngleEncoder:
+
+    """
+    every text is a unit vector at a set angle (in degrees), so cosine similarities are easy to set up
+    """
+
+    def __init__(self, angles):
+        self.angles = angles
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False):
+        return unit([self.angles[text] for text in texts])
+
+
+def test_rows_join_the_most_similar_leader_above_both_thresholds():
+    rules = unit([0, 10, 60, 12, 32])
+    toms = unit([0, 0, 0, 90, 0])
+    # cos(10) ~ 0.98, cos(12) ~ 0.98 but its client tom is orthogonal, cos(32) ~ 0.85 and cos(28) ~ 0.88 (to 60)
+    assert cluster_near_duplicates(rules, toms, 0.9, 0.9) == [[0, 1], [2], [3], [4]]
+    assert cluster_near_duplicates(rules, toms, 0.99, 0.9) == [[0], [1], [2], [3], [4]]
+    assert cluster_near_duplicates(rules, toms, 0.9, -1.0) == [[0, 1, 3], [2], [4]]
+    # 32 is similar enough to both the leaders at 0 and 60, and closer to 60
+    assert cluster_near_duplicates(rules, toms, 0.8, 0.9) == [[0, 1], [2, 4], [3]]
+    # leaders stay the first member, 20 is compared with the leader at 0 and not with the member at 10
+    assert cluster_near_duplicates(unit([0, 10, 20]), unit([0, 0, 0]), np.cos(np.deg2rad(15)), 0.9) == [[0, 1], [2]]
+
+
+def test_representative_is_the_most_central_member():
+    rules = unit([0, 50, 10, 5])
+    assert cluster_representative([0, 2, 3], rules) == 3
+    assert cluster_representative([1], rules) == 1
+
+
+@pytest.mark.parametrize('with_ids', [True, False])
+def test_compacted_memory_keeps_provenance(with_ids):
+    memory = pd.DataFrame({
+        'rule': ['ask a', 'praise', 'ask b', 'ask c'],
+        'client tom': ['hesitant', 'hesitant', 'hesitant', 'hesitant'],
+        'cost': [0.1, 0.2, 0.3, 0.4]
+    })
+    if with_ids:
+        memory['state action id'] = ['id0', 'id1', 'id2', 'id3']
+    encoder = AngleEncoder({'ask a': 0, 'ask b': 10, 'ask c': 5, 'praise': 80, 'hesitant': 0})
+    compacted = compact_memory(memory, encoder, rule_threshold=0.9, tom_threshold=0.9)
+
+    assert list(compacted['rule']) == ['ask c', 'praise']
+    assert list(compacted['cost']) == [0.4, 0.2]
+    assert list(compacted['cluster size']) == [3, 1]
+    member_ids = ['id0', 'id1', 'id2', 'id3'] if with_ids else [0, 1, 2, 3]
+    assert list(compacted['cluster members']) == [
+        [member_ids[0], member_ids[2], member_ids[3]],
+        [member_ids[1]]
+    ]
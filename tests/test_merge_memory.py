@@ -0,0 +1,120 @@
+import json
+from argparse import Namespace
+
+import pandas as pd
+
+import merge_memory
+from utils.journal import ResultJournal, shard_of, state_action_id
+
+
+def state_actions(num_sessions=4, num_turns=6):
+    return [
+        (session_id, turn_index, f'Topic: t\nclient: state {session_id} {turn_index}', f'therapist: action {turn_index}')
+        for session_id in range(num_sessions) for turn_index in range(num_turns)
+    ]
+
+
+def play_result(session_id, turn_index, state, gold_action, lm_name='gpt-3.5-turbo-1106'):
+    return {
+        'state': state,
+        'gold response': gold_action,
+        'context': state,
+        'rule': f'rule {session_id} {turn_index}',
+        'cost': 0.5,
+        'cost breakdown': {'sender': 0.25, 'receiver': 0.25},
+        'sender lm name': lm_name,
+        'receiver lm name': lm_name,
+        'transcript id': session_id,
+        'turn index': turn_index
+    }
+
+
+def write_shard(path, journal_path, shard_id, num_shards):
+    # what train_agent.py does for one shard: play its pairs, compact the journal into the memory file
+    journal = ResultJournal(journal_path)
+    result_ids = []
+    for session_id, turn_index, state, gold_action in state_actions():
+        result_id = state_action_id(session_id, turn_index, state, gold_action)
+        if shard_of(result_id, num_shards) != shard_id:
+            continue
+        result_ids.append(result_id)
+        result = play_result(session_id, turn_index, state, gold_action)
+        result['state action id'] = result_id
+        journal.append(result_id, result)
+    pd.DataFrame(journal.compact(result_ids)).to_csv(path)
+    return result_ids
+
+
+def merge(tmp_path, shard_paths, name='merged.csv', index_dir=None):
+    output = str(tmp_path/name)
+    merge_memory.main(Namespace(memory_shards=shard_paths, output_csv_file=output, index_dir=index_dir))
+    return output
+
+
+def test_shards_partition_the_ids():
+    ids = [state_action_id(s, t, f'state {s} {t}', 'action') for s in range(10) for t in range(10)]
+    shards = [shard_of(i, 4) for i in ids]
+    assert set(shards) == {0, 1, 2, 3}
+    assert shards == [shard_of(i, 4) for i in ids]
+    assert all(shard_of(i, 1) == 0 for i in ids)
+
+
+def test_merged_shards_match_an_unsharded_run(tmp_path):
+    single = str(tmp_path/'single.csv')
+    all_ids = write_shard(single, str(tmp_path/'single.journal.jsonl'), 0, 1)
+    shard_paths, shard_ids = [], []
+    for shard_id in range(3):
+        path = str(tmp_path/f'shard{shard_id}.csv')
+        shard_ids += write_shard(path, str(tmp_path/f'shard{shard_id}.journal.jsonl'), shard_id, 3)
+        shard_paths.append(path)
+    assert sorted(shard_ids) == sorted(all_ids)
+
+    merged = pd.read_csv(merge(tmp_path, shard_paths), index_col=0)
+    expected = pd.read_csv(merge(tmp_path, [single], name='expected.csv'), index_col=0)
+    pd.testing.assert_frame_equal(merged, expected)
+    assert list(merged['state action id']) == all_ids
+
+
+def test_merge_is_deterministic_and_drops_duplicates(tmp_path):
+    shard_paths = []
+    for shard_id in range(2):
+        path = str(tmp_path/f'shard{shard_id}.csv')
+        write_shard(path, str(tmp_path/f'shard{shard_id}.journal.jsonl'), shard_id, 2)
+        shard_paths.append(path)
+    # a pair played twice, e.g. by a rerun with a different shard count
+    duplicate = pd.read_csv(shard_paths[0], index_col=0).iloc[:3]
+    duplicate['rule'] = 'played again'
+    duplicate.to_csv(str(tmp_path/'shard2.csv'))
+    shard_paths.append(str(tmp_path/'shard2.csv'))
+
+    first = merge(tmp_path, shard_paths, name='first.csv')
+    second = merge(tmp_path, shard_paths[::-1], name='second.csv')
+    with open(first) as ifp1, open(second) as ifp2:
+        assert ifp1.read() == ifp2.read()
+
+    merged = pd.read_csv(first, index_col=0)
+    assert merged['state action id'].is_unique
+    assert len(merged) == len(state_actions())
+    # shards are taken in sorted path order, so the rerun copy is dropped
+    assert 'played again' not in set(merged['rule'])
+
+    with open(first+'.meta.json') as ifp:
+        metadata = json.load(ifp)
+    assert metadata['num state and actions'] == len(merged)
+    assert metadata['num duplicates dropped'] == 3
+    assert metadata['total cost'] == 0.5*len(merged)
+    assert metadata['cost breakdown'] == {'sender': 0.25*len(merged), 'receiver': 0.25*len(merged)}
+    assert metadata['sender lm names'] == ['gpt-3.5-turbo-1106']
+
+
+def test_merge_follows_the_training_index_order(tmp_path):
+    path = str(tmp_path/'shard0.csv')
+    write_shard(path, str(tmp_path/'shard0.journal.jsonl'), 0, 1)
+    index_dir = str(tmp_path/'index.csv')
+    pd.DataFrame({'id': [2, 0, 3, 1]}).to_csv(index_dir)
+
+    merged = pd.read_csv(merge(tmp_path, [path], index_dir=index_dir), index_col=0)
+    transcript_ids = list(dict.fromkeys(merged['transcript id']))
+    assert transcript_ids == [2, 0, 3, 1]
+    for _, turns in merged.groupby('transcript id'):
+        assert list(turns['turn index']) == sorted(turns['turn index'])
@@ -0,0 +1,169 @@
+import itertools
+import random
+import threading
+import time
+
+import pytest
+
+from utils.journal import ResultJournal
+from utils.pipeline import Pipeline, Stage
+
+
+def jittered(fn):
+    # finish in a scrambled order
+    def wrapped(item):
+        time.sleep(random.random()*0.005)
+        return fn(item)
+    return wrapped
+
+
+def pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith('pipeline')]
+
+
+def test_single_worker_stages_keep_the_input_order():
+    batch_sizes = []
+    def double(items):
+        batch_sizes.append(len(items))
+        return [2*item for item in items]
+
+    pipeline = Pipeline([
+        Stage('add', lambda item: item+1),
+        Stage('double', double, batch_size=8, max_wait=0.01),
+        Stage('str', str)
+    ], queue_size=4)
+    assert list(pipeline.run(range(100))) == [str(2*(i+1)) for i in range(100)]
+    assert max(batch_sizes) <= 8 and sum(batch_sizes) == 100
+    stats = pipeline.stats()
+    assert stats['double']['items'] == 100 and stats['double']['batches'] == len(batch_sizes)
+    assert stats['str']['items'] == 100
+
+
+def test_parallel_stages_lose_no_items_and_the_journal_restores_the_order(tmp_path):
+    journal = ResultJournal(str(tmp_path/'run.journal.jsonl'))
+    def respond(item):
+        journal.append(f'id {item}', {'output': item*item})
+        return item
+
+    pipeline = Pipeline([
+        Stage('network', jittered(lambda item: item), num_workers=8),
+        Stage('batched', lambda items: items[::-1], batch_size=5, max_wait=0.01),
+        Stage('respond', jittered(respond), num_workers=4)
+    ], queue_size=3)
+    outputs = list(pipeline.run(iter(range(200))))
+    assert sorted(outputs) == list(range(200))
+    result_ids = [f'id {i}' for i in range(200)]
+    assert [result['output'] for result in journal.compact(result_ids)] == [i*i for i in range(200)]
+
+
+def test_none_outputs_are_dropped():
+    pipeline = Pipeline([
+        Stage('odd only', lambda item: item if item % 2 else None, num_workers=3),
+        Stage('batched', lambda items: [None if item == 5 else item for item in items], batch_size=4)
+    ])
+    assert sorted(pipeline.run(range(10))) == [1, 3, 7, 9]
+
+
+def test_an_empty_input_finishes():
+    pipeline = Pipeline([Stage('a', str, num_workers=2), Stage('b', lambda items: items, batch_size=4)])
+    assert list(pipeline.run([])) == []
+
+
+@pytest.mark.parametrize('failing_stage', [0, 1, 2])
+def test_a_stage_error_is_raised_and_stops_the_pipeline(failing_stage):
+    consumed = []
+    def items():
+        for i in itertools.count():
+            consumed.append(i)
+            yield i
+
+    def fails_on(stage):
+        def fn(item):
+            if stage == failing_stage and item == 20:
+                raise ValueError(f'stage {stage} failed')
+            return item
+        return fn
+
+    def batched(items):
+        return [fails_on(1)(item) for item in items]
+
+    pipeline = Pipeline([
+        Stage('first', fails_on(0), num_workers=4),
+        Stage('batched', batched, batch_size=4),
+        Stage('last', fails_on(2), num_workers=2)
+    ], queue_size=2)
+    with pytest.raises(ValueError, match=f'stage {failing_stage} failed'):
+        for _ in pipeline.run(items()):
+            pass
+    # the infinite input stops being read, every thread has finished
+    assert pipeline_threads() == []
+    num_consumed = len(consumed)
+    time.sleep(0.3)
+    assert len(consumed) == num_consumed < 100
+
+
+def test_closing_early_finishes_every_thread():
+    pipeline = Pipeline([
+        Stage('network', jittered(lambda item: item), num_workers=4),
+        Stage('batched', lambda items: items, batch_size=4)
+    ], queue_size=2)
+    outputs = pipeline.run(itertools.count())
+    assert len([next(outputs) for _ in range(10)]) == 10
+    assert len(pipeline_threads()) == 1+4+1
+    outputs.close()
+    assert pipeline_threads() == []
+
+
+def test_a_stuck_worker_does_not_hold_up_closing():
+    release = threading.Event()
+    def stuck(item):
+        if item == 1:
+            release.wait()
+        return item
+
+    pipeline = Pipeline([Stage('stuck', stuck, num_workers=2)], join_timeout=0.2)
+    outputs = pipeline.run(range(10))
+    assert next(outputs) == 0
+    start = time.time()
+    outputs.close()
+    assert time.time()-start < 2
+    assert [thread.name for thread in pipeline_threads()] == ['pipeline stuck']
+    release.set()
+    for thread in pipeline_threads():
+        thread.join()
+
+
+def test_an_input_error_is_raised():
+    def items():
+        yield 1
+        yield 2
+        raise KeyError('bad input')
+
+    pipeline = Pipeline([Stage('a', lambda item: item)])
+    with pytest.raises(KeyError, match='bad input'):
+        list(pipeline.run(items()))
+
+
+def test_full_queues_hold_back_the_input():
+    consumed = []
+    def items():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    release = threading.Event()
+    def slow(item):
+        release.wait()
+        return item
+
+    pipeline = Pipeline([Stage('slow', slow, num_workers=2)], queue_size=4)
+    outputs = pipeline.run(items())
+    first = threading.Thread(target=lambda: next(outputs))
+    first.start()
+    time.sleep(0.3)
+    # two items in the workers, queue_size queued, at most one more held by the feeder
+    assert len(consumed) <= 2+4+1
+    release.set()
+    first.join()
+    outputs.close()
+    assert pipeline_threads() == []
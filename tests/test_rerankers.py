@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import sentence_transformers
+from utils.llm_backends import MockBackend
+from utils.openai_dialogue import set_llm_backend
+from utils.rerankers import CrossEncoderReranker, GPTReranker, HybridReranker, build_reranker
+
+
+RULES = ['rule one', 'rule two', 'rule three']
+
+
+class StubScorer:
+
+    """
+    cross-encoder stand-in with preset scores per client tom, remembers its calls
+    """
+
+    def __init__(self, scores):
+        self.scores = scores
+        self.calls = []
+
+    def score_batch(self, client_toms, rules_lists):
+        self.calls.append(list(client_toms))
+        return [np.asarray(self.scores[client_tom], dtype=np.float32) for client_tom in client_toms]
+
+
+class StubCrossEncoder:
+
+    """
+    sentence_transformers.CrossEncoder stand-in, scores a pair by the words its two texts share
+    """
+
+    num_predicts = 0
+
+    def __init__(self, model_name, device='cpu'):
+        self.model_name = model_name
+
+    def predict(self, pairs, batch_size=32, show_progress_bar=False):
+        StubCrossEncoder.num_predicts += 1
+        return np.array([len(set(a.split()) & set(b.split())) for a, b in pairs], dtype=np.float32)
+
+
+@pytest.fixture
+def cross_encoder(monkeypatch):
+    monkeypatch.setattr(sentence_transformers, 'CrossEncoder', StubCrossEncoder)
+    monkeypatch.setattr(StubCrossEncoder, 'num_predicts', 0)
+
+
+def gpt_backend(replies):
+    backend = MockBackend(replies=replies)
+    set_llm_backend(backend)
+    return backend
+
+
+@pytest.mark.parametrize('reply, index', [('2', 1), ('Rule 3.', 2), ('none of them', 0), ('9', 0), ('0', 0)])
+def test_gpt_reranker_falls_back_to_the_best_retrieved_rule(llm_globals, reply, index):
+    gpt_backend([reply])
+    chosen, cost = GPTReranker().rerank('a state', 'a client tom', RULES)
+    assert chosen == index and cost > 0
+
+
+def test_cross_encoder_scores_every_pair_in_one_call(cross_encoder):
+    reranker = CrossEncoderReranker('stub')
+    client_toms = ['two one', 'three', 'nothing']
+    rules_lists = [RULES, RULES[::-1], []]
+    scores = reranker.score_batch(client_toms, rules_lists)
+    assert StubCrossEncoder.num_predicts == 1
+    assert [list(s) for s in scores] == [[1, 1, 0], [1, 0, 0], []]
+    assert reranker.rerank_batch(client_toms[:2], client_toms[:2], rules_lists[:2]) == [(0, 0), (0, 0)]
+    assert reranker.rerank('state', 'three', RULES) == (2, 0)
+
+
+def test_hybrid_asks_the_llm_only_about_close_candidates(llm_globals):
+    backend = gpt_backend(['2'])
+    scorer = StubScorer({'clear': [0.0, 3.0, 1.0], 'close': [2.5, 0.0, 3.0]})
+    reranker = HybridReranker(scorer, GPTReranker(), margin=1.0)
+
+    assert reranker.rerank('state', 'clear', RULES) == (1, 0)
+    assert backend.num_requests == 0
+
+    # the llm sees the close rules best first, its second choice is RULES[0]
+    seen = []
+    backend.replies = lambda messages: seen.append(messages[-1]['content']) or '2'
+    index, cost = reranker.rerank('state', 'close', RULES)
+    assert index == 0 and cost > 0
+    assert '1: rule three' in seen[0] and '2: rule one' in seen[0] and 'rule two' not in seen[0]
+    assert reranker.escalation_rate() == 0.5
+
+
+def test_hybrid_rerank_batch_scores_once_and_matches_rerank(llm_globals):
+    backend = gpt_backend(['1'])
+    scores = {'clear': [0.0, 3.0, 1.0], 'close': [2.5, 0.0, 3.0], 'tie': [1.0, 1.0, 1.0]}
+    client_toms = ['clear', 'close', 'tie', 'clear']
+    reranker = HybridReranker(StubScorer(scores), GPTReranker(), margin=1.0, num_workers=2)
+    chosen = reranker.rerank_batch(['state']*4, client_toms, [RULES]*4)
+    assert reranker.cross_encoder_reranker.calls == [client_toms]
+    assert backend.num_requests == 2
+    assert reranker.escalation_rate() == 0.5
+
+    one_by_one = HybridReranker(StubScorer(scores), GPTReranker(), margin=1.0)
+    assert chosen == [one_by_one.rerank('state', client_tom, RULES) for client_tom in client_toms]
+    assert [index for index, _ in chosen] == [1, 2, 0, 1]
+
+
+def test_build_reranker(cross_encoder):
+    assert isinstance(build_reranker('gpt', gpt_model='gpt-4'), GPTReranker)
+    assert build_reranker('cross_encoder', cross_encoder_name='stub').model.model_name == 'stub'
+    hybrid = build_reranker('hybrid', cross_encoder_name='stub', hybrid_margin=0.5, hybrid_workers=3)
+    assert (hybrid.margin, hybrid.num_workers) == (0.5, 3)
+    with pytest.raises(AssertionError):
+        build_reranker('bm25')
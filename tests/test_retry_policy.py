@@ -0,0 +1,108 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from utils.retry_policy import CircuitBreaker, RetryPolicy, RetryTimeExceeded
+
+
+def fast_policy(**kwargs):
+    options = dict(base_delay=0, max_delay=0, max_retry_time=2, failure_threshold=2, cooldown=0.05)
+    options.update(kwargs)
+    return RetryPolicy(**options)
+
+
+def failing(error, times):
+    calls = []
+    def send_request():
+        calls.append(1)
+        if len(calls) <= times:
+            raise error
+        return 'ok'
+    return send_request, calls
+
+
+def test_retries_until_success():
+    policy = fast_policy(failure_threshold=10)
+    send_request, calls = failing(openai.error.RateLimitError('slow down'), times=3)
+    assert policy.call('m', send_request) == 'ok'
+    assert len(calls) == 4
+    assert policy.metrics.snapshot()['retries'] == {'m': {'RateLimitError': 3}}
+
+
+def test_non_retryable_error_is_raised_at_once():
+    policy = fast_policy()
+    send_request, calls = failing(openai.error.InvalidRequestError('prompt too long', None), times=1)
+    with pytest.raises(openai.error.InvalidRequestError):
+        policy.call('m', send_request)
+    assert len(calls) == 1
+
+
+def test_gives_up_after_max_retry_time():
+    policy = fast_policy(base_delay=0.05, max_delay=0.05, max_retry_time=0.2, failure_threshold=100)
+    send_request, _ = failing(openai.error.APIError('down'), times=1000)
+    with pytest.raises(RetryTimeExceeded):
+        policy.call('m', send_request)
+
+
+def test_breaker_opens_and_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=0.05)
+    assert breaker.wait_time() == (0, False)
+    assert not breaker.record_failure()
+    assert breaker.record_failure()
+    wait, probe = breaker.wait_time()
+    assert wait > 0 and not probe
+    time.sleep(0.06)
+    assert breaker.wait_time() == (0, True)
+    # only one probe at a time
+    assert breaker.wait_time() == (1, False)
+    breaker.record_success()
+    assert breaker.wait_time() == (0, False)
+
+
+def test_non_retryable_probe_does_not_wedge_the_breaker():
+    policy = fast_policy()
+    policy.breaker('m').record_failure()
+    policy.breaker('m').record_failure()
+    time.sleep(0.06)
+
+    # the half-open probe is a bad request, the endpoint itself is fine
+    send_request, _ = failing(openai.error.InvalidRequestError('prompt too long', None), times=1)
+    with pytest.raises(openai.error.InvalidRequestError):
+        policy.call('m', send_request)
+
+    started = time.monotonic()
+    assert policy.call('m', lambda: 'ok') == 'ok'
+    assert time.monotonic()-started < 0.5
+    assert policy.breaker('m').opened_at is None
+
+
+def test_interrupted_probe_is_released():
+    policy = fast_policy()
+    policy.breaker('m').record_failure()
+    policy.breaker('m').record_failure()
+    time.sleep(0.06)
+
+    def interrupted():
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        policy.call('m', interrupted)
+    assert not policy.breaker('m').probe_in_flight
+    assert policy.call('m', lambda: 'ok') == 'ok'
+
+
+def test_acall_retries_and_releases_the_probe():
+    policy = fast_policy()
+    policy.breaker('m').record_failure()
+    policy.breaker('m').record_failure()
+    time.sleep(0.06)
+
+    async def bad_request():
+        raise openai.error.InvalidRequestError('prompt too long', None)
+    async def good_request():
+        return 'ok'
+
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(policy.acall('m', bad_request))
+    assert asyncio.run(policy.acall('m', good_request)) == 'ok'
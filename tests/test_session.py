@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from utils.annomi_utils import AnnoMIDataset
+from utils.session import Session, iter_state_actions
+
+
+ANNOMI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'AnnoMI')
+
+
+def baseline_state_actions(sessions, min_action_length=35, max_prev_turns=4):
+    """
+    the loop train_agent.py and inference.py used to extract state action pairs with
+    """
+    state_actions = []
+    for session_id, session in enumerate(sessions):
+        session.state_tracker = 3
+        try:
+            session.skip_to_next_utt_by('therapist')
+            while True:
+                state, gold_action = session.state(max_prev_turns), session.gold_action()
+                if len(gold_action) > min_action_length:
+                    state_actions.append((session_id, session.state_tracker, state, gold_action))
+                session.skip_to_next_utt_by('therapist')
+        except IndexError:
+            pass
+    return state_actions
+
+
+@pytest.mark.parametrize('csv_name', ['train.csv', 'test.csv'])
+@pytest.mark.parametrize('min_action_length, max_prev_turns', [(35, 4), (0, 2), (35, 10)])
+def test_same_pairs_as_the_baseline_loop(csv_name, min_action_length, max_prev_turns, tmp_path):
+    dataset = AnnoMIDataset(os.path.join(ANNOMI_DIR, csv_name), cache_dir=str(tmp_path))
+    sessions = list(dataset.sessions())
+    state_actions = list(iter_state_actions(sessions, min_action_length=min_action_length, max_prev_turns=max_prev_turns))
+    assert len(state_actions) > 0
+    assert state_actions == baseline_state_actions(
+        list(dataset.sessions()), min_action_length=min_action_length, max_prev_turns=max_prev_turns
+    )
+
+
+def test_short_sessions_and_session_ids():
+    turns = [{'role': role, 'utterance': f'{role} says something rather long number {i}'} for i, role in enumerate(
+        ['therapist', 'client', 'therapist', 'client', 'client', 'therapist', 'client', 'therapist']
+    )]
+    sessions = [
+        Session({'topic': 'smoking', 'turns': turns}),
+        Session({'topic': 'alcohol', 'turns': turns[:4]}),
+        Session({'topic': 'diet', 'turns': turns[:6]})
+    ]
+    state_actions = list(iter_state_actions(sessions, session_ids=['a', 'b', 'c']))
+    assert [(session_id, turn_index) for session_id, turn_index, _, _ in state_actions] == [('a', 5), ('a', 7), ('c', 5)]
+    assert state_actions == [
+        (['a', 'b', 'c'][session_id], turn_index, state, gold_action)
+        for session_id, turn_index, state, gold_action in baseline_state_actions(sessions)
+    ]
@@ -0,0 +1,57 @@
+import pytest
+
+from utils.structured_output import parse_json_object, parse_prediction, validate_fields
+
+
+CLIENT_STAGES = ['Precontemplation', 'Contemplation', 'Preparation', 'Action', 'Maintenance']
+
+
+@pytest.mark.parametrize('reply', [
+    '{"client_stage": "Action"}',
+    '```json\n{"client_stage": "Action"}\n```',
+    'Here is the analysis: {"client_stage": "Action"} Let me know!',
+    '{"client_stage": "Action",}',
+    "{'client_stage': 'Action'}",
+    '{"client_stage": "Action"',
+    '{“client_stage”: “Action”}'
+])
+def test_parse_json_object_repairs(reply):
+    assert parse_json_object(reply) == {'client_stage': 'Action'}
+
+
+@pytest.mark.parametrize('reply', ['no json here', '{not: json, at all', '["a list"]', ''])
+def test_parse_json_object_gives_up(reply):
+    assert parse_json_object(reply) is None
+
+
+def test_parse_json_object_never_evaluates_code(tmp_path):
+    marker = tmp_path/'evaluated'
+    reply = "{'a': __import__('pathlib').Path(%r).touch()}" % str(marker)
+    assert parse_json_object(reply) is None
+    assert not marker.exists()
+
+
+def test_validate_fields_normalizes_keys_and_values():
+    parsed = {'Client Stage': 'contemplation stage', 'client-mental state': '  hesitant  '}
+    assert validate_fields(parsed, {'client_stage': CLIENT_STAGES, 'client_mental_state': None}) == {
+        'client_stage': 'Contemplation', 'client_mental_state': 'hesitant'
+    }
+
+
+@pytest.mark.parametrize('parsed', [
+    None,
+    {'client_mental_state': 'hesitant'},
+    {'client_stage': 'Contemplation', 'client_mental_state': ''},
+    {'client_stage': 'Contemplation', 'client_mental_state': 3},
+    {'client_stage': 'somewhere', 'client_mental_state': 'hesitant'},
+    # precontemplation does not contain the word contemplation, but both are named here
+    {'client_stage': 'Contemplation or Precontemplation', 'client_mental_state': 'hesitant'}
+])
+def test_validate_fields_rejects(parsed):
+    assert validate_fields(parsed, {'client_stage': CLIENT_STAGES, 'client_mental_state': None}) is None
+
+
+def test_parse_prediction():
+    assert parse_prediction("{'prediction': \"Preparation\"}") == 'Preparation'
+    assert parse_prediction('{"prediction": 1}') is None
+    assert parse_prediction('Preparation') is None
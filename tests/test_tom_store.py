@@ -0,0 +1,36 @@
+from utils.tom_store import TomStore
+
+
+SNIPPET = 'Topic: smoking cessation\n[client]: Yeah, I-I think that would be very helpful.'
+RESPONSE = '[therapist]: glad you think that is helpful!'
+
+
+def test_training_toms_never_reach_inference(tmp_path):
+    store = TomStore(str(tmp_path/'toms.sqlite'))
+    store.put_full_toms(SNIPPET, RESPONSE, 'gpt', 'preparation', 'hopeful', 'affirming', 'affirm the client')
+    assert store.get_full_toms(SNIPPET, RESPONSE, 'gpt')['client tom'] == 'hopeful'
+    assert store.get_client_toms(SNIPPET, 'gpt') is None
+    store.close()
+
+
+def test_client_toms_are_keyed_by_mode_and_model(tmp_path):
+    store = TomStore(str(tmp_path/'toms.sqlite'))
+    store.put_client_toms(SNIPPET, 'gpt', 'preparation', 'hopeful', mode='single')
+    assert store.get_client_toms(SNIPPET, 'gpt', mode='multi_turn') is None
+    assert store.get_client_toms(SNIPPET, 'other gpt', mode='single') is None
+    # whitespace differences do not matter
+    assert store.get_client_toms(SNIPPET.replace(' ', '  '), 'gpt', mode='single') == {
+        'client stage': 'preparation', 'client tom': 'hopeful'
+    }
+    store.close()
+
+
+def test_entries_persist(tmp_path):
+    path = str(tmp_path/'toms.sqlite')
+    store = TomStore(path)
+    store.put_client_toms(SNIPPET, 'gpt', 'preparation', 'hopeful')
+    store.close()
+    store = TomStore(path)
+    assert store.get_client_toms(SNIPPET, 'gpt')['client tom'] == 'hopeful'
+    assert store.stats()['client toms'] == 1
+    store.close()
@@ -1,4 +1,4 @@
-from utils import OpenaiSequencialDialogue 
+from utils import OpenaiSequencialDialogue, parse_json_object, validate_fields, parse_prediction, get_tom_store
 
 def determine_therapist_stage(dialog_snippet, llm_name='gpt-3.5-turbo-1106'):
     prompt = """You are a dialogue analyst and your job is to help us understanding motivational interviewing dialogues.  You will be given a dialogue context, and you will help us determine which of the 4 stages of motivational interviewing the therapist is at: engaging, focusing, evoking, or planning.
@@ -18,21 +18,16 @@ Look at the following dialogue snippet, which of the 4 stage is the dialogue in?
 Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
     model = OpenaiSequencialDialogue(model=llm_name)
     model_response = model.send_user_message(prompt.replace('@snippet@', dialog_snippet))
-    try:
-        therapist_tom = eval(model_response)['prediction']
-    except:
+    therapist_tom = parse_prediction(model_response)
+    if therapist_tom is None:
         print(model_response)
         therapist_tom = 'na'
     cost = model.cost()['total']
     
     return therapist_tom.lower(), cost
 
-def determine_toms(
-    dialog_snippet, 
-    therapist_response,
-    llm_name='gpt-3.5-turbo-1106'
-):
-    prompt = """You are a dialogue analyst and your job is to help us understanding motivational interviewing dialogues.  You will be given a dialogue context, and you will help us determine which of the 5 stages of change the client is at: Precontemplation, Contemplation, Preparation, Action, or Maintenance.
+# shared by the multi-turn prompts of determine_toms and determine_toms_inference_mode
+STAGES_OF_CHANGE_PROMPT = """You are a dialogue analyst and your job is to help us understanding motivational interviewing dialogues.  You will be given a dialogue context, and you will help us determine which of the 5 stages of change the client is at: Precontemplation, Contemplation, Preparation, Action, or Maintenance.
 
 1. Precontemplation: At this stage, the individual is not yet considering making a change and may be unaware of the need for change.
 
@@ -49,85 +44,216 @@ Look at the following dialogue snippet, which of the 5 stage is the client in?
 @snippet@
 
 Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
+
+def fine_grained_tom_prompt(client_last_utt):
+    return """Now, give a fine-grained description of the client's mental state when the client says """+client_last_utt+""" (it doesn't have to be within to the stages of change -  just your understanding of how ready they are to change/what they are thinking with respect to making a positive change - are they resistant? eager to change? hesitant?). Be general, make sure your rule is generalizable across topics. For example, simple use 'bad habit' instead of 'drug abuse/alcohol issue/smoking'. Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
+
+THERAPIST_BEHAVIOR_PROMPT = """Here is the therapist's response to the client:
+@therapist_response@
+
+Now, give a fine-grained description of the therapist's response. What is the therapist doing here? And what effect does the therapist want to have in the client using the response? Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything.
+"""
+
+CONTEXTUAL_INSTRUCTION_PROMPT = """Now, based on your analysis of the client's mental state and the therapist's behavior, combine these two information into a rule in the format of "when the client ..., the therapist can… in order to…"""
+
+CLIENT_STAGES = ['Precontemplation', 'Contemplation', 'Preparation', 'Action', 'Maintenance']
+
+# single request version, all fields in one JSON object
+SINGLE_REQUEST_TOM_PROMPT = """You are a dialogue analyst and your job is to help us understanding motivational interviewing dialogues.  You will be given a dialogue context@with_response@, and you will help us analyze it.
+
+These are the 5 stages of change a client can be at:
+
+1. Precontemplation: At this stage, the individual is not yet considering making a change and may be unaware of the need for change.
+
+2. Contemplation: In this stage, the individual is aware of the need for change and is considering the possibility of making a change in the near future.
+
+3. Preparation: During this stage, the individual is actively preparing to make a change and may be taking small steps toward behavior change.
+
+4. Action: At this stage, the individual has made a specific, observable change in their behavior and is actively working to maintain this change.
+
+5. Maintenance: In the maintenance stage, the individual has successfully made the desired change and is working to prevent relapse and sustain the new behavior over time.
+
+The dialogue snippet:
+
+@snippet@
+@therapist_response@
+Answer with a single JSON object with the following fields:
+@fields@
+
+Output the JSON object only, you do not have to explain anything."""
+
+SINGLE_REQUEST_TOM_FIELDS = {
+    'client_stage': 'which of the 5 stages of change the client is in, one of "Precontemplation", "Contemplation", "Preparation", "Action" or "Maintenance"',
+    'client_mental_state': 'a fine-grained description of the client\'s mental state when the client says @client_last_utt@ (it doesn\'t have to be within to the stages of change -  just your understanding of how ready they are to change/what they are thinking with respect to making a positive change - are they resistant? eager to change? hesitant?). Be general, make sure your rule is generalizable across topics. For example, simple use \'bad habit\' instead of \'drug abuse/alcohol issue/smoking\'',
+    'therapist_behavior': 'a fine-grained description of the therapist\'s response. What is the therapist doing here? And what effect does the therapist want to have in the client using the response?',
+    'contextual_instruction': 'based on your analysis of the client\'s mental state and the therapist\'s behavior, combine these two information into a rule in the format of "when the client ..., the therapist can… in order to…"'
+}
+
+
+# room for all fields at once
+SINGLE_REQUEST_TOM_MAX_TOKENS = 768
+
+
+def client_last_utterance(dialog_snippet):
+    return dialog_snippet.split('\n')[-1].replace('[client]', '')
+
+
+def single_request_tom_prompt(dialog_snippet, therapist_response=None):
+    """
+    prompt of determine_toms_single_request and the fields it asks for
+    """
+    fields = ['client_stage', 'client_mental_state']
+    if therapist_response is not None:
+        fields += ['therapist_behavior', 'contextual_instruction']
+    fields_text = '\n'.join([
+        f'"{f}": '+SINGLE_REQUEST_TOM_FIELDS[f].replace('@client_last_utt@', client_last_utterance(dialog_snippet)) 
+        for f in fields
+    ])
+    prompt = SINGLE_REQUEST_TOM_PROMPT.replace('@snippet@', dialog_snippet).replace('@fields@', fields_text)
+    if therapist_response is not None:
+        prompt = prompt.replace('@with_response@', ' and the therapist\'s response to it').replace(
+            '@therapist_response@', '\nHere is the therapist\'s response to the client:\n'+therapist_response+'\n')
+    else:
+        prompt = prompt.replace('@with_response@', '').replace('@therapist_response@', '')
+    return prompt, fields
+
+
+def determine_toms_single_request(
+    dialog_snippet, 
+    therapist_response=None,
+    llm_name='gpt-3.5-turbo-1106'
+):
+    """
+    all TOM fields in one request, parsed as JSON and validated.
+    Without a therapist_response only the client fields are asked for (inference mode).
+
+    returns ({field: value} or None if the reply is invalid, cost)
+    """
+    prompt, fields = single_request_tom_prompt(dialog_snippet, therapist_response)
+    model = OpenaiSequencialDialogue(model=llm_name, max_response_tokens=SINGLE_REQUEST_TOM_MAX_TOKENS)
+    model_response = model.send_user_message(prompt)
+    toms = validate_fields(
+        parse_json_object(model_response), 
+        {f:(CLIENT_STAGES if f == 'client_stage' else None) for f in fields}
+    )
+    if toms is None:
+        print('[Warning]: TOM detector: invalid single request response, falling back to multi-turn: ', model_response)
+    return toms, model.cost()['total']
+
+
+def determine_toms(
+    dialog_snippet, 
+    therapist_response,
+    llm_name='gpt-3.5-turbo-1106',
+    mode='multi_turn'
+):
+    """
+    mode: 'multi_turn' (default, the original prompts) asks for each field in turn on one conversation,
+        'single' asks for all fields in one JSON request (falling back to multi-turn if the reply is invalid)
+    returns client stage, client tom, therapist tom, contextual instruction, cost
+
+    if a TomStore is installed (utils.set_tom_store), previously inferred TOMs are reused at no cost
+    """
+    store = get_tom_store()
+    if store is not None:
+        toms = store.get_full_toms(dialog_snippet, therapist_response, llm_name, mode=mode)
+        if toms is not None:
+            return toms['client stage'], toms['client tom'], toms['therapist tom'], toms['contextual instruction'], 0
+    client_tom, client_fine_grained_tom, therapist_fine_grained_tom, contextual_instruction, cost = _determine_toms(
+        dialog_snippet, therapist_response, llm_name, mode
+    )
+    if store is not None:
+        store.put_full_toms(dialog_snippet, therapist_response, llm_name, 
+                            client_tom, client_fine_grained_tom, therapist_fine_grained_tom, contextual_instruction, mode=mode)
+    return client_tom, client_fine_grained_tom, therapist_fine_grained_tom, contextual_instruction, cost
+
+
+def _determine_toms(dialog_snippet, therapist_response, llm_name, mode):
+    assert mode in {'single', 'multi_turn'}
+    cost = 0
+    if mode == 'single':
+        toms, cost = determine_toms_single_request(dialog_snippet, therapist_response, llm_name)
+        if toms is not None:
+            return (
+                toms['client_stage'].lower(), 
+                toms['client_mental_state'].lower(), 
+                toms['therapist_behavior'].lower(), 
+                toms['contextual_instruction'], 
+                cost
+            )
+
     model = OpenaiSequencialDialogue(model=llm_name)
-    model_response = model.send_user_message(prompt.replace('@snippet@', dialog_snippet))
-    try:
-        client_tom = eval(model_response)['prediction']
-    except:
+    model_response = model.send_user_message(STAGES_OF_CHANGE_PROMPT.replace('@snippet@', dialog_snippet))
+    client_tom = parse_prediction(model_response)
+    if client_tom is None:
         print(model_response)
         client_tom = 'na'
         
-    client_last_utt = dialog_snippet.split('\n')[-1].replace('[client]', '')
-    fine_grained_tom_prompt = f"""Now, give a fine-grained description of the client's mental state when the client says """+client_last_utt+""" (it doesn't have to be within to the stages of change -  just your understanding of how ready they are to change/what they are thinking with respect to making a positive change - are they resistant? eager to change? hesitant?). Be general, make sure your rule is generalizable across topics. For example, simple use 'bad habit' instead of 'drug abuse/alcohol issue/smoking'. Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
-    model_response = model.send_user_message(fine_grained_tom_prompt)
-    
-    try:
-        client_fine_grained_tom = eval(model_response)['prediction']
-    except:
+    model_response = model.send_user_message(fine_grained_tom_prompt(client_last_utterance(dialog_snippet)))
+    client_fine_grained_tom = parse_prediction(model_response)
+    if client_fine_grained_tom is None:
         print('[Warning]: TOM detector: parse response failed on: ', model_response)
         client_fine_grained_tom = model_response
     
     
-    therapist_behavior_prompt = """Here is the therapist's response to the client:
-@therapist_response@
-
-Now, give a fine-grained description of the therapist's response. What is the therapist doing here? And what effect does the therapist want to have in the client using the response? Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything.
-""".replace('@therapist_response@', therapist_response)
-    model_response = model.send_user_message(therapist_behavior_prompt)
-    try:
-        therapist_fine_grained_tom = eval(model_response)['prediction']
-    except:
+    model_response = model.send_user_message(THERAPIST_BEHAVIOR_PROMPT.replace('@therapist_response@', therapist_response))
+    therapist_fine_grained_tom = parse_prediction(model_response)
+    if therapist_fine_grained_tom is None:
         print(model_response)
         therapist_fine_grained_tom = 'na'
         
-    contextual_instruction_prompt = """Now, based on your analysis of the client's mental state and the therapist's behavior, combine these two information into a rule in the format of "when the client ..., the therapist can… in order to…"""
-    contextual_instruction = model.send_user_message(contextual_instruction_prompt)
+    contextual_instruction = model.send_user_message(CONTEXTUAL_INSTRUCTION_PROMPT)
     
     
-    return client_tom.lower(), client_fine_grained_tom.lower(), therapist_fine_grained_tom.lower(), contextual_instruction, model.cost()['total']
+    return client_tom.lower(), client_fine_grained_tom.lower(), therapist_fine_grained_tom.lower(), contextual_instruction, cost+model.cost()['total']
 
 
 def determine_toms_inference_mode(
     dialog_snippet, 
-    llm_name='gpt-3.5-turbo-1106'
+    llm_name='gpt-3.5-turbo-1106',
+    mode='multi_turn'
 ):
-    prompt = """You are a dialogue analyst and your job is to help us understanding motivational interviewing dialogues.  You will be given a dialogue context, and you will help us determine which of the 5 stages of change the client is at: Precontemplation, Contemplation, Preparation, Action, or Maintenance.
-
-1. Precontemplation: At this stage, the individual is not yet considering making a change and may be unaware of the need for change.
-
-2. Contemplation: In this stage, the individual is aware of the need for change and is considering the possibility of making a change in the near future.
-
-3. Preparation: During this stage, the individual is actively preparing to make a change and may be taking small steps toward behavior change.
+    """
+    client side of determine_toms, for test time (no therapist response)
+    returns client stage, client tom, cost
 
-4. Action: At this stage, the individual has made a specific, observable change in their behavior and is actively working to maintain this change.
+    if a TomStore is installed (utils.set_tom_store), client TOMs inferred before by this function
+    (never the training ones, whose prompt sees the therapist response) are reused at no cost
+    """
+    store = get_tom_store()
+    if store is not None:
+        toms = store.get_client_toms(dialog_snippet, llm_name, mode=mode)
+        if toms is not None:
+            return toms['client stage'], toms['client tom'], 0
+    client_tom, client_fine_grained_tom, cost = _determine_toms_inference_mode(dialog_snippet, llm_name, mode)
+    if store is not None:
+        store.put_client_toms(dialog_snippet, llm_name, client_tom, client_fine_grained_tom, mode=mode)
+    return client_tom, client_fine_grained_tom, cost
 
-5. Maintenance: In the maintenance stage, the individual has successfully made the desired change and is working to prevent relapse and sustain the new behavior over time.
 
-Look at the following dialogue snippet, which of the 5 stage is the client in?
+def _determine_toms_inference_mode(dialog_snippet, llm_name, mode):
+    assert mode in {'single', 'multi_turn'}
+    cost = 0
+    if mode == 'single':
+        toms, cost = determine_toms_single_request(dialog_snippet, None, llm_name)
+        if toms is not None:
+            return toms['client_stage'].lower(), toms['client_mental_state'].lower(), cost
 
-@snippet@
-
-Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
     model = OpenaiSequencialDialogue(model=llm_name)
-    model_response = model.send_user_message(prompt.replace('@snippet@', dialog_snippet))
-    try:
-        client_tom = eval(model_response)['prediction']
-    except:
+    model_response = model.send_user_message(STAGES_OF_CHANGE_PROMPT.replace('@snippet@', dialog_snippet))
+    client_tom = parse_prediction(model_response)
+    if client_tom is None:
         print(model_response)
         client_tom = 'na'
         
-    client_last_utt = dialog_snippet.split('\n')[-1].replace('[client]', '')
-    fine_grained_tom_prompt = f"""Now, give a fine-grained description of the client's mental state when the client says """+client_last_utt+""" (it doesn't have to be within to the stages of change -  just your understanding of how ready they are to change/what they are thinking with respect to making a positive change - are they resistant? eager to change? hesitant?). Be general, make sure your rule is generalizable across topics. For example, simple use 'bad habit' instead of 'drug abuse/alcohol issue/smoking'. Format you answer in this format: {'prediction': "your answer"}, you do not have to explain anything."""
-    model_response = model.send_user_message(fine_grained_tom_prompt)
-    
-    try:
-        client_fine_grained_tom = eval(model_response)['prediction']
-    except:
+    model_response = model.send_user_message(fine_grained_tom_prompt(client_last_utterance(dialog_snippet)))
+    client_fine_grained_tom = parse_prediction(model_response)
+    if client_fine_grained_tom is None:
         print('[Warning]: TOM detector: parse response failed on: ', model_response)
         client_fine_grained_tom = model_response
     
     
-    return client_tom.lower(), client_fine_grained_tom.lower(), model.cost()['total']
+    return client_tom.lower(), client_fine_grained_tom.lower(), cost+model.cost()['total']
 
 
 if __name__ == '__main__':
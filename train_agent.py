@@ -1,15 +1,46 @@
+import json
 import pandas as pd
 from utils import (
 OpenaiSequencialDialogue,
 Session,
-display_annomi_dialogue
+AnnoMIDataset,
+iter_state_actions,
+RequestScheduler,
+LLMEngine,
+set_llm_engine,
+ordered_parallel_map,
+LLMResponseCache,
+set_llm_cache,
+default_retry_policy,
+set_llm_backend,
+build_backend,
+TomStore,
+set_tom_store,
+ResultJournal,
+state_action_id,
+shard_of,
+sync_memory_bundle,
+build_sentence_encoder,
+estimate_cost,
+count_tokens,
+BilledCostMeter,
+CostBudget
 )
-from nltk.util import flatten
 from utils import DialogueActClassifier 
+from utils.dialogueact_classifier import MI_LABELS, CLASSIFY_ACTION_PROMPT, CLASSIFY_TURN_ACTIONS_PROMPT
 import openai
 from utils import OPENAI_API_KEY
 openai.api_key = OPENAI_API_KEY
-from tom_detector import determine_toms
+from tom_detector import (
+determine_toms,
+single_request_tom_prompt,
+client_last_utterance,
+fine_grained_tom_prompt,
+SINGLE_REQUEST_TOM_MAX_TOKENS,
+STAGES_OF_CHANGE_PROMPT,
+THERAPIST_BEHAVIOR_PROMPT,
+CONTEXTUAL_INSTRUCTION_PROMPT
+)
 from collections import defaultdict
 from tqdm import tqdm
 
@@ -34,6 +65,37 @@ def truncate_labels(labels):
         
     return out
 
+def receiver_prompt(state, content_rule=None):
+    """
+    what the receiver is asked, first without a rule, then with the sender's latest rule
+    """
+    if content_rule is None:
+        return f'Look at the following therapist-client dialogue, predict what should the therapist say next.\n{state}\n\nStart your resposne with [therapist]: '
+    return f'Look at the following therapist-client dialogue, predict what should the therapist say next.\n{state}.'+\
+    f'\nFollow these guidelines when producing response:\n{content_rule}\n\nStart your resposne with [therapist]: '
+
+def sender_rule_prompt(state, client_tom, receiver_response, gold_action, gold_mi_codes, num_gold_sentences):
+    """
+    first sender message, asks for a rule that turns the receiver response into the gold one
+    """
+    return 'You are trying to teach a student to follow true therapist\'s motivaional interviewing behavior. '+\
+    'Here is the current scenario:\n'+\
+    state+\
+    '\n\nClient mental state seems to be: '+client_tom+\
+    '\n\nThe Student Response is: \n'+receiver_response+\
+    '\nIn comparison, the true therapist response is: \n'+gold_action+\
+    '\n\nFrom our annotation, it seems like the true therapist\'s actions in order, sentence by sentence, are: '+str(gold_mi_codes)+', which is '+str(num_gold_sentences)+' sentences.'\
+    ' Analyze the current situation, and write a instruction for the student, in the format of '+\
+    'Based on the annotation, When the client ..., the therapist should ..., the therapist should not ...'+\
+    '\nWhen mention what the therapist should do, be sure to include information on how many sentence are needed and what each sentence should do.'+\
+    '\nImportant: this is not a general guideline, but should be specifically tailored to the flaw in the student response.'+\
+    'Be general, make sure your rule is generalizable across topics. For example, simple use \'bad habit\' instead of drug abuse/alcohol issue/smoking.'+\
+    ' such that we can reuse this rule for other topics in the future.'
+
+SUCCESS_CHECK_PROMPT = 'The student wrote a response based on your rule. @receiver_response@, did the student correctly follow your guideline and replicated the true therapist? Answer yes or no first.'
+
+UPDATE_RULE_PROMPT = 'Then update your instruction to better guide the student.'
+
 def play_state(
     state,
     gold_action,
@@ -41,7 +103,8 @@ def play_state(
     verbose=True,
     max_align_loop = 3,
     sender_lm_name = 'gpt-3.5-turbo-1106',
-    receiver_lm_name = 'gpt-3.5-turbo-1106'
+    receiver_lm_name = 'gpt-3.5-turbo-1106',
+    tom_mode = 'multi_turn'
 ):
     """
     play out a state-action pair
@@ -60,7 +123,7 @@ def play_state(
     data['alignment successful'] = False
     
     # some analysis on state and action
-    client_stage, client_tom, therapist_tom, contextual_instruction, cost = determine_toms(state, gold_action)
+    client_stage, client_tom, therapist_tom, contextual_instruction, cost = determine_toms(state, gold_action, mode=tom_mode)
     tot_cost['tom inference'] += cost
     data['client stage'] = client_stage
     data['client tom'] = client_tom
@@ -76,36 +139,18 @@ def play_state(
     receiver = OpenaiSequencialDialogue(model=receiver_lm_name, stop=['\n'])
     sender = OpenaiSequencialDialogue(model=sender_lm_name)
     
-    receiver_initial_prompt = f'Look at the following therapist-client dialogue, predict what should the therapist say next.\n{state}\n\nStart your resposne with [therapist]: '
-    receiver_initial_response = receiver.send_user_message(receiver_initial_prompt)
+    receiver_initial_response = receiver.send_user_message(receiver_prompt(state))
     receiver.rewind()
     data['initial response'] = receiver_initial_response
     vprint('Initial response:\n'+receiver_initial_response)
     
     
     # do initialization of sender/receiver
-    sender_prompt = 'You are trying to teach a student to follow true therapist\'s motivaional interviewing behavior. '+\
-    'Here is the current scenario:\n'+\
-    state+\
-    '\n\nClient mental state seems to be: '+client_tom+\
-    '\n\nThe Student Response is: \n'+receiver_initial_response+\
-    '\nIn comparison, the true therapist response is: \n'+gold_action+\
-    '\n\nFrom our annotation, it seems like the true therapist\'s actions in order, sentence by sentence, are: '+str(gold_mi_codes)+', which is '+str(len(gold_sentences))+' sentences.'\
-    ' Analyze the current situation, and write a instruction for the student, in the format of '+\
-    'Based on the annotation, When the client ..., the therapist should ..., the therapist should not ...'+\
-    '\nWhen mention what the therapist should do, be sure to include information on how many sentence are needed and what each sentence should do.'+\
-    '\nImportant: this is not a general guideline, but should be specifically tailored to the flaw in the student response.'+\
-    'Be general, make sure your rule is generalizable across topics. For example, simple use \'bad habit\' instead of drug abuse/alcohol issue/smoking.'+\
-    ' such that we can reuse this rule for other topics in the future.'
-    
+    sender_prompt = sender_rule_prompt(state, client_tom, receiver_initial_response, gold_action, gold_mi_codes, len(gold_sentences))
     content_rule = sender.send_user_message(sender_prompt).replace('Based on the annotation, ', '')
     vprint('Sender:\n'+content_rule)
     data['rule'] = content_rule
-    receiver_improvement_prompt = f'Look at the following therapist-client dialogue, predict what should the therapist say next.\n{state}.'+\
-    f'\nFollow these guidelines when producing response:\n{content_rule}\n\nStart your resposne with [therapist]: '
-    receiver_updated_response = receiver.send_user_message(
-                receiver_improvement_prompt
-            )
+    receiver_updated_response = receiver.send_user_message(receiver_prompt(state, content_rule))
     receiver.rewind()
     vprint('Receiver:\n'+receiver_updated_response)
     
@@ -114,9 +159,7 @@ def play_state(
     loop = 0
     for i in range(max_align_loop):
         # check end condition
-        success_check = sender.send_user_message(
-            f'The student wrote a response based on your rule. {receiver_updated_response}, did the student correctly follow your guideline and replicated the true therapist? Answer yes or no first.'
-        )
+        success_check = sender.send_user_message(SUCCESS_CHECK_PROMPT.replace('@receiver_response@', receiver_updated_response))
         vprint(f'success check: {success_check}')
         if 'yes' in success_check.lower():
             data['alignment successful'] = True
@@ -126,14 +169,10 @@ def play_state(
             vprint(f'breaking alignment loop since max loop of {max_align_loop} reached')
     
         # else, improve
-        content_rule = sender.send_user_message('Then update your instruction to better guide the student.').replace('Based on the annotation, ', '')
+        content_rule = sender.send_user_message(UPDATE_RULE_PROMPT).replace('Based on the annotation, ', '')
         data['rule'] = content_rule
         vprint('Sender:\n'+content_rule)
-        receiver_improvement_prompt = f'Look at the following therapist-client dialogue, predict what should the therapist say next.\n{state}.'+\
-        f'\nFollow these guidelines when producing response:\n{content_rule}\n\nStart your resposne with [therapist]: '
-        receiver_updated_response = receiver.send_user_message(
-                    receiver_improvement_prompt
-                )
+        receiver_updated_response = receiver.send_user_message(receiver_prompt(state, content_rule))
         receiver.rewind()
         vprint('Receiver:\n'+receiver_updated_response)
 
@@ -151,69 +190,260 @@ def play_state(
 
     return data
 
+# chat format overhead (role, separators) per message, and for priming the reply
+MESSAGE_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+def conversation_cost_bound(model, messages, max_reply_tokens):
+    """
+    upper bound on the cost of sending messages one after the other on one conversation
+    (every earlier message and reply is part of the next prompt, every reply max_reply_tokens long).
+    a message is a list of texts and token counts (for replies not known yet), concatenated
+    """
+    num_prompt_tokens = 0
+    history_tokens = 0
+    for message in messages:
+        # +1 per piece, a concatenation can tokenize a bit differently than its parts
+        history_tokens += MESSAGE_TOKENS+sum([
+            (piece if isinstance(piece, int) else count_tokens(piece, model))+1 for piece in message
+        ])
+        num_prompt_tokens += history_tokens+REPLY_PRIMING_TOKENS
+        history_tokens += MESSAGE_TOKENS+max_reply_tokens
+    return estimate_cost(model, num_prompt_tokens, len(messages)*max_reply_tokens)
+
+def estimate_play_state_cost(
+    state,
+    gold_action,
+    max_align_loop = 3,
+    sender_lm_name = 'gpt-3.5-turbo-1106',
+    receiver_lm_name = 'gpt-3.5-turbo-1106',
+    tom_mode = 'multi_turn',
+    adjudication = 'per_sentence',
+    max_response_tokens = 256
+):
+    """
+    upper bound on what play_state costs, built from its actual prompts: every fallback taken,
+    every gold sentence sent to the llm, every alignment loop used, every reply of max length.
+    tokens are counted with tiktoken, or as utf-8 bytes (never fewer) if it is not installed
+    """
+    R = max_response_tokens
+    tom_lm_name = annotate_lm_name = 'gpt-3.5-turbo-1106'
+
+    # tom inference, single mode falls back to multi-turn on an invalid reply
+    tom_cost = conversation_cost_bound(tom_lm_name, [
+        [STAGES_OF_CHANGE_PROMPT.replace('@snippet@', state)],
+        [fine_grained_tom_prompt(client_last_utterance(state))],
+        [THERAPIST_BEHAVIOR_PROMPT.replace('@therapist_response@', gold_action)],
+        [CONTEXTUAL_INSTRUCTION_PROMPT]
+    ], R)
+    client_tom_tokens = R
+    if tom_mode == 'single':
+        tom_cost += conversation_cost_bound(
+            tom_lm_name, [[single_request_tom_prompt(state, gold_action)[0]]], SINGLE_REQUEST_TOM_MAX_TOKENS
+        )
+        client_tom_tokens = SINGLE_REQUEST_TOM_MAX_TOKENS
+
+    # dialogue act adjudication of every gold sentence, per turn adjudication falls back to per sentence
+    from nltk import sent_tokenize
+    gold_sentences = sent_tokenize(gold_action)
+    longest_labels = str(sorted(MI_LABELS, key=len, reverse=True)[:5])
+    snippet = state+'\n'+gold_action
+    annotate_cost = sum([
+        conversation_cost_bound(annotate_lm_name, [[
+            CLASSIFY_ACTION_PROMPT.replace('@snippet@', snippet).replace('@sentence@', sentence).replace(
+                '@classifier_decision@', ' likely one of '+longest_labels+' ')
+        ]], R)
+        for sentence in gold_sentences
+    ])
+    if adjudication == 'per_turn' and len(gold_sentences) > 1:
+        sentences_text = '\n'.join([f'    {i+1}. "{sent}": likely one of {longest_labels}' for i, sent in enumerate(gold_sentences)])
+        annotate_cost += conversation_cost_bound(annotate_lm_name, [[
+            CLASSIFY_TURN_ACTIONS_PROMPT.replace('@snippet@', snippet).replace(
+                '@num_sentences@', str(len(gold_sentences))).replace('@sentences@', sentences_text)
+        ]], R)
+    # an adjudicated label is the llm reply itself
+    gold_mi_codes_tokens = len(gold_sentences)*(R+4)+2
+
+    # receiver is rewound after each request: the first one without a rule, then one per rule
+    receiver_cost = conversation_cost_bound(receiver_lm_name, [[receiver_prompt(state)]], R)+\
+        (1+max_align_loop)*conversation_cost_bound(receiver_lm_name, [[receiver_prompt(state, ''), R]], R)
+
+    # sender keeps its history: the rule request, then a check and an update per alignment loop
+    sender_messages = [[
+        sender_rule_prompt(state, '', '', gold_action, '', len(gold_sentences)), 
+        client_tom_tokens, R, gold_mi_codes_tokens
+    ]]
+    for _ in range(max_align_loop):
+        sender_messages.append([SUCCESS_CHECK_PROMPT.replace('@receiver_response@', ''), R])
+        sender_messages.append([UPDATE_RULE_PROMPT])
+    sender_cost = conversation_cost_bound(sender_lm_name, sender_messages, R)
+
+    return tom_cost+annotate_cost+receiver_cost+sender_cost
+
 def main(args):
 
     # building training data
-    training_data = pd.read_csv(args.data_path)
+    training_data = AnnoMIDataset(args.data_path)
     training_dialogue_ids = list(pd.read_csv(args.index_dir)['id'])
 
-    sessions_to_play = []
-    for i in training_dialogue_ids:
-        sessions_to_play.append(Session(display_annomi_dialogue(training_data, i)))
+    sessions_to_play = training_data.sessions(training_dialogue_ids)
         
     print('successfully built a bunch of sessions: ', len(sessions_to_play))
     print(f'using {args.num_dialogues_to_use}')
-    sessions_to_play = sessions_to_play[args.begin_dialogue_position:args.begin_dialogue_position+args.num_dialogues_to_use]
+    dialogue_range = slice(args.begin_dialogue_position, args.begin_dialogue_position+args.num_dialogues_to_use)
+    sessions_to_play = sessions_to_play[dialogue_range]
+    session_ids = training_dialogue_ids[dialogue_range]
 
-    all_train_states = []
-    all_train_gold_actions = []
+    # dialogue act classifier 
+    escalation_config = dict()
+    if args.escalation_config is not None:
+        with open(args.escalation_config) as ifp:
+            escalation_config = json.load(ifp)
+    dialog_act_classifier = DialogueActClassifier(
+        classifier_backend=args.classifier_backend, 
+        adjudication=args.adjudication,
+        escalation_threshold=escalation_config.get('threshold'),
+        escalation_margin=escalation_config.get('margin', 0.0),
+        label_thresholds=escalation_config.get('label_thresholds')
+    )
 
-    for session in sessions_to_play:
-        session_states = []
-        session_gold_actions = []
-        
-        session.state_tracker = 3
-        session.skip_to_next_utt_by('therapist')
-        try:
-            while True:
-                state, gold_action = session.state(), session.gold_action()
-                if len(session.gold_action()) > 35:
-                    session_states.append(state)
-                    session_gold_actions.append(gold_action)
-                session.skip_to_next_utt_by('therapist')
-        except IndexError:
-            all_train_states.append(session_states)
-            all_train_gold_actions.append(session_gold_actions)
-
-    all_train_states = flatten(all_train_states)
-    all_train_gold_actions = flatten(all_train_gold_actions)
-    print('num state and actions: ', len(all_train_states))
+    default_retry_policy.max_retry_time = args.max_retry_time
+    set_llm_backend(build_backend(args.llm_backend, args.llm_traffic_path, args.mock_latency))
 
-    # dialogue act classifier 
-    dialog_act_classifier = DialogueActClassifier()
+    # reuse TOMs inferred in training or previous runs
+    tom_store = None
+    if args.tom_store_path is not None:
+        tom_store = TomStore(args.tom_store_path)
+        set_tom_store(tom_store)
 
-    # start training
-    total_cost = 0
-    num_state_action_pairs = len(all_train_states)
-    play_outcomes = []
-    for i in tqdm(list(range(num_state_action_pairs))):
-        cur_state = all_train_states[i]
-        cur_gold_action = all_train_gold_actions[i] 
-        play_result = play_state(
-            cur_state, 
-            cur_gold_action, 
-            dialog_act_classifier = dialog_act_classifier,
-            max_align_loop = args.max_align_loop,
-            sender_lm_name = args.sender_lm_name,
-            receiver_lm_name = args.receiver_lm_name
+    # reuse responses of deterministic requests from previous runs
+    llm_cache = None
+    if args.llm_cache_path is not None:
+        llm_cache = LLMResponseCache(args.llm_cache_path, max_size_bytes=args.llm_cache_max_mb*1024**2)
+        set_llm_cache(llm_cache)
+
+    # run many state-action pairs at once, requests share one scheduler
+    engine = None
+    if args.concurrency > 1:
+        engine = LLMEngine(RequestScheduler(
+            max_concurrency=args.concurrency,
+            default_rate_limit={'rpm':args.max_requests_per_minute, 'tpm':args.max_tokens_per_minute}
+        ))
+        set_llm_engine(engine)
+
+    if args.num_shards > 1:
+        print(f'shard {args.shard_id} of {args.num_shards}, merge the memory shards with merge_memory.py')
+
+    # every outcome is journaled as it completes, --resume skips those already done
+    journal_path = args.journal_path or args.output_csv_file+'.journal.jsonl'
+    journal = ResultJournal(journal_path, resume=args.resume)
+    print(f'journal: {journal_path}, {len(journal)} state-action pairs already done')
+
+    # every pair reserves its worst-case cost before it is scheduled, on the first models (main, then fallback)
+    # that can still fit under --max_cost, scheduling stops once none can
+    budget = CostBudget(args.max_cost)
+    lm_names = [(args.sender_lm_name, args.receiver_lm_name)]
+    if args.fallback_lm_name is not None:
+        lm_names.append((args.fallback_lm_name, args.fallback_lm_name))
+    def reserve(state, gold_action):
+        estimated_costs = [
+            estimate_play_state_cost(
+                state, 
+                gold_action, 
+                max_align_loop = args.max_align_loop,
+                sender_lm_name = sender_lm_name,
+                receiver_lm_name = receiver_lm_name,
+                tom_mode = args.tom_mode,
+                adjudication = args.adjudication
             )
-        play_outcomes.append(play_result)
+            for sender_lm_name, receiver_lm_name in lm_names
+        ]
+        choice = budget.reserve_first(estimated_costs)
+        if choice is None:
+            return None
+        if choice > 0:
+            print(f'projected cost {budget.projected()} close to max cost {args.max_cost}, using {lm_names[choice]} for this state-action pair')
+        return lm_names[choice]+(estimated_costs[choice],)
+
+    # start training, state-action pairs are extracted lazily as workers free up
+    total_cost = 0
+    num_played = 0
+    result_ids = []
+    def unfinished_state_actions():
+        for session_id, turn_index, state, gold_action in iter_state_actions(
+            sessions_to_play, 
+            session_ids = session_ids, 
+            min_action_length = args.min_action_length, 
+            max_prev_turns = args.max_prev_turns
+        ):
+            result_id = state_action_id(session_id, turn_index, state, gold_action)
+            if shard_of(result_id, args.num_shards) != args.shard_id:
+                continue
+            result_ids.append(result_id)
+            if result_id in journal:
+                continue
+            reservation = reserve(state, gold_action)
+            if reservation is None:
+                print(f'max cost {args.max_cost} reached, not scheduling any more state-action pairs (rerun with --resume to continue)')
+                return
+            yield (result_id, session_id, turn_index, state, gold_action)+reservation
+
+    def play(state_action):
+        result_id, session_id, turn_index, state, gold_action, sender_lm_name, receiver_lm_name, estimated_cost = state_action
+        # settle with what was billed (cached responses are free), even if play_state fails
+        with BilledCostMeter() as billed:
+            try:
+                play_result = play_state(
+                    state, 
+                    gold_action, 
+                    dialog_act_classifier = dialog_act_classifier,
+                    max_align_loop = args.max_align_loop,
+                    sender_lm_name = sender_lm_name,
+                    receiver_lm_name = receiver_lm_name,
+                    tom_mode = args.tom_mode
+                    )
+            finally:
+                budget.settle(estimated_cost, billed.total)
+        play_result['billed cost'] = billed.total
+        play_result['state action id'] = result_id
+        play_result['transcript id'] = session_id
+        play_result['turn index'] = turn_index
+        journal.append(result_id, play_result)
+        return play_result
+
+    for play_result in ordered_parallel_map(play, unfinished_state_actions(), concurrency=args.concurrency):
+        num_played += 1
         total_cost += play_result['cost']
         print(f'Total Cost So Far: {total_cost}')
 
-    # saving
+    if engine is not None:
+        set_llm_engine(None)
+        engine.close()
+    print('Retry metrics: ', default_retry_policy.metrics.snapshot())
+    if tom_store is not None:
+        print('TOM store: ', tom_store.stats())
+        set_tom_store(None)
+        tom_store.close()
+    if llm_cache is not None:
+        print('LLM response cache: ', llm_cache.stats())
+        set_llm_cache(None)
+        llm_cache.close()
+
+    print(f'Dialogue act escalation rate: {dialog_act_classifier.escalation_rate()}')
+    print('Cost budget: ', budget.stats())
+
+    print('num state and actions: ', len(result_ids), ', played in this run: ', num_played)
+
+    # saving, compacts the journal into the memory file
+    play_outcomes = journal.compact(result_ids)
     pd.DataFrame(play_outcomes).to_csv(args.output_csv_file)
 
+    # precompute the retrieval embeddings, so inference does not have to
+    if args.memory_bundle_dir is not None:
+        training_memory = pd.read_csv(args.output_csv_file, index_col=0)
+        sentence_encoder = build_sentence_encoder(args.encoder_name, cache_dir=args.embedding_cache_dir)
+        sync_memory_bundle(args.memory_bundle_dir, training_memory, sentence_encoder, args.encoder_name)
+
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Training the Agent')
@@ -227,13 +457,68 @@ if __name__ == '__main__':
                         help='openai name of the sender lm')
     parser.add_argument('--receiver_lm_name', type=str, default='gpt-3.5-turbo-1106',
                         help='openai name of the receiver lm')
-    parser.add_argument('--max_align_loop', type=str, default=3,
+    parser.add_argument('--max_align_loop', type=int, default=3,
                         help='maximum step of alignment loops to be used')
     parser.add_argument('--num_dialogues_to_use', type=int, default=5,
                         help='how many dialogue to use, if you have more than you want')
     parser.add_argument('--begin_dialogue_position', type=int, default=0,
                         help='where to begin, e.g. if you set this to 5, your dialogues use will be [5:5+num_dialogues_to_use]')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='how many state-action pairs to play at the same time')
+    parser.add_argument('--max_requests_per_minute', type=int, default=None,
+                        help='per-model request budget when running concurrently')
+    parser.add_argument('--max_tokens_per_minute', type=int, default=None,
+                        help='per-model token budget when running concurrently')
+    parser.add_argument('--llm_cache_path', type=str, default=None,
+                        help='sqlite file to cache llm responses in, no caching if not set')
+    parser.add_argument('--llm_cache_max_mb', type=int, default=1024,
+                        help='size limit of the llm response cache, least recently used entries are evicted first')
+    parser.add_argument('--max_retry_time', type=float, default=600,
+                        help='give up on a request after retrying it for this many seconds')
+    parser.add_argument('--llm_backend', type=str, default='openai', choices=['openai', 'mock', 'record', 'replay'],
+                        help='where llm requests go, mock/replay run without network (e.g. for benchmarking)')
+    parser.add_argument('--llm_traffic_path', type=str, default=None,
+                        help='jsonl file the record backend writes to and the replay backend reads from')
+    parser.add_argument('--mock_latency', type=float, default=0.0,
+                        help='mean latency in seconds of the mock backend')
+    parser.add_argument('--classifier_backend', type=str, default='torch', choices=['torch', 'torch-int8', 'onnx', 'onnx-int8'],
+                        help='how to run the dialogue act classifier, the int8/onnx backends are for cpu-only machines')
+    parser.add_argument('--adjudication', type=str, default='per_sentence', choices=['per_sentence', 'per_turn'],
+                        help='ask the llm for dialogue act labels once per sentence, or once per turn')
+    parser.add_argument('--escalation_config', type=str, default=None,
+                        help='json from calibrate_escalation.py, only ask the llm about sentences the classifier is unsure of')
+    parser.add_argument('--tom_mode', type=str, default='multi_turn', choices=['multi_turn', 'single'],
+                        help='infer the TOM fields with one request per field (the original prompts), or all in one cheaper json request')
+    parser.add_argument('--tom_store_path', type=str, default=None,
+                        help='sqlite file of inferred TOMs shared across runs (see precompute_toms.py), not used if not set')
+    parser.add_argument('--min_action_length', type=int, default=35,
+                        help='only learn from therapist turns longer than this many characters')
+    parser.add_argument('--max_prev_turns', type=int, default=4,
+                        help='how many previous turns make up the dialogue state')
+    parser.add_argument('--max_cost', type=float, default=None,
+                        help='stop scheduling state-action pairs once their projected cost would pass this many dollars, no cap if not set')
+    parser.add_argument('--fallback_lm_name', type=str, default=None,
+                        help='cheaper sender/receiver lm to switch to, instead of stopping, when --max_cost is about to be reached')
+    parser.add_argument('--memory_bundle_dir', type=str, default=None,
+                        help='also write the memory with its retrieval embeddings here, pass it to inference.py --memory_bundle_dir')
+    parser.add_argument('--encoder_name', type=str, default='all-MiniLM-L6-v2',
+                        help='sentence-transformers model used to retrieve rules by client tom')
+    parser.add_argument('--embedding_cache_dir', type=str, default=None,
+                        help='persistent cache of sentence embeddings, only texts not seen before are encoded, no caching if not set')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='split the state-action pairs across this many workers (e.g. machines), by a stable hash of the pair')
+    parser.add_argument('--shard_id', type=int, default=0,
+                        help='which shard this worker plays, in [0, num_shards)')
+    parser.add_argument('--journal_path', type=str, default=None,
+                        help='jsonl file each outcome is appended to as it completes, defaults to output_csv_file + .journal.jsonl')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue a crashed or killed run, state-action pairs already in the journal are not played again '+\
+                        '(without it, a run stops rather than overwrite a journal with results)')
     args = parser.parse_args()
+    if args.num_shards < 1:
+        parser.error(f'--num_shards must be at least 1, got {args.num_shards}')
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error(f'--shard_id must be in [0, {args.num_shards}), got {args.shard_id}')
     print(args)
     main(args)
     
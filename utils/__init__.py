@@ -1,5 +1,76 @@
-from .assets import OPENAI_API_KEY, annomi_classifier_path
-from .dialogueact_classifier import DialogueActClassifier
-from .openai_dialogue import OpenaiSequencialDialogue
-from .annomi_utils import display_annomi_dialogue
-from .session import assemble_dialogue_turns, is_simple_acknowledgement, Session
\ No newline at end of file
+"""
+building blocks, imported lazily: `from utils import X` only loads the submodule X comes from,
+so e.g. torch is not imported by code that never builds a dialogue act classifier
+"""
+import importlib
+
+_EXPORTS = {
+    'OPENAI_API_KEY': 'assets',
+    'annomi_classifier_path': 'assets',
+    'DialogueActClassifier': 'dialogueact_classifier',
+    'calibrate_escalation_thresholds': 'dialogueact_classifier',
+    'OpenaiSequencialDialogue': 'openai_dialogue',
+    'set_llm_engine': 'openai_dialogue',
+    'set_llm_cache': 'openai_dialogue',
+    'set_llm_backend': 'openai_dialogue',
+    'estimate_cost': 'openai_dialogue',
+    'count_tokens': 'openai_dialogue',
+    'BilledCostMeter': 'openai_dialogue',
+    'OpenAIBackend': 'llm_backends',
+    'MockBackend': 'llm_backends',
+    'RecordReplayBackend': 'llm_backends',
+    'serve_backend': 'llm_backends',
+    'build_backend': 'llm_backends',
+    'LLMResponseCache': 'llm_cache',
+    'RetryPolicy': 'retry_policy',
+    'default_retry_policy': 'retry_policy',
+    'BatchCollector': 'batch_api',
+    'PendingBatchRequest': 'batch_api',
+    'run_batch_round': 'batch_api',
+    'num_batch_rounds': 'batch_api',
+    'RequestScheduler': 'async_dialogue',
+    'LLMEngine': 'async_dialogue',
+    'ordered_parallel_map': 'async_dialogue',
+    'display_annomi_dialogue': 'annomi_utils',
+    'AnnoMIDataset': 'annomi_utils',
+    'assemble_dialogue_turns': 'session',
+    'is_simple_acknowledgement': 'session',
+    'Session': 'session',
+    'iter_state_actions': 'session',
+    'parse_json_object': 'structured_output',
+    'validate_fields': 'structured_output',
+    'parse_prediction': 'structured_output',
+    'TomStore': 'tom_store',
+    'set_tom_store': 'tom_store',
+    'get_tom_store': 'tom_store',
+    'ResultJournal': 'journal',
+    'state_action_id': 'journal',
+    'shard_of': 'journal',
+    'CostBudget': 'cost_budget',
+    'cluster_near_duplicates': 'memory_compaction',
+    'compact_memory': 'memory_compaction',
+    'MemoryBundle': 'memory_bundle',
+    'sync_memory_bundle': 'memory_bundle',
+    'GPTReranker': 'rerankers',
+    'CrossEncoderReranker': 'rerankers',
+    'HybridReranker': 'rerankers',
+    'build_reranker': 'rerankers',
+    'Stage': 'pipeline',
+    'Pipeline': 'pipeline',
+    'CachedSentenceEncoder': 'embedding_cache',
+    'build_sentence_encoder': 'embedding_cache',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module('.'+_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
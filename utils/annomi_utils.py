@@ -1,6 +1,22 @@
+import hashlib
+import os
+import pickle
+
+import pandas as pd
+
+from .session import Session
+
+
 def display_annomi_dialogue(annomi_dataset, dialogue_id, turn_sep='\n',max_num_turns=100):
     dialogue_turns = annomi_dataset[annomi_dataset['transcript_id'] == dialogue_id].drop_duplicates(subset='timestamp').to_dict('records')
     dialogue_turns = sorted(dialogue_turns, key=lambda x:x['timestamp'])
+    return assemble_annomi_dialogue(dialogue_turns, turn_sep=turn_sep, max_num_turns=max_num_turns)
+
+
+def assemble_annomi_dialogue(dialogue_turns, turn_sep='\n',max_num_turns=100):
+    """
+    dialogue_turns: AnnoMI rows of one transcript, deduplicated and sorted by timestamp
+    """
     topic = dialogue_turns[0]['topic']
     output = """"""
     num_turns_sofar = 0
@@ -34,4 +50,76 @@ def display_annomi_dialogue(annomi_dataset, dialogue_id, turn_sep='\n',max_num_t
         turns.append({'role':role, 'utterance':utt})
     
             
-    return {'topic':topic, 'turns':turns}
\ No newline at end of file
+    return {'topic':topic, 'turns':turns}
+
+
+class AnnoMIDataset:
+
+    """
+    AnnoMI csv parsed once and indexed by transcript id.
+
+    Rows are grouped by transcript in a single pass, the parsed dialogues are cached
+    in a pickle keyed by the csv's hash so later startups skip parsing altogether.
+    dataset[transcript_id] gives a fresh Session, same as Session(display_annomi_dialogue(df, transcript_id)).
+    """
+
+    columns = ['transcript_id', 'timestamp', 'interlocutor', 'utterance_text', 'topic']
+
+    def __init__(self, csv_path, cache_dir=None, use_cache=True, turn_sep='\n', max_num_turns=100):
+        self.csv_path = csv_path
+        self.turn_sep = turn_sep
+        self.max_num_turns = max_num_turns
+        with open(csv_path, 'rb') as ifp:
+            csv_hash = hashlib.sha256(ifp.read()).hexdigest()[:16]
+        cache_dir = cache_dir if cache_dir is not None else os.path.dirname(os.path.abspath(csv_path))
+        self.cache_path = os.path.join(
+            cache_dir, 
+            f'.{os.path.basename(csv_path)}.{csv_hash}.{max_num_turns}.sessions.pkl'
+        )
+
+        if use_cache and os.path.exists(self.cache_path):
+            with open(self.cache_path, 'rb') as ifp:
+                self.dialogues = pickle.load(ifp)
+        else:
+            self.dialogues = self._parse(pd.read_csv(csv_path, usecols=self.columns))
+            if use_cache:
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(self.cache_path, 'wb') as ofp:
+                    pickle.dump(self.dialogues, ofp, protocol=pickle.HIGHEST_PROTOCOL)
+        self.transcript_ids = sorted(self.dialogues.keys())
+
+    def _parse(self, annomi_dataset):
+        # same deduplication as display_annomi_dialogue (first row per timestamp, in file order),
+        # then a stable sort so every transcript's turns are contiguous and in time order
+        annomi_dataset = annomi_dataset.drop_duplicates(subset=['transcript_id', 'timestamp'])
+        annomi_dataset = annomi_dataset.sort_values(['transcript_id', 'timestamp'], kind='mergesort')
+        dialogues = dict()
+        for transcript_id, rows in annomi_dataset.groupby('transcript_id', sort=False):
+            dialogues[transcript_id] = assemble_annomi_dialogue(
+                rows.to_dict('records'), 
+                turn_sep=self.turn_sep, 
+                max_num_turns=self.max_num_turns
+            )
+        return dialogues
+
+    def __len__(self):
+        return len(self.dialogues)
+
+    def __contains__(self, transcript_id):
+        return transcript_id in self.dialogues
+
+    def dialogue(self, transcript_id):
+        """
+        {'topic', 'turns'} of a transcript
+        """
+        return self.dialogues[transcript_id]
+
+    def __getitem__(self, transcript_id):
+        return Session(self.dialogues[transcript_id])
+
+    def sessions(self, transcript_ids=None):
+        """
+        fresh Sessions for the given transcript ids (all, in sorted order, by default)
+        """
+        transcript_ids = transcript_ids if transcript_ids is not None else self.transcript_ids
+        return [self[i] for i in transcript_ids]
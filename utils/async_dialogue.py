@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from tqdm import tqdm
+
+from .retry_policy import default_retry_policy
+from .llm_backends import OpenAIBackend
+
+
+def estimate_num_tokens(messages, max_tokens=0):
+    """
+    rough token count of a request (~4 characters per token), used for budgeting only
+    """
+    n_chars = sum([len(m['content'] or '') for m in messages])
+    return n_chars // 4 + max_tokens
+
+
+class TokenBucket:
+    """
+    a per-minute budget that refills continuously
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount):
+        # a single request larger than the whole budget would never fit, let it through alone
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) / self.rate)
+                self._refill()
+            self.available -= amount
+
+    def refund(self, amount):
+        """
+        give back (or, with a negative amount, take) budget once the real usage is known
+        """
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+
+class RequestScheduler:
+    """
+    Shared scheduler for concurrent requests.
+
+    Caps the number of requests in flight, and enforces requests-per-minute and
+    tokens-per-minute budgets per model.
+
+    rate_limits: {model: {'rpm': int, 'tpm': int}}, models not listed use default_rate_limit
+    """
+
+    def __init__(self, max_concurrency=8, rate_limits=None, default_rate_limit=None):
+        self.max_concurrency = max_concurrency
+        self.rate_limits = rate_limits or dict()
+        self.default_rate_limit = default_rate_limit or dict()
+        self.semaphore = None
+        self.buckets = dict()
+
+    def _buckets(self, model):
+        if model not in self.buckets:
+            limit = self.rate_limits.get(model, self.default_rate_limit)
+            self.buckets[model] = {
+                'rpm': TokenBucket(limit['rpm']) if limit.get('rpm') else None,
+                'tpm': TokenBucket(limit['tpm']) if limit.get('tpm') else None
+            }
+        return self.buckets[model]
+
+    async def run(self, model, estimated_tokens, request):
+        """
+        await request() once there is a free slot and enough budget for the model
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        buckets = self._buckets(model)
+        if buckets['rpm'] is not None:
+            await buckets['rpm'].acquire(1)
+        if buckets['tpm'] is not None:
+            await buckets['tpm'].acquire(estimated_tokens)
+        async with self.semaphore:
+            response = await request()
+        if buckets['tpm'] is not None:
+            buckets['tpm'].refund(estimated_tokens - response['usage']['total_tokens'])
+        return response
+
+
+async def acomplete_chat(request_kwargs, scheduler=None, timeout_tolerance=15, retry_policy=None, backend=None):
+    """
+    async version of OpenaiSequencialDialogue._send_request, retry until a response is received
+    (or the retry policy gives up)
+    """
+    retry_policy = retry_policy if retry_policy is not None else default_retry_policy
+    backend = backend if backend is not None else OpenAIBackend()
+    estimated_tokens = estimate_num_tokens(request_kwargs['messages'], request_kwargs['max_tokens'])
+
+    async def send_request():
+        return await backend.acomplete(request_kwargs, timeout_tolerance)
+
+    async def schedule_request():
+        if scheduler is None:
+            return await send_request()
+        return await scheduler.run(request_kwargs['model'], estimated_tokens, send_request)
+
+    try:
+        return await retry_policy.acall(request_kwargs['model'], schedule_request)
+    except openai.error.InvalidRequestError:
+        # something is wrong: e.g. prompt too long
+        print(f"InvalidRequestError\nPrompt passed in:\n\n{str(request_kwargs['messages'])}\n\n")
+        raise
+
+
+class LLMEngine:
+
+    """
+    Runs an event loop in a background thread, so blocking code (play_state, inference_state, ...)
+    running in many worker threads can share one RequestScheduler.
+
+    Install with utils.openai_dialogue.set_llm_engine, after which every
+    OpenaiSequencialDialogue request goes through the engine.
+    """
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def complete(self, request_kwargs, timeout_tolerance=15, retry_policy=None, backend=None):
+        future = asyncio.run_coroutine_threadsafe(
+            acomplete_chat(request_kwargs, self.scheduler, timeout_tolerance, retry_policy, backend),
+            self.loop
+        )
+        return future.result()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def ordered_parallel_map(fn, items, concurrency=8, disable_tqdm=False, total=None, max_pending=None):
+    """
+    apply fn to every item with up to `concurrency` worker threads,
+    yield results in the original order of items as soon as they are ready.
+
+    items may be a lazy iterable (e.g. iter_state_actions), it is only consumed
+    max_pending (default 2 x concurrency) items ahead of the results
+    """
+    if total is None and hasattr(items, '__len__'):
+        total = len(items)
+    max_pending = max_pending if max_pending is not None else 2*concurrency
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, tqdm(total=total, disable=disable_tqdm) as progress:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+                progress.update(1)
+        while pending:
+            yield pending.popleft().result()
+            progress.update(1)
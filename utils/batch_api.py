@@ -0,0 +1,109 @@
+import glob
+import json
+import os
+import threading
+
+from .llm_cache import request_key
+
+
+class PendingBatchRequest(Exception):
+    """
+    raised in place of a response when the request has been queued for the next batch
+    """
+
+
+class BatchCollector:
+
+    """
+    Offline batch-API mode, installed in place of an engine with utils.openai_dialogue.set_llm_engine.
+
+    Requests whose results were ingested are answered from them, every other request is
+    queued for export and PendingBatchRequest is raised, so a pipeline re-run after each
+    ingest advances by exactly one stage (one round of requests) per state.
+
+    custom_id is a hash of the request content, stable across re-runs.
+    """
+
+    def __init__(self, endpoint='/v1/chat/completions'):
+        self.endpoint = endpoint
+        self.results = dict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def complete(self, request_kwargs, timeout_tolerance=None, retry_policy=None, backend=None):
+        custom_id = request_key(request_kwargs)
+        if custom_id in self.results:
+            return self.results[custom_id]
+        with self.lock:
+            self.pending[custom_id] = request_kwargs
+        raise PendingBatchRequest(custom_id)
+
+    def ingest(self, results_path):
+        """
+        read a batch results JSONL, failed lines are skipped (and will be exported again)
+        """
+        num_ingested = 0
+        with open(results_path) as ifp:
+            for line in ifp:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get('response') or dict()
+                if result.get('error') is None and response.get('status_code') == 200:
+                    self.results[result['custom_id']] = response['body']
+                    num_ingested += 1
+        return num_ingested
+
+    def export(self, requests_path):
+        """
+        write all queued requests as a batch requests JSONL, returns how many were written
+        """
+        with self.lock:
+            pending = sorted(self.pending.items())
+            self.pending = dict()
+        with open(requests_path, 'w') as ofp:
+            for custom_id, request_kwargs in pending:
+                body = dict(request_kwargs)
+                body['messages'] = [{'role': m['role'], 'content': m['content']} for m in body['messages']]
+                if body.get('stop') is None:
+                    body.pop('stop', None)
+                ofp.write(json.dumps({
+                    'custom_id': custom_id,
+                    'method': 'POST',
+                    'url': self.endpoint,
+                    'body': body
+                })+'\n')
+        return len(pending)
+
+
+def num_batch_rounds(batch_dir):
+    """
+    how many rounds of requests were exported to batch_dir so far
+    """
+    return len(glob.glob(os.path.join(batch_dir, 'requests_*.jsonl')))
+
+
+def run_batch_round(batch_dir, run_pipeline):
+    """
+    one round of the offline batch pipeline:
+        1. ingest every results*.jsonl in batch_dir
+        2. call run_pipeline(collector), which should catch PendingBatchRequest per item
+        3. export the requests that are still missing to batch_dir/requests_<round>.jsonl
+
+    returns (output of run_pipeline, path of the exported requests or None when nothing is pending)
+    """
+    os.makedirs(batch_dir, exist_ok=True)
+    collector = BatchCollector()
+    for results_path in sorted(glob.glob(os.path.join(batch_dir, 'results*.jsonl'))):
+        print(f'ingested {collector.ingest(results_path)} results from {results_path}')
+
+    output = run_pipeline(collector)
+
+    if len(collector.pending) == 0:
+        return output, None
+    round_id = num_batch_rounds(batch_dir)
+    requests_path = os.path.join(batch_dir, f'requests_{round_id:03d}.jsonl')
+    num_requests = collector.export(requests_path)
+    print(f'wrote {num_requests} requests to {requests_path}, submit them to the batch api, '
+          f'save the output as {os.path.join(batch_dir, f"results_{round_id:03d}.jsonl")} and re-run')
+    return output, requests_path
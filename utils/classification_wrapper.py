@@ -2,54 +2,142 @@ import torch
 from transformers import AutoModelForSequenceClassification, AutoTokenizer
 from tqdm import tqdm
 import joblib
+import hashlib
 import os
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    """https://stackoverflow.com/questions/312443/how-do-i-split-a-list-into-equally-sized-chunks"""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+def default_num_threads():
+    """
+    number of cpus this process may actually use (respects affinity / container limits)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_onnx_dir(model_name_or_path):
+    """
+    writable cache directory for the onnx export of a model (hub id or local directory),
+    under $XDG_CACHE_HOME (~/.cache by default). A local model gets a new one whenever its config changes
+    """
+    key = model_name_or_path
+    if os.path.isdir(model_name_or_path):
+        key = os.path.abspath(model_name_or_path)
+        config_path = os.path.join(key, 'config.json')
+        if os.path.exists(config_path):
+            key += f'@{os.path.getmtime(config_path)}'
+    name = os.path.basename(model_name_or_path.rstrip('/'))+'-'+hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+    cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_root, 'diir', 'onnx', name)
 
 
 class ClassificationWrapper:
+
+    """
+    Batched inference with a huggingface sequence classifier.
+
+    backend:
+        'torch': the fp32 model, on cuda if available
+        'torch-int8': dynamically int8-quantized linear layers, cpu only
+        'onnx': exported onnx model run by onnxruntime, cpu only
+        'onnx-int8': the onnx model with dynamically int8-quantized weights, cpu only
+    The onnx export is cached in onnx_dir (defaults to a per-model directory, see default_onnx_dir).
+    """
+
+    backends = ('torch', 'torch-int8', 'onnx', 'onnx-int8')
     
     def __init__(
         self, 
         model_name_or_path,
-        device='cuda:0', 
-        max_length=148
+        device=None, 
+        max_length=148,
+        backend='torch',
+        num_threads=None,
+        onnx_dir=None
     ):
+        if backend not in self.backends:
+            raise ValueError(f'backend must be one of {self.backends}, got {backend}')
+        if device is None:
+            device = 'cuda:0' if backend == 'torch' and torch.cuda.is_available() else 'cpu'
         self.device = device
+        self.backend = backend
         self.max_length = max_length
+        self.num_threads = num_threads if num_threads is not None else default_num_threads()
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
         self.model = AutoModelForSequenceClassification.from_pretrained(model_name_or_path)
         self.model.eval()
+        if device == 'cpu':
+            torch.set_num_threads(self.num_threads)
+        if backend == 'torch-int8':
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend in ('onnx', 'onnx-int8'):
+            self.onnx_session = self._onnx_session(
+                onnx_dir if onnx_dir is not None else default_onnx_dir(model_name_or_path), 
+                quantize = backend == 'onnx-int8'
+            )
         self.model.to(device)
         try:
             self.label_encoder = joblib.load(os.path.join(model_name_or_path, 'label_encoder.joblib'))
         except:
             self.label_encoder = None
             print('could not found label mapping, returning numerical predictions')
+
+    def _onnx_session(self, onnx_dir, quantize=False):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('the onnx backends need onnxruntime, pip install onnxruntime')
+        os.makedirs(onnx_dir, exist_ok=True)
+        onnx_path = os.path.join(onnx_dir, 'model.onnx')
+        if not os.path.exists(onnx_path):
+            dummy = self.tokenizer(['hello world'], return_tensors='pt')
+            input_names = list(dummy.keys())
+            # written then renamed, an interrupted export is never picked up later
+            torch.onnx.export(
+                self.model,
+                tuple(dummy[k] for k in input_names),
+                onnx_path+'.tmp',
+                input_names=input_names,
+                output_names=['logits'],
+                dynamic_axes={**{k:{0:'batch', 1:'sequence'} for k in input_names}, 'logits':{0:'batch'}},
+                opset_version=14
+            )
+            os.replace(onnx_path+'.tmp', onnx_path)
+        if quantize:
+            quantized_path = os.path.join(onnx_dir, 'model.int8.onnx')
+            if not os.path.exists(quantized_path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                quantize_dynamic(onnx_path, quantized_path+'.tmp', weight_type=QuantType.QInt8)
+                os.replace(quantized_path+'.tmp', quantized_path)
+            onnx_path = quantized_path
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.num_threads
+        return onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+
+    def _logits(self, encoded_src):
+        if self.backend in ('onnx', 'onnx-int8'):
+            input_names = [i.name for i in self.onnx_session.get_inputs()]
+            logits = self.onnx_session.run(['logits'], {k:encoded_src[k].cpu().numpy() for k in input_names})[0]
+            return torch.from_numpy(logits)
+        return self.model(**encoded_src).logits
         
-    def _extract(self, raw_inp, return_type):
-        
-        inp = raw_inp
-            
+    def _extract(self, features, raw_inp, return_type):
+        """
+        one forward pass over a batch of pre-tokenized inputs, 
+        returns predictions in the same order as raw_inp (duplicates included)
+        """
         with torch.no_grad():
-            encoded_src = self.tokenizer(
-                inp, 
-                max_length=self.max_length,
-                truncation=True,
-                padding=True,
+            encoded_src = self.tokenizer.pad(
+                features,
                 return_tensors='pt'
             ).to(self.device)
             
-            model_output = self.model(**encoded_src).logits
+            logits = self._logits(encoded_src)
             
             if return_type == 'label':
-                output = torch.argmax(self.model(**encoded_src).logits, dim=-1).cpu().numpy()
+                output = torch.argmax(logits, dim=-1).cpu().numpy()
             elif return_type == 'class proba':
-                output = torch.nn.functional.softmax(self.model(**encoded_src).logits, dim=-1).cpu().numpy()
+                output = torch.nn.functional.softmax(logits, dim=-1).cpu().numpy()
             else:
                 raise TypeError(
                     f'return type must be one of "label" or "class proba", got {return_type}'
@@ -57,28 +145,49 @@ class ClassificationWrapper:
         
         if self.label_encoder is not None:
             if return_type == 'label':
-                output_dict = [{'input':k, 'predicted':self.label_encoder.inverse_transform([v])[0]} 
-                               for k,v in dict(zip(raw_inp, output)).items()]
+                output_dict = [{'input':k, 'predicted':v} 
+                               for k,v in zip(raw_inp, self.label_encoder.inverse_transform(output))]
             else:
                 output_dict = [{'input':k, 'predicted':dict(zip(self.label_encoder.classes_, v))} 
-                               for k,v in dict(zip(raw_inp, output)).items()]
+                               for k,v in zip(raw_inp, output)]
         else:
-            output_dict = [{'input':k, 'predicted':v} for k,v in dict(zip(raw_inp, output)).items()]
+            output_dict = [{'input':k, 'predicted':v} for k,v in zip(raw_inp, output)]
         
         return output_dict
+
+    def _length_bucketed_batches(self, lengths, batch_size, max_batch_tokens):
+        """
+        sort inputs by length and cut them into batches whose padded size 
+        (num items x longest item) stays within max_batch_tokens, 
+        yields lists of positions in the original input
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        batch = []
+        for i in order:
+            # sorted ascending, so the item being added is the longest in the batch
+            too_many_tokens = max_batch_tokens is not None and (len(batch)+1) * lengths[i] > max_batch_tokens
+            too_many_items = batch_size is not None and len(batch) >= batch_size
+            if batch and (too_many_tokens or too_many_items):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
     
     def __call__(self, 
                  sentence, 
-                 batch_size=4, 
+                 batch_size=None, 
                  disable_tqdm=False, 
                  on_error='raise',
-                 return_type = 'label'
+                 return_type = 'label',
+                 max_batch_tokens=4096
                 ):
         """
         sentence: Union[List, String]
-        batch_size: int
+        batch_size: int, optional cap on the number of sentences per batch
         distable_tqdm: bool
         on_error: string in {'raise', 'echo', 'nothing'}
+        max_batch_tokens: int, token budget of a (padded) batch, inputs of similar length are batched together
         """
         assert on_error in {'raise', 'echo', 'nothing'}
         if type(sentence) not in (list, str):
@@ -87,13 +196,29 @@ class ClassificationWrapper:
             raw_inp = [sentence]
         else:
             raw_inp = sentence
-            
-        batches = list(chunks(raw_inp, batch_size))
-        outputs = []
+        if len(raw_inp) == 0:
+            return []
+        
+        # tokenize once, padding happens per batch
+        encoded = self.tokenizer(
+            raw_inp,
+            max_length=self.max_length,
+            truncation=True
+        )
+        features = [{k:encoded[k][i] for k in encoded.keys()} for i in range(len(raw_inp))]
+        lengths = [len(f['input_ids']) for f in features]
+        batches = list(self._length_bucketed_batches(lengths, batch_size, max_batch_tokens))
+        outputs = [None] * len(raw_inp)
         
         for batch in tqdm(batches, disable=disable_tqdm):
             try:
-                outputs += self._extract(batch, return_type = return_type)
+                batch_outputs = self._extract(
+                    [features[i] for i in batch], 
+                    [raw_inp[i] for i in batch], 
+                    return_type = return_type
+                )
+                for i, o in zip(batch, batch_outputs):
+                    outputs[i] = o
             except KeyboardInterrupt:
                 raise
             except Exception as e:
@@ -102,11 +227,65 @@ class ClassificationWrapper:
                 elif on_error == 'echo':
                     print('---')
                     print('Classification Wrapper: oops broken batch, sorry...')
-                    print(batch)
+                    print([raw_inp[i] for i in batch])
                     print(e)
                     print('---')
                 raise e
             
         if type(sentence) == str:
             return outputs[0]
-        return outputs
\ No newline at end of file
+        return outputs
+
+
+def benchmark_backends(
+    model_name_or_path, 
+    sentences, 
+    backends=('torch', 'torch-int8', 'onnx', 'onnx-int8'),
+    device='cpu',
+    num_threads=None
+):
+    """
+    latency of each backend and how often it agrees with the fp32 torch model on sentences
+    """
+    import time
+    results = []
+    reference = None
+    for backend in ('torch',)+tuple(b for b in backends if b != 'torch'):
+        classifier = ClassificationWrapper(
+            model_name_or_path, 
+            device=device if backend == 'torch' else 'cpu', 
+            backend=backend, 
+            num_threads=num_threads
+        )
+        # warm up (and export, for onnx) before timing
+        classifier(sentences[:8], disable_tqdm=True)
+        start = time.perf_counter()
+        predictions = [o['predicted'] for o in classifier(sentences, disable_tqdm=True)]
+        elapsed = time.perf_counter() - start
+        if reference is None:
+            reference = predictions
+        if backend in backends:
+            results.append({
+                'backend':backend,
+                'ms per sentence':1000*elapsed/len(sentences),
+                'agreement with fp32':sum([p == r for p, r in zip(predictions, reference)])/len(sentences)
+            })
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(description='Benchmark classifier backends on AnnoMI therapist sentences')
+    parser.add_argument('--model_name_or_path', type=str, required=True,
+                        help='path to the huggingface dialogue act classifier')
+    parser.add_argument('--data_path', type=str, default='AnnoMI/test.csv',
+                        help='AnnoMI csv to take therapist utterances from')
+    parser.add_argument('--num_sentences', type=int, default=500,
+                        help='how many utterances to benchmark on')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='cpu threads, defaults to all cpus available to this process')
+    args = parser.parse_args()
+    data = pd.read_csv(args.data_path)
+    sentences = list(data[data['interlocutor'] == 'therapist']['utterance_text'].dropna().astype(str))[:args.num_sentences]
+    print(pd.DataFrame(benchmark_backends(args.model_name_or_path, sentences, num_threads=args.num_threads)))
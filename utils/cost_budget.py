@@ -0,0 +1,72 @@
+import threading
+
+
+class CostBudget:
+
+    """
+    Spending cap shared by concurrent workers.
+
+    Work reserves its estimated (upper bound) cost before it is scheduled and settles with
+    the actual cost once done, so actual spend plus outstanding reservations never passes max_cost.
+    max_cost=None means no cap (spend is still tracked).
+    Safe to share across threads.
+    """
+
+    def __init__(self, max_cost=None):
+        self.max_cost = max_cost
+        self.spent = 0
+        self.reserved = 0
+        self.num_rejected = 0
+        self.lock = threading.Lock()
+        self.settled = threading.Condition(self.lock)
+
+    def try_reserve(self, amount):
+        """
+        reserve amount if it fits in what is left of the budget, returns whether it did
+        """
+        with self.lock:
+            if self.max_cost is not None and self.spent+self.reserved+amount > self.max_cost:
+                self.num_rejected += 1
+                return False
+            self.reserved += amount
+            return True
+
+    def reserve_first(self, amounts):
+        """
+        reserve the first of amounts (in order of preference, e.g. the same work on cheaper models)
+        that can still fit, returns its index, None if none of them can anymore.
+        waits for outstanding reservations to settle while the preferred amount could still fit
+        """
+        with self.lock:
+            for i, amount in enumerate(amounts):
+                while self.max_cost is not None and self.spent+self.reserved+amount > self.max_cost:
+                    if self.spent+amount > self.max_cost:
+                        break
+                    self.settled.wait()
+                else:
+                    self.reserved += amount
+                    return i
+            self.num_rejected += 1
+            return None
+
+    def settle(self, reserved_amount, actual_cost):
+        """
+        replace a reservation with what the work actually cost (also when it failed half-way)
+        """
+        with self.lock:
+            self.reserved -= reserved_amount
+            self.spent += actual_cost
+            self.settled.notify_all()
+
+    def projected(self):
+        with self.lock:
+            return self.spent+self.reserved
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max cost': self.max_cost, 
+                'spent': self.spent, 
+                'reserved': self.reserved, 
+                'rejected reservations': self.num_rejected
+            }
@@ -1,10 +1,155 @@
 from .assets import annomi_classifier_path
 import openai 
-from .classification_wrapper import ClassificationWrapper
+import ast
+import json
+import re
+import threading
 from .openai_dialogue import OpenaiSequencialDialogue
-from nltk import sent_tokenize
 
 
+# label set of the dialogue act classifier, with explanations for the LLM
+MI_LABEL_DEFINITIONS = """    [Give Information]: Gives information, educates, provides feedback, or expresses a professional opinion without persuading, advising, or warning. Self-discose of objective information also goes here.
+    [Question]: All questions from clinicians (open, closed, evocative,	fact-finding, etc.)	
+    [Simple Reflection]: Reflect (repeat or reword) on what the client have said, without adding further meaning to it.
+    [Complex Reflection]: Reflect (repeat or reword) on what the client have said, but adding further meaning (or make explicit some hidden impliciation) of it.
+    [Affirm]: States something positive or complimentary about the client’s strengths, efforts, intentions, or worth.
+    [Emphasize Autonomy]: Highlights a client’s sense of control, freedom of choice, personal autonomy, ability, and obligation about change.
+    [Confront]: Directly and unambiguously disagreeing, arguing, correcting, shaming, blaming, criticizing, labeling, warning, moralizing, ridiculing, or questioning a client’s honesty.
+    [Seek Collaboration]: Attempts to share power or acknowledge the expertise of a client.
+    [Support]: These are generally sympathetic, compassionate, or understanding comments, with the quality of siding with the client.
+    [Advise with Permission]: Attempts to change a client’s opinions, attitudes, or behaviors, but have obtained the client's permission to do so, or clearly indicates the decision is the clients'.
+    [Advise]: Attempts to change a client’s opinions, attitudes, or behaviors using tools such as logic, compelling arguments, self-disclosure, facts, biased information, advice, suggestions, tips, opinions, or solutions to problems.
+    [Other]: Filler words, such as 'mm-hmm', 'mm', 'yeah', 'okay', 'hmm', 'uh-huh', 'huh', 'right', 'yep', etc."""
+MI_LABELS = [
+    'Give Information', 'Question', 'Simple Reflection', 'Complex Reflection', 'Affirm', 'Emphasize Autonomy', 
+    'Confront', 'Seek Collaboration', 'Support', 'Advise with Permission', 'Advise', 'Other'
+]
+
+
+# LLM adjudication, one sentence or a whole turn at a time
+CLASSIFY_ACTION_PROMPT = """Look at the following dialogue snippet, and tell me the intent of a therapist response. The potential labels and their explanations are:
+
+"""+MI_LABEL_DEFINITIONS+"""
+
+
+    The snippet:
+    @snippet@
+
+    What is the label of the sentence "@sentence@" in the last therapist response? Our classifier classified this as @classifier_decision@, now help use decide which best describes this sentence. You can override the classifier decision if you really need to, but 95% times the true answer is in the classifier's suggestion. 
+
+    Your answer (answer with the label only, without any extra words):
+        """
+
+CLASSIFY_TURN_ACTIONS_PROMPT = """Look at the following dialogue snippet, and tell me the intent of each sentence in the last therapist response. The potential labels and their explanations are:
+
+"""+MI_LABEL_DEFINITIONS+"""
+
+
+    The snippet:
+    @snippet@
+
+    The last therapist response has @num_sentences@ sentences, here they are with our classifier's decision for each:
+@sentences@
+
+    Help us decide which label best describes each sentence. You can override the classifier decision if you really need to, but 95% times the true answer is in the classifier's suggestion. 
+
+    Your answer (a JSON list of exactly @num_sentences@ labels, one per sentence in order, e.g. ["Question", "Affirm"], without any extra words):
+        """
+
+
+def canonical_label(text):
+    """
+    map a free-text label from the LLM to one of MI_LABELS, None if it matches none
+    """
+    text = text.strip().strip('[]"\'.').strip()
+    for label in MI_LABELS:
+        if text.lower() == label.lower():
+            return label
+    # longest first, so 'Advise with Permission' wins over 'Advise'
+    for label in sorted(MI_LABELS, key=len, reverse=True):
+        if label.lower() in text.lower():
+            return label
+    return None
+
+
+def parse_label_list(response, num_sentences):
+    """
+    parse an ordered list of labels out of an LLM reply, tries in turn
+        a JSON (or python) list, numbered lines, and [bracketed] labels.
+    returns None unless exactly num_sentences valid labels are found
+    """
+    candidates = []
+    if '[' in response and ']' in response:
+        list_text = response[response.index('['):response.rindex(']')+1]
+        for parse in (json.loads, ast.literal_eval):
+            try:
+                parsed = parse(list_text)
+            except (ValueError, SyntaxError):
+                continue
+            if isinstance(parsed, list):
+                candidates.append([str(i) for i in parsed])
+                break
+    candidates.append(re.findall(r'^\s*\d+\s*[.):]\s*(.+?)\s*$', response, flags=re.MULTILINE))
+    candidates.append(re.findall(r'\[([^\[\]]+)\]', response))
+    for raw_labels in candidates:
+        labels = [canonical_label(l) for l in raw_labels]
+        if len(labels) == num_sentences and None not in labels:
+            return labels
+    return None
+
+
+def sort_labels(proba):
+    """
+    labels of a {label: probability} dict, most likely first
+    """
+    return sorted(proba.keys(), key=lambda k : proba[k], reverse=True)
+
+
+def same_label(a, b):
+    return (canonical_label(a) or a.strip().lower()) == (canonical_label(b) or b.strip().lower())
+
+
+def calibrate_escalation_thresholds(probas, reference_labels, target_agreement=0.95, min_support=20):
+    """
+    Pick escalation thresholds on held-out data: the lowest top-probability above which 
+    the classifier's top label agrees with the reference (LLM adjudicated) label at least 
+    target_agreement of the time. Labels with at least min_support sentences get their own threshold.
+
+    probas: [{label: probability}], reference_labels: [str]
+    Returns a config for DialogueActClassifier (threshold, label_thresholds) plus
+    the escalation rate and agreement it would have had on this data.
+    """
+    if len(probas) == 0:
+        raise ValueError('no sentences to calibrate on')
+    tops = [(sort_labels(p)[0], p[sort_labels(p)[0]], same_label(sort_labels(p)[0], r)) 
+            for p, r in zip(probas, reference_labels)]
+
+    def lowest_threshold(items):
+        # candidates from the most to the least confident, keep going while agreement holds
+        items = sorted(items, key=lambda x: x[1], reverse=True)
+        threshold = None
+        num_agree = 0
+        for n, (label, top, agree) in enumerate(items):
+            num_agree += agree
+            if num_agree / (n+1) >= target_agreement:
+                threshold = top
+        return threshold
+
+    config = {'threshold': lowest_threshold(tops), 'label_thresholds': dict()}
+    for label in set([t[0] for t in tops]):
+        label_tops = [t for t in tops if t[0] == label]
+        if len(label_tops) >= min_support:
+            config['label_thresholds'][label] = lowest_threshold(label_tops)
+
+    accepted = []
+    for label, top, agree in tops:
+        threshold = config['label_thresholds'].get(label, config['threshold'])
+        if threshold is not None and top >= threshold:
+            accepted.append(agree)
+    config['escalation rate'] = 1 - len(accepted) / max(len(tops), 1)
+    config['agreement'] = sum(accepted) / len(accepted) if accepted else None
+    return config
+
 
 class DialogueActClassifier:
 
@@ -12,9 +157,38 @@ class DialogueActClassifier:
     Dialogue Act Classification, supericl style (small model + LLM)
     """
 
-    def __init__(self):
+    def __init__(
+            self, 
+            classifier_backend='torch', 
+            device=None, 
+            adjudication='per_sentence',
+            escalation_threshold=None,
+            escalation_margin=0.0,
+            label_thresholds=None
+            ):
+        """
+        adjudication: 'per_sentence' asks the LLM once per sentence,
+            'per_turn' labels all sentences of a turn in one request (falls back to per sentence
+            if the reply cannot be parsed)
+        escalation_threshold: ask the LLM only when the classifier's top probability is below this,
+            None means always ask (see calibrate_escalation_thresholds)
+        escalation_margin: also ask the LLM when the top two probabilities are closer than this
+        label_thresholds: {label: threshold}, overrides escalation_threshold when label is the top label
+        """
+        assert adjudication in {'per_sentence', 'per_turn'}
+        self.adjudication = adjudication
+        self.escalation_threshold = escalation_threshold
+        self.escalation_margin = escalation_margin
+        self.label_thresholds = label_thresholds or dict()
+        self.num_sentences_seen = 0
+        self.num_sentences_escalated = 0
+        self.escalation_lock = threading.Lock()
+        # torch / transformers are only imported once a classifier is actually built
+        from .classification_wrapper import ClassificationWrapper
         self.intent_classifier = ClassificationWrapper(
-            model_name_or_path = annomi_classifier_path
+            model_name_or_path = annomi_classifier_path,
+            device = device,
+            backend = classifier_backend
         )
         
         
@@ -30,50 +204,122 @@ class DialogueActClassifier:
         Sentence:
             sentences in that turn, splitted by nltk.sent_tokenize
         """
+        return self.annotate_dialogue_turns([(context, turn)])[0]
+
+    def annotate_dialogue_turns(self, contexts_and_turns, with_probas=False):
+        """
+        Bulk version of annotate_dialogue_turn, takes a list of (context, turn).
+
+        All sentences of all turns go through the small classifier in one batched call,
+        the LLM then adjudicates each sentence given the precomputed label ranking.
+
+        Returns a list of (sentences, labels, cost), one per turn,
+        with_probas=True adds the classifier's {label: probability} of each sentence: (sentences, labels, cost, probas)
+        """
+        from nltk import sent_tokenize
+        turn_sentences = [sent_tokenize(turn) for context, turn in contexts_and_turns]
+        all_probas = self.get_label_probas_batch(
+            [sent for sentences in turn_sentences for sent in sentences]
+        )
         out = []
-        sentences = []
-        tot_cost = 0
-        for sent in sent_tokenize(turn):
-            sentences.append(sent)
-            label, cost = self.classify_action(context, turn, sent)
-            out.append(label)
-            tot_cost += cost
-        return sentences, out, tot_cost
+        position = 0
+        for (context, turn), sentences in zip(contexts_and_turns, turn_sentences):
+            probas = all_probas[position:position+len(sentences)]
+            position += len(sentences)
+            sorted_labels = [sort_labels(p) for p in probas]
+            escalated = [i for i, p in enumerate(probas) if self.needs_llm(p)]
+            self._record_escalations(len(sentences), len(escalated))
+
+            # confident sentences keep the classifier decision
+            labels = [l[0] for l in sorted_labels]
+            llm_labels = None
+            tot_cost = 0
+            if self.adjudication == 'per_turn' and len(escalated) > 1:
+                llm_labels, tot_cost = self.classify_turn_actions(context, turn, sentences, sorted_labels)
+                if llm_labels is not None:
+                    for i in escalated:
+                        labels[i] = llm_labels[i]
+            if llm_labels is None:
+                for i in escalated:
+                    labels[i], cost = self.classify_action(context, turn, sentences[i], sorted_labels=sorted_labels[i])
+                    tot_cost += cost
+            out.append((sentences, labels, tot_cost, probas) if with_probas else (sentences, labels, tot_cost))
+        return out
+
+    def needs_llm(self, proba):
+        """
+        whether the classifier is unsure enough about a sentence to ask the LLM
+        proba: {label: probability} from the classifier
+        """
+        ranked = sort_labels(proba)
+        threshold = self.label_thresholds.get(ranked[0], self.escalation_threshold)
+        if threshold is None:
+            return True
+        top = proba[ranked[0]]
+        second = proba[ranked[1]] if len(ranked) > 1 else 0
+        return top < threshold or top - second < self.escalation_margin
+
+    def _record_escalations(self, num_sentences, num_escalated):
+        with self.escalation_lock:
+            self.num_sentences_seen += num_sentences
+            self.num_sentences_escalated += num_escalated
+
+    def escalation_rate(self):
+        """
+        fraction of sentences sent to the LLM so far
+        """
+        if self.num_sentences_seen == 0:
+            return 0
+        return self.num_sentences_escalated / self.num_sentences_seen
     
             
     def get_sorted_labels(self, sentence):
-        p = self.intent_classifier(sentence, return_type='class proba', disable_tqdm=True)
-        sorted_labels = sorted(p['predicted'].keys(), key=lambda k : p['predicted'][k], reverse=True)
-        return sorted_labels
+        return self.get_sorted_labels_batch([sentence])[0]
 
-    def classify_action(self, context, turn, sentence, verbose=False):
+    def get_sorted_labels_batch(self, sentences):
         """
-        Context: the dialogue context
-        Turn: the turn of interest in the dialogue
-        Sentence: the sentence of interest in the turn
+        labels for each sentence, most likely first, from a single classifier call
         """
-        classifier_prompt = """Look at the following dialogue snippet, and tell me the intent of a therapist response. The potential labels and their explanations are:
-
-    [Give Information]: Gives information, educates, provides feedback, or expresses a professional opinion without persuading, advising, or warning. Self-discose of objective information also goes here.
-    [Question]: All questions from clinicians (open, closed, evocative,	fact-finding, etc.)	
-    [Simple Reflection]: Reflect (repeat or reword) on what the client have said, without adding further meaning to it.
-    [Complex Reflection]: Reflect (repeat or reword) on what the client have said, but adding further meaning (or make explicit some hidden impliciation) of it.
-    [Affirm]: States something positive or complimentary about the client’s strengths, efforts, intentions, or worth.
-    [Emphasize Autonomy]: Highlights a client’s sense of control, freedom of choice, personal autonomy, ability, and obligation about change.
-    [Confront]: Directly and unambiguously disagreeing, arguing, correcting, shaming, blaming, criticizing, labeling, warning, moralizing, ridiculing, or questioning a client’s honesty.
-    [Seek Collaboration]: Attempts to share power or acknowledge the expertise of a client.
-    [Support]: These are generally sympathetic, compassionate, or understanding comments, with the quality of siding with the client.
-    [Advise with Permission]: Attempts to change a client’s opinions, attitudes, or behaviors, but have obtained the client's permission to do so, or clearly indicates the decision is the clients'.
-    [Advise]: Attempts to change a client’s opinions, attitudes, or behaviors using tools such as logic, compelling arguments, self-disclosure, facts, biased information, advice, suggestions, tips, opinions, or solutions to problems.
-    [Other]: Filler words, such as 'mm-hmm', 'mm', 'yeah', 'okay', 'hmm', 'uh-huh', 'huh', 'right', 'yep', etc.
+        return [sort_labels(p) for p in self.get_label_probas_batch(sentences)]
 
+    def get_label_probas_batch(self, sentences):
+        """
+        {label: probability} for each sentence, from a single classifier call
+        """
+        if len(sentences) == 0:
+            return []
+        probas = self.intent_classifier(sentences, return_type='class proba', disable_tqdm=True)
+        return [p['predicted'] for p in probas]
 
-    The snippet:
-    @snippet@
+    def classify_turn_actions(self, context, turn, sentences, sorted_labels, verbose=False):
+        """
+        Label every sentence of a turn in one LLM request.
 
-    What is the label of the sentence "@sentence@" in the last therapist response? Our classifier classified this as @classifier_decision@, now help use decide which best describes this sentence. You can override the classifier decision if you really need to, but 95% times the true answer is in the classifier's suggestion. 
+        Sorted_labels: the small classifier's label ranking for each sentence
+        Returns (labels, cost), labels is None if the reply could not be parsed
+        """
+        sentences_text = '\n'.join([
+            f'    {i+1}. "{sent}": likely one of {str(labels[:5])}' 
+            for i, (sent, labels) in enumerate(zip(sentences, sorted_labels))
+        ])
+        prompt = CLASSIFY_TURN_ACTIONS_PROMPT.replace('@snippet@', context+'\n'+turn).replace(
+            '@num_sentences@', str(len(sentences))).replace('@sentences@', sentences_text)
+        classifier = OpenaiSequencialDialogue(model='gpt-3.5-turbo-1106')
+        response = classifier.send_user_message(prompt)
+        if verbose:
+            print(prompt)
+            print(response)
+        labels = parse_label_list(response, len(sentences))
+        if labels is None:
+            print('[Warning]: DialogueActClassifier: could not parse turn labels, falling back to per sentence: ', response)
+        return labels, classifier.cost()['total']
 
-    Your answer (answer with the label only, without any extra words):
+    def classify_action(self, context, turn, sentence, verbose=False, sorted_labels=None):
+        """
+        Context: the dialogue context
+        Turn: the turn of interest in the dialogue
+        Sentence: the sentence of interest in the turn
+        Sorted_labels: the small classifier's label ranking for the sentence, computed if not given
         """
         classifier = OpenaiSequencialDialogue(model='gpt-3.5-turbo-1106')
         # small_model_decision = self.intent_classifier(sentence, disable_tqdm=True)['predicted']
@@ -81,13 +327,13 @@ class DialogueActClassifier:
     #         small_model_decision = 'Advise (but unsure about whether with permission or not)'
     #     if 'reflection' in small_model_decision.lower():
     #         small_model_decision = 'Reflection (but unsure about whether it is simple or complex)'
-        small_model_decision = self.get_sorted_labels(sentence)
+        small_model_decision = sorted_labels if sorted_labels is not None else self.get_sorted_labels(sentence)
         small_model_decision = ' likely one of '+str(small_model_decision[:5])+' '
         response = classifier.send_user_message(
-            classifier_prompt.replace('@snippet@', context+'\n'+turn).replace('@sentence@', sentence).replace('@classifier_decision@', small_model_decision)
+            CLASSIFY_ACTION_PROMPT.replace('@snippet@', context+'\n'+turn).replace('@sentence@', sentence).replace('@classifier_decision@', small_model_decision)
         )
         if verbose:
-            print(classifier_prompt.replace('@snippet@', context+'\n'+turn).replace('@sentence@', sentence).replace('@classifier_decision@', small_model_decision))
+            print(CLASSIFY_ACTION_PROMPT.replace('@snippet@', context+'\n'+turn).replace('@sentence@', sentence).replace('@classifier_decision@', small_model_decision))
             print(response)
         return response.replace('[', '').replace(']', ''), classifier.cost()['total']
     
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class CachedSentenceEncoder:
+
+    """
+    Drop-in wrapper of a SentenceTransformer's encode(), with a persistent embedding cache.
+
+    <cache_dir>/<model name>/embeddings.f32   memory-mapped (max_entries, dim) float32 slots
+    <cache_dir>/<model name>/index.sqlite     text hash -> slot, with last use time for LRU eviction
+
+    only texts missing from the cache are encoded (together, in batches), and the encoder itself
+    is only loaded (with load_encoder) on the first miss, so a fully cached run never loads the model.
+    Safe to share across threads.
+    """
+
+    def __init__(self, model_name, cache_dir, load_encoder, max_entries=1000000):
+        self.model_name = model_name
+        self.load_encoder = load_encoder
+        self.encoder = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.path = os.path.join(cache_dir, model_name.replace('/', '__'))
+        os.makedirs(self.path, exist_ok=True)
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as ifp:
+                self.meta = json.load(ifp)
+        else:
+            self.meta = {'model name': model_name, 'dim': self._encoder().get_sentence_embedding_dimension(), 'max entries': max_entries}
+            with open(meta_path, 'w') as ofp:
+                json.dump(self.meta, ofp, indent=2)
+        self.max_entries = self.meta['max entries']
+
+        embeddings_path = os.path.join(self.path, 'embeddings.f32')
+        # a sparse file, slots take disk space once written
+        self.embeddings = np.memmap(
+            embeddings_path, dtype=np.float32, mode='r+' if os.path.exists(embeddings_path) else 'w+',
+            shape=(self.max_entries, self.meta['dim'])
+        )
+        self.conn = sqlite3.connect(os.path.join(self.path, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER, last_used REAL)')
+        self.conn.commit()
+        self.next_slot = self.conn.execute('SELECT COALESCE(MAX(slot)+1, 0) FROM entries').fetchone()[0]
+
+    def _encoder(self):
+        if self.encoder is None:
+            self.encoder = self.load_encoder()
+        return self.encoder
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta['dim']
+
+    def _lookup(self, keys):
+        slots = dict()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = self.conn.execute(
+                f'SELECT key, slot FROM entries WHERE key IN ({",".join("?"*len(chunk))})', chunk
+            ).fetchall()
+            slots.update(rows)
+        return slots
+
+    def _free_slots(self, num_slots, keep_keys):
+        """
+        fresh slots first, then those of the least recently used entries (which are dropped from the index)
+        """
+        num_fresh = min(num_slots, self.max_entries-self.next_slot)
+        slots = list(range(self.next_slot, self.next_slot+num_fresh))
+        self.next_slot += num_fresh
+        if len(slots) < num_slots:
+            evicted = self.conn.execute(
+                'SELECT key, slot FROM entries ORDER BY last_used LIMIT ?', (num_slots-len(slots)+len(keep_keys),)
+            ).fetchall()
+            evicted = [(key, slot) for key, slot in evicted if key not in keep_keys][:num_slots-len(slots)]
+            self.conn.executemany('DELETE FROM entries WHERE key = ?', [(key,) for key, _ in evicted])
+            self.conn.commit()
+            slots += [slot for _, slot in evicted]
+        return slots
+
+    def encode(self, sentences, batch_size=32, normalize_embeddings=False, **kwargs):
+        """
+        same as SentenceTransformer.encode for a string or a list of strings (numpy output)
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        keys = [text_key(text) for text in texts]
+        out = np.zeros((len(texts), self.meta['dim']), dtype=np.float32)
+
+        with self.lock:
+            slots = self._lookup(sorted(set(keys)))
+            missing = dict()
+            for i, key in enumerate(keys):
+                if key in slots:
+                    out[i] = self.embeddings[slots[key]]
+                else:
+                    missing.setdefault(key, []).append(i)
+            # both counted in texts (a text repeated in the batch is encoded once, but counted each time)
+            num_missing = sum([len(positions) for positions in missing.values()])
+            self.hits += len(texts)-num_missing
+            self.misses += num_missing
+            now = time.time()
+            self.conn.executemany('UPDATE entries SET last_used = ? WHERE key = ?', [(now, key) for key in slots])
+            self.conn.commit()
+
+            if len(missing) > 0:
+                missing_keys = list(missing)
+                new_embeddings = np.asarray(self._encoder().encode(
+                    [texts[missing[key][0]] for key in missing_keys], batch_size=batch_size, **kwargs
+                ), dtype=np.float32)
+                for key, embedding in zip(missing_keys, new_embeddings):
+                    out[missing[key]] = embedding
+
+                # embeddings are written before the index points at them
+                to_cache = missing_keys[-self.max_entries:]
+                free_slots = self._free_slots(len(to_cache), keep_keys=set(slots))
+                for key, slot, embedding in zip(to_cache, free_slots, new_embeddings[-len(to_cache):]):
+                    self.embeddings[slot] = embedding
+                self.embeddings.flush()
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                    [(key, slot, now) for key, slot in zip(to_cache, free_slots)]
+                )
+                self.conn.commit()
+
+        if normalize_embeddings:
+            out = out / np.maximum(np.linalg.norm(out, axis=1, keepdims=True), 1e-12)
+        return out[0] if single else out
+
+    def stats(self):
+        with self.lock:
+            num_entries = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': num_entries, 'max entries': self.max_entries}
+
+    def close(self):
+        with self.lock:
+            self.embeddings.flush()
+            self.conn.close()
+
+
+def build_sentence_encoder(model_name='all-MiniLM-L6-v2', cache_dir=None, max_entries=1000000):
+    """
+    SentenceTransformer, wrapped in a persistent embedding cache if a cache_dir is given
+    """
+    def load_encoder():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if cache_dir is None:
+        return load_encoder()
+    return CachedSentenceEncoder(model_name, cache_dir, load_encoder, max_entries=max_entries)
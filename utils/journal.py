@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def state_action_id(session_id, turn_index, state, gold_action):
+    """
+    stable id of a state-action pair, the hash guards against different context window settings
+    """
+    digest = hashlib.sha1((state+'\n'+gold_action).encode('utf-8')).hexdigest()[:12]
+    return f'{session_id}:{turn_index}:{digest}'
+
+
+def shard_of(result_id, num_shards):
+    """
+    which of num_shards workers handles a state-action pair, stable across runs and machines
+    """
+    return int(hashlib.sha1(result_id.encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+def _to_json(o):
+    # numpy scalars (e.g. transcript ids read by pandas)
+    if hasattr(o, 'item'):
+        return o.item()
+    return str(o)
+
+
+class ResultJournal:
+
+    """
+    Append-only JSONL journal of per state-action results, written (and fsynced) as each one completes,
+    so a crashed or killed run can be resumed without paying for finished pairs again.
+
+    resume=False starts a new journal and refuses to overwrite a non-empty one (it holds paid-for results),
+    resume=True keeps the finished results of the previous run.
+    Safe to share across threads.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = dict()
+        if resume and os.path.exists(path):
+            with open(path) as ifp:
+                for line in ifp:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut short by the crash
+                        continue
+                    self.results[entry['id']] = entry['result']
+            truncated = False
+            if os.path.getsize(path) > 0:
+                with open(path, 'rb') as ifp:
+                    ifp.seek(-1, os.SEEK_END)
+                    truncated = ifp.read(1) != b'\n'
+            if truncated:
+                with open(path, 'a') as ofp:
+                    ofp.write('\n')
+        elif os.path.exists(path):
+            if os.path.getsize(path) > 0:
+                raise FileExistsError(
+                    f'journal {path} already has results, rerun with --resume to continue that run, '
+                    'or delete it (or pass another --journal_path) to start over'
+                )
+            os.remove(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __contains__(self, result_id):
+        return result_id in self.results
+
+    def __len__(self):
+        return len(self.results)
+
+    def append(self, result_id, result):
+        line = json.dumps({'id': result_id, 'result': result}, default=_to_json)
+        with self.lock:
+            with open(self.path, 'a') as ofp:
+                ofp.write(line+'\n')
+                ofp.flush()
+                os.fsync(ofp.fileno())
+            self.results[result_id] = json.loads(line)['result']
+
+    def compact(self, result_ids):
+        """
+        results in the order of result_ids (those not in the journal are skipped)
+        """
+        return [self.results[i] for i in result_ids if i in self.results]
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+
+from .llm_cache import request_key
+
+
+class OpenAIBackend:
+    """
+    the real thing, openai.ChatCompletion
+    """
+
+    def complete(self, request_kwargs, timeout_tolerance=15):
+        # request_timeout is a client-side deadline that, unlike a signal, works from any thread
+        return openai.ChatCompletion.create(request_timeout=timeout_tolerance, **request_kwargs)
+
+    async def acomplete(self, request_kwargs, timeout_tolerance=15):
+        return await asyncio.wait_for(
+            openai.ChatCompletion.acreate(**request_kwargs),
+            timeout=timeout_tolerance
+        )
+
+
+# fields of the single request TOM prompt (tom_detector.SINGLE_REQUEST_TOM_FIELDS)
+MOCK_TOM_REPLY = {
+    'client_stage': 'Contemplation',
+    'client_mental_state': 'hesitant, sees reasons to change but is not ready yet',
+    'therapist_behavior': 'reflects the client\'s ambivalence to evoke change talk',
+    'contextual_instruction': 'when the client is hesitant, the therapist can reflect their ambivalence in order to evoke change talk'
+}
+
+def default_mock_reply(messages):
+    """
+    a valid reply of the kind the request asks for: the TOM fields as a JSON object, a JSON list of
+    dialogue act labels, otherwise {'prediction': '1'} (parses both as a TOM prediction and as a reranker rule id)
+    """
+    prompt = messages[-1]['content'] or ''
+    if 'Answer with a single JSON object' in prompt:
+        return json.dumps({f: reply for f, reply in MOCK_TOM_REPLY.items() if f'"{f}":' in prompt})
+    num_labels = re.search(r'a JSON list of exactly (\d+) labels', prompt)
+    if num_labels is not None:
+        return json.dumps(['Question']*int(num_labels.group(1)))
+    return "{'prediction': '1'}"
+
+
+class MockBackend:
+
+    """
+    Offline stand-in for benchmarking and CI, no network involved.
+
+    latency: seconds per request, a number or a function returning one,
+        e.g. lambda: random.lognormvariate(0, 0.5)
+    replies: scripted replies, a list (cycled through in order) or a function messages -> str.
+        The default (default_mock_reply) answers each request in the format it asks for,
+        so mock runs take the same request path as real ones.
+    Token usage is estimated from the text length (~4 characters per token).
+    """
+
+    def __init__(self, latency=0.0, replies=None, completion_tokens=None):
+        self.latency = latency
+        self.replies = replies if replies is not None else default_mock_reply
+        self.completion_tokens = completion_tokens
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    def _latency(self):
+        return self.latency() if callable(self.latency) else self.latency
+
+    def _response(self, request_kwargs):
+        with self.lock:
+            request_id = self.num_requests
+            self.num_requests += 1
+        messages = request_kwargs['messages']
+        if callable(self.replies):
+            reply = self.replies(messages)
+        else:
+            reply = self.replies[request_id % len(self.replies)]
+        prompt_tokens = sum([len(m['content'] or '') for m in messages]) // 4
+        completion_tokens = self.completion_tokens if self.completion_tokens is not None else len(reply) // 4
+        return {
+            'id': f'mock-{request_id}',
+            'object': 'chat.completion',
+            'model': request_kwargs['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens+completion_tokens
+            }
+        }
+
+    def complete(self, request_kwargs, timeout_tolerance=15):
+        time.sleep(self._latency())
+        return self._response(request_kwargs)
+
+    async def acomplete(self, request_kwargs, timeout_tolerance=15):
+        await asyncio.sleep(self._latency())
+        return self._response(request_kwargs)
+
+
+class RecordReplayBackend:
+
+    """
+    mode='record': forward requests to `backend` and append every response to a JSONL traffic file
+    mode='replay': answer from a previously recorded traffic file, byte-for-byte, without any network
+
+    Requests are matched by content (model, messages, max_tokens, stop).
+    """
+
+    def __init__(self, path, mode='replay', backend=None, latency=0.0):
+        assert mode in {'record', 'replay'}
+        self.path = path
+        self.mode = mode
+        self.backend = backend if backend is not None else OpenAIBackend()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.recorded = dict()
+        if mode == 'replay':
+            with open(path) as ifp:
+                for line in ifp:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.recorded[entry['key']] = entry['response']
+
+    def _replay(self, request_kwargs):
+        key = request_key(request_kwargs)
+        if key not in self.recorded:
+            raise KeyError(f'request {key} was not recorded in {self.path}')
+        # stored as the raw serialized string, so the response is exactly what was recorded
+        return json.loads(self.recorded[key])
+
+    def _record(self, request_kwargs, response):
+        entry = json.dumps({'key': request_key(request_kwargs), 'response': json.dumps(response)})
+        with self.lock:
+            with open(self.path, 'a') as ofp:
+                ofp.write(entry+'\n')
+
+    def complete(self, request_kwargs, timeout_tolerance=15):
+        if self.mode == 'replay':
+            time.sleep(self.latency)
+            return self._replay(request_kwargs)
+        response = self.backend.complete(request_kwargs, timeout_tolerance)
+        self._record(request_kwargs, response)
+        return response
+
+    async def acomplete(self, request_kwargs, timeout_tolerance=15):
+        if self.mode == 'replay':
+            await asyncio.sleep(self.latency)
+            return self._replay(request_kwargs)
+        response = await self.backend.acomplete(request_kwargs, timeout_tolerance)
+        self._record(request_kwargs, response)
+        return response
+
+
+def serve_backend(backend, host='127.0.0.1', port=8000):
+    """
+    Serve a backend (e.g. MockBackend) as a local OpenAI-compatible /v1/chat/completions endpoint,
+    point the client at it with openai.api_base = 'http://127.0.0.1:8000/v1'.
+
+    Runs in a daemon thread, returns the server (call .shutdown() to stop it).
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            request_kwargs = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            request_kwargs.setdefault('max_tokens', None)
+            request_kwargs.setdefault('stop', None)
+            body = json.dumps(backend.complete(request_kwargs)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_backend(name='openai', traffic_path=None, mock_latency=0.0):
+    """
+    backend from command line options, name in {'openai', 'mock', 'record', 'replay'}
+    """
+    if name == 'openai':
+        return OpenAIBackend()
+    if name == 'mock':
+        # exponential latencies around the given mean, closer to real traffic than a constant
+        return MockBackend(latency=lambda: random.expovariate(1/mock_latency) if mock_latency > 0 else 0.0)
+    if name in ('record', 'replay'):
+        assert traffic_path is not None, f'{name} needs a traffic file'
+        return RecordReplayBackend(traffic_path, mode=name)
+    raise ValueError(f'unknown llm backend {name}')
@@ -0,0 +1,96 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def request_key(request_kwargs):
+    """
+    content address of a chat request: hash of model, full message list, max_tokens and stop
+    """
+    payload = {
+        'model': request_kwargs['model'],
+        'messages': [{'role': m['role'], 'content': m['content']} for m in request_kwargs['messages']],
+        'max_tokens': request_kwargs.get('max_tokens'),
+        'stop': request_kwargs.get('stop')
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+
+    """
+    Persistent on-disk cache (SQLite) of chat responses for deterministic (temperature 0) requests.
+
+    Entries are evicted least-recently-used first once the stored responses exceed max_size_bytes.
+    Safe to share across threads.
+    """
+
+    def __init__(self, path, max_size_bytes=1024**3):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, response TEXT, size INTEGER, last_access REAL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS lru ON responses (last_access)')
+        self.conn.commit()
+
+    @staticmethod
+    def cacheable(request_kwargs):
+        return request_kwargs.get('temperature', 1.0) == 0.0
+
+    def get(self, request_kwargs):
+        """
+        return the cached response, or None on a miss
+        """
+        key = request_key(request_kwargs)
+        with self.lock:
+            row = self.conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, request_kwargs, response):
+        serialized = json.dumps(response)
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (request_key(request_kwargs), serialized, len(serialized), time.time())
+            )
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        to_free = total_size - self.max_size_bytes
+        for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY last_access').fetchall():
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            to_free -= size
+            if to_free <= 0:
+                break
+
+    def stats(self):
+        with self.lock:
+            num_entries, total_size = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses'
+            ).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': num_entries, 'size_bytes': total_size}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
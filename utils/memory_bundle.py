@@ -0,0 +1,164 @@
+import json
+import os
+import numpy as np
+from .journal import _to_json
+
+
+class MemoryBundle:
+
+    """
+    Training memory on disk, ready for client-tom retrieval without re-encoding anything.
+
+    <path>/rows.jsonl          one memory row (rule, client tom, ...) per line
+    <path>/embeddings.f32      L2-normalized client tom embeddings, float32, memory-mapped
+    <path>/meta.json           encoder name, embedding dimension, number of rows (and bytes of rows.jsonl)
+    <path>/hnsw.bin            optional approximate index (hnswlib), used once the memory has ann_threshold rows
+
+    rows are append-only, append() adds new rules without rebuilding anything.
+    """
+
+    def __init__(self, path, ann_threshold=100000):
+        self.path = path
+        self.ann_threshold = ann_threshold
+        with open(os.path.join(path, 'meta.json')) as ifp:
+            self.meta = json.load(ifp)
+        with open(os.path.join(path, 'rows.jsonl'), 'rb') as ifp:
+            self.rows = [json.loads(line) for line in ifp.read(self.meta['rows bytes']).decode('utf-8').splitlines()]
+        self.rules = [row['rule'] for row in self.rows]
+        self.client_toms = [row['client tom'] for row in self.rows]
+        self._load_embeddings()
+        self.ann_index = None
+        if len(self) >= ann_threshold:
+            self._load_ann_index()
+
+    @classmethod
+    def create(cls, path, memory, sentence_encoder, encoder_name, **kwargs):
+        """
+        write a new bundle from a memory DataFrame (csv from train_agent.py), replacing any existing one
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('rows.jsonl', 'embeddings.f32', 'hnsw.bin'):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        dim = sentence_encoder.get_sentence_embedding_dimension()
+        cls._write_meta(path, {'encoder name': encoder_name, 'dim': dim, 'num rows': 0, 'rows bytes': 0})
+        open(os.path.join(path, 'rows.jsonl'), 'w').close()
+        open(os.path.join(path, 'embeddings.f32'), 'wb').close()
+        bundle = cls(path, **kwargs)
+        bundle.append(memory, sentence_encoder)
+        return bundle
+
+    @staticmethod
+    def _write_meta(path, meta):
+        # write then rename, a crash never leaves a half-written meta.json
+        with open(os.path.join(path, 'meta.json.tmp'), 'w') as ofp:
+            json.dump(meta, ofp, indent=2)
+        os.replace(os.path.join(path, 'meta.json.tmp'), os.path.join(path, 'meta.json'))
+
+    def _load_embeddings(self):
+        if len(self) == 0:
+            self.embeddings = np.zeros((0, self.meta['dim']), dtype=np.float32)
+            return
+        self.embeddings = np.memmap(
+            os.path.join(self.path, 'embeddings.f32'), dtype=np.float32, mode='r', shape=(len(self), self.meta['dim'])
+        )
+
+    def _load_ann_index(self):
+        try:
+            import hnswlib
+        except ImportError:
+            print(f'memory has {len(self)} rows but hnswlib is not installed, using exact search (pip install hnswlib)')
+            return
+        index_path = os.path.join(self.path, 'hnsw.bin')
+        self.ann_index = hnswlib.Index(space='ip', dim=self.meta['dim'])
+        if os.path.exists(index_path):
+            self.ann_index.load_index(index_path, max_elements=len(self))
+            if self.ann_index.get_current_count() == len(self):
+                return
+        self.ann_index.init_index(max_elements=len(self), ef_construction=200, M=16)
+        self.ann_index.add_items(np.asarray(self.embeddings), np.arange(len(self)))
+        self.ann_index.save_index(index_path)
+
+    def __len__(self):
+        return self.meta['num rows']
+
+    def append(self, memory, sentence_encoder, batch_size=64):
+        """
+        add the rows of a memory DataFrame, only the new client toms are encoded
+        """
+        if len(memory) == 0:
+            return
+        embeddings = sentence_encoder.encode(
+            list(memory['client tom']), batch_size=batch_size, normalize_embeddings=True
+        ).astype(np.float32)
+        rows = memory.to_dict('records')
+        rows_text = ''.join([json.dumps(row, default=_to_json)+'\n' for row in rows]).encode('utf-8')
+        # anything past what meta.json accounts for is left over from an interrupted append
+        with open(os.path.join(self.path, 'embeddings.f32'), 'r+b') as ofp:
+            ofp.truncate(len(self)*self.meta['dim']*4)
+            ofp.seek(0, os.SEEK_END)
+            ofp.write(np.ascontiguousarray(embeddings).tobytes())
+        with open(os.path.join(self.path, 'rows.jsonl'), 'r+b') as ofp:
+            ofp.truncate(self.meta['rows bytes'])
+            ofp.seek(0, os.SEEK_END)
+            ofp.write(rows_text)
+        self.meta['num rows'] += len(rows)
+        self.meta['rows bytes'] += len(rows_text)
+        self._write_meta(self.path, self.meta)
+
+        self.rows += [json.loads(json.dumps(row, default=_to_json)) for row in rows]
+        self.rules += [row['rule'] for row in rows]
+        self.client_toms += [row['client tom'] for row in rows]
+        self._load_embeddings()
+        if self.ann_index is not None:
+            self.ann_index.resize_index(len(self))
+            self.ann_index.add_items(embeddings, np.arange(len(self)-len(rows), len(self)))
+            self.ann_index.save_index(os.path.join(self.path, 'hnsw.bin'))
+        elif len(self) >= self.ann_threshold:
+            self._load_ann_index()
+
+    def search(self, query_embeddings, k=10):
+        """
+        top-k rows by cosine similarity of their client tom, for one query (dim,) or a batch (n, dim)
+        returns indices and scores, best first, shaped (k,) or (n, k)
+        """
+        single = query_embeddings.ndim == 1
+        queries = np.atleast_2d(query_embeddings).astype(np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, len(self))
+
+        if self.ann_index is not None:
+            self.ann_index.set_ef(max(4*k, 50))
+            indices, distances = self.ann_index.knn_query(queries, k=k)
+            indices, scores = indices.astype(np.int64), 1-distances
+        else:
+            all_scores = queries @ np.asarray(self.embeddings).T
+            # partial sort: only the k best of each row get ordered
+            indices = np.argpartition(-all_scores, k-1, axis=1)[:, :k] if k < len(self) else np.tile(np.arange(len(self)), (len(queries), 1))
+            scores = np.take_along_axis(all_scores, indices, axis=1)
+            order = np.argsort(-scores, axis=1, kind='stable')
+            indices = np.take_along_axis(indices, order, axis=1)
+            scores = np.take_along_axis(scores, order, axis=1)
+
+        if single:
+            return indices[0], scores[0]
+        return indices, scores
+
+
+def sync_memory_bundle(path, memory, sentence_encoder, encoder_name, **kwargs):
+    """
+    load the bundle at path, kept up to date with a memory DataFrame:
+    built if missing, appended to if the memory only gained rows, rebuilt if anything else changed
+    """
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        bundle = MemoryBundle(path, **kwargs)
+        num_rows = len(bundle)
+        unchanged = bundle.meta['encoder name'] == encoder_name and num_rows <= len(memory) and \
+            bundle.rules == list(memory['rule'][:num_rows]) and bundle.client_toms == list(memory['client tom'][:num_rows])
+        if unchanged:
+            if num_rows < len(memory):
+                print(f'appending {len(memory)-num_rows} rows to the memory bundle at {path}')
+                bundle.append(memory.iloc[num_rows:], sentence_encoder)
+            return bundle
+    print(f'building the memory bundle at {path}')
+    return MemoryBundle.create(path, memory, sentence_encoder, encoder_name, **kwargs)
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+def cluster_near_duplicates(rule_embeddings, tom_embeddings, rule_threshold=0.9, tom_threshold=0.9):
+    """
+    Greedy (leader) clustering of memory rows in their order, embeddings are L2-normalized.
+
+    a row joins the most similar existing cluster whose leader has both a rule similarity >= rule_threshold
+    and a client tom similarity >= tom_threshold (so merged rows are still retrieved for the same situations),
+    and starts a new cluster otherwise.
+    returns a list of clusters, each a list of row indices
+    """
+    clusters = []
+    # there are at most as many leaders as rows, filled in as clusters start
+    leader_rules = np.empty_like(rule_embeddings)
+    leader_toms = np.empty_like(tom_embeddings)
+    for i in range(len(rule_embeddings)):
+        rule_sims = leader_rules[:len(clusters)] @ rule_embeddings[i]
+        tom_sims = leader_toms[:len(clusters)] @ tom_embeddings[i]
+        candidates = np.flatnonzero((rule_sims >= rule_threshold) & (tom_sims >= tom_threshold))
+        if len(candidates) > 0:
+            clusters[candidates[np.argmax(rule_sims[candidates])]].append(i)
+            continue
+        leader_rules[len(clusters)] = rule_embeddings[i]
+        leader_toms[len(clusters)] = tom_embeddings[i]
+        clusters.append([i])
+    return clusters
+
+
+def cluster_representative(cluster, rule_embeddings):
+    """
+    the member whose rule is the most similar, on average, to the rest of the cluster
+    """
+    member_rules = rule_embeddings[cluster]
+    return cluster[int(np.argmax((member_rules @ member_rules.T).sum(axis=1)))]
+
+
+def compact_memory(memory, sentence_encoder, rule_threshold=0.9, tom_threshold=0.9, batch_size=64):
+    """
+    Merge near-duplicate rows of a training memory (csv from train_agent.py) into one representative each.
+
+    the representative keeps its own columns, and gains 'cluster size' and 'cluster members'
+    (the state action ids, or row numbers for older memory files, of every merged row) for provenance.
+    returns the compacted memory as a DataFrame, in the order of the first member of each cluster
+    """
+    rule_embeddings = sentence_encoder.encode(list(memory['rule']), batch_size=batch_size, normalize_embeddings=True)
+    tom_embeddings = sentence_encoder.encode(list(memory['client tom']), batch_size=batch_size, normalize_embeddings=True)
+    clusters = cluster_near_duplicates(rule_embeddings, tom_embeddings, rule_threshold, tom_threshold)
+
+    member_ids = list(memory['state action id']) if 'state action id' in memory.columns else list(range(len(memory)))
+    representatives = [cluster_representative(cluster, rule_embeddings) for cluster in clusters]
+    compacted = memory.iloc[representatives].copy().reset_index(drop=True)
+    compacted['cluster size'] = [len(cluster) for cluster in clusters]
+    compacted['cluster members'] = [[member_ids[i] for i in cluster] for cluster in clusters]
+    return compacted
@@ -1,13 +1,114 @@
 import os
 import openai
 import json
-import pandas as pd
 from tqdm import tqdm
 
 import sys
 import time
+import threading
 import warnings
-from timeout_decorator import timeout
+from functools import lru_cache
+from .retry_policy import default_retry_policy
+from .llm_backends import OpenAIBackend
+
+# optional shared engine (see utils/async_dialogue.py), when set, every
+# blocking request is routed through its event loop and scheduler
+_llm_engine = None
+
+def set_llm_engine(engine):
+    """
+    install (or remove, with None) the engine used by all OpenaiSequencialDialogue objects
+    """
+    global _llm_engine
+    _llm_engine = engine
+
+# where requests are actually sent (see utils/llm_backends.py), swap for a mock or replay offline
+_llm_backend = OpenAIBackend()
+
+def set_llm_backend(backend):
+    """
+    install the backend used by all OpenaiSequencialDialogue objects that were not given their own
+    """
+    global _llm_backend
+    _llm_backend = backend
+
+# optional persistent response cache (see utils/llm_cache.py)
+_llm_cache = None
+
+def set_llm_cache(cache):
+    """
+    install (or remove, with None) the response cache used by all OpenaiSequencialDialogue objects
+    """
+    global _llm_cache
+    _llm_cache = cache
+
+# for most recent pricing see https://openai.com/pricing
+PRICING_PER_1K_TOKENS = {
+    'gpt-3.5-turbo': {'prompt_tokens':0.0015, 'completion_tokens':0.002},
+    'gpt-4': {'prompt_tokens':0.03, 'completion_tokens':0.06},
+    'gpt-4-1106-preview': {'prompt_tokens':0.01, 'completion_tokens':0.03},
+    'gpt-3.5-turbo-1106': {'prompt_tokens':0.001, 'completion_tokens':0.002},
+    'gpt-3.5-turbo-instruct': {'prompt_tokens':0.0015, 'completion_tokens':0.002}
+}
+
+def estimate_cost(model, num_prompt_tokens, num_completion_tokens):
+    """
+    cost of a (projected) number of tokens, same pricing as OpenaiSequencialDialogue.cost()
+    """
+    pricing = PRICING_PER_1K_TOKENS[model]
+    return (pricing['prompt_tokens']*num_prompt_tokens + pricing['completion_tokens']*num_completion_tokens) / 1000
+
+@lru_cache(maxsize=None)
+def _tiktoken_encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+def count_tokens(text, model='gpt-3.5-turbo'):
+    """
+    number of tokens of text for model, exact with tiktoken (pip install tiktoken),
+    otherwise its number of utf-8 bytes, which is never less
+    """
+    encoding = _tiktoken_encoding(model)
+    if encoding is None:
+        return len(text.encode('utf-8'))
+    return len(encoding.encode(text))
+
+# meters active in each thread (see BilledCostMeter)
+_billed_cost_meters = threading.local()
+
+class BilledCostMeter:
+
+    """
+    What the requests sent from the current thread actually cost while the meter is active,
+    responses served from the cache are free. Meters can be nested.
+
+        with BilledCostMeter() as meter:
+            ...
+        meter.total
+    """
+
+    def __init__(self):
+        self.total = 0
+
+    def __enter__(self):
+        if not hasattr(_billed_cost_meters, 'active'):
+            _billed_cost_meters.active = []
+        _billed_cost_meters.active.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _billed_cost_meters.active.remove(self)
+        return False
+
+def _charge_meters(cost):
+    for meter in getattr(_billed_cost_meters, 'active', []):
+        meter.total += cost
 
 class OpenaiSequencialDialogue:
     
@@ -24,7 +125,9 @@ class OpenaiSequencialDialogue:
             system_message = None, 
             max_response_tokens=256,
             timeout_tolerance=15,
-            stop = None
+            stop = None,
+            retry_policy = None,
+            backend = None
             ):
         
         # a list of chat history
@@ -39,18 +142,16 @@ class OpenaiSequencialDialogue:
         self.max_response_tokens = max_response_tokens
         self.timeout_tolerance = timeout_tolerance
         self.stop = stop
+        # backoff, circuit breaking and retry metrics, shared across dialogues by default
+        self.retry_policy = retry_policy if retry_policy is not None else default_retry_policy
+        self.backend = backend
             
         # to track cost
-        # for most recent pricing see https://openai.com/pricing
         self.usages = []
+        # usages served from the response cache, counted in cost() but not actually billed
+        self.cached_usages = []
         warnings.warn("Model pricing last updated: 11/07/2023")
-        self.pricing_per_1k_tokens = {
-            'gpt-3.5-turbo': {'prompt_tokens':0.0015, 'completion_tokens':0.002},
-            'gpt-4': {'prompt_tokens':0.03, 'completion_tokens':0.06},
-            'gpt-4-1106-preview': {'prompt_tokens':0.01, 'completion_tokens':0.03},
-            'gpt-3.5-turbo-1106': {'prompt_tokens':0.001, 'completion_tokens':0.002},
-            'gpt-3.5-turbo-instruct': {'prompt_tokens':0.0015, 'completion_tokens':0.002}
-        }
+        self.pricing_per_1k_tokens = dict(PRICING_PER_1K_TOKENS)
     
     
     # def _complete_chat(self, messages, model):
@@ -79,36 +180,57 @@ class OpenaiSequencialDialogue:
         
     #     return response
 
+    def _request_kwargs(self, messages, model):
+        return dict(
+            model = model, 
+            messages=messages,
+            max_tokens=self.max_response_tokens, 
+            temperature=0.0,
+            stop = self.stop
+        )
+
+    def _lookup_cache(self, request_kwargs):
+        # returns None on a miss, or when there is no cache
+        if _llm_cache is None or not _llm_cache.cacheable(request_kwargs):
+            return None
+        response = _llm_cache.get(request_kwargs)
+        if response is not None:
+            self.cached_usages.append(response['usage'])
+        return response
+
+    def _store_cache(self, request_kwargs, response):
+        if _llm_cache is not None and _llm_cache.cacheable(request_kwargs):
+            _llm_cache.put(request_kwargs, response)
+
     def _complete_chat(self, messages, model):
-        # call API until result is provided and then return it
-        response = None
-        received = False
-        while not received:
-            try:
-                @timeout(self.timeout_tolerance)
-                def send_request():
-                    response = openai.ChatCompletion.create(
-                        model = model, 
-                        messages=messages,
-                        max_tokens=self.max_response_tokens, 
-                        temperature=0.0,
-                        stop = self.stop
-                    )
-                    return response
-                response = send_request()
-                received = True
-            except:
-                error = sys.exc_info()[0]
-                if error == openai.error.InvalidRequestError: # something is wrong: e.g. prompt too long
-                    print(f"InvalidRequestError\nPrompt passed in:\n\n{str(messages)}\n\n")
-                    assert False
-
-                print("API error:", error)
-                time.sleep(1)
+        request_kwargs = self._request_kwargs(messages, model)
+        response = self._lookup_cache(request_kwargs)
+        if response is None:
+            response = self._send_request(request_kwargs)
+            self._store_cache(request_kwargs, response)
+            _charge_meters(sum(self._usage_cost([response['usage']])))
                 
         self.usages.append(response['usage'])
         
         return response
+
+    def _backend(self):
+        return self.backend if self.backend is not None else _llm_backend
+
+    def _send_request(self, request_kwargs):
+        if _llm_engine is not None:
+            return _llm_engine.complete(request_kwargs, self.timeout_tolerance, self.retry_policy, self._backend())
+
+        # call API until result is provided (or the retry policy gives up) and then return it
+        backend = self._backend()
+        try:
+            return self.retry_policy.call(
+                request_kwargs['model'],
+                lambda: backend.complete(request_kwargs, self.timeout_tolerance)
+            )
+        except openai.error.InvalidRequestError: # something is wrong: e.g. prompt too long
+            print(f"InvalidRequestError\nPrompt passed in:\n\n{str(request_kwargs['messages'])}\n\n")
+            raise
     
     def send_user_message(self, message):
         """
@@ -155,21 +277,29 @@ class OpenaiSequencialDialogue:
         with open(markdown_path, 'w') as ofp:
             ofp.write(self._markdown())
             
-    def cost(self):
-        """
-        return cost to api so far
-        """
+    def _usage_cost(self, usages):
         # n thousand tokens
-        nk_prompt_tokens = sum([i['prompt_tokens'] for i in self.usages]) / 1000
-        nk_completion_tokens = sum([i['completion_tokens'] for i in self.usages]) / 1000
+        nk_prompt_tokens = sum([i['prompt_tokens'] for i in usages]) / 1000
+        nk_completion_tokens = sum([i['completion_tokens'] for i in usages]) / 1000
         
         prompt_cost = self.pricing_per_1k_tokens[self.model]['prompt_tokens'] * nk_prompt_tokens
         completion_cost = self.pricing_per_1k_tokens[self.model]['completion_tokens'] * nk_completion_tokens
+        return prompt_cost, completion_cost
+
+    def cost(self):
+        """
+        return cost to api so far, 
+        cached responses are counted as if they were requested (so reports stay comparable),
+        'billed' is what was actually paid
+        """
+        prompt_cost, completion_cost = self._usage_cost(self.usages)
+        cached_prompt_cost, cached_completion_cost = self._usage_cost(self.cached_usages)
         
         cost_dict = {
             'prompt':prompt_cost,
             'completion':completion_cost,
-            'total':prompt_cost+completion_cost
+            'total':prompt_cost+completion_cost,
+            'billed':prompt_cost+completion_cost-cached_prompt_cost-cached_completion_cost
         }
         
         return cost_dict
@@ -0,0 +1,172 @@
+import queue
+import threading
+import time
+
+
+# end of input marker, each worker of a stage receives one
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Stage:
+
+    """
+    One step of a Pipeline.
+
+    fn maps an item to its output, or, with batch_size > 1, a list of items to the list of their outputs.
+    None outputs are dropped (e.g. items that cannot go on yet).
+    A batched stage takes whatever is queued up (up to batch_size), waiting at most max_wait seconds for more.
+    """
+
+    def __init__(self, name, fn, num_workers=1, batch_size=1, max_wait=0.05):
+        self.name = name
+        self.fn = fn
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+
+class Pipeline:
+
+    """
+    Runs items through stages, each with its own worker threads, connected by bounded queues,
+    so network waits of one stage overlap with cpu work of another.
+
+    A full queue blocks the stage before it, all the way back to reading the (lazy) input,
+    so memory stays flat however many items there are.
+    Outputs come out in completion order, the first exception raised by a stage stops the pipeline and is re-raised.
+    Once run finishes, fails or is closed, its threads are given join_timeout seconds (in total) to finish
+    the item they are working on.
+    """
+
+    def __init__(self, stages, queue_size=64, join_timeout=30.0):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.join_timeout = join_timeout
+        self.lock = threading.Lock()
+        self.num_items = {stage.name: 0 for stage in stages}
+        self.num_batches = {stage.name: 0 for stage in stages}
+        self.busy_seconds = {stage.name: 0.0 for stage in stages}
+
+    def stats(self):
+        with self.lock:
+            return {
+                stage.name: {
+                    'items': self.num_items[stage.name],
+                    'batches': self.num_batches[stage.name],
+                    'busy seconds': self.busy_seconds[stage.name]
+                } for stage in self.stages
+            }
+
+    def run(self, items):
+        """
+        generator of the outputs of the last stage
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages)+1)]
+        stop = threading.Event()
+        num_running = [stage.num_workers for stage in self.stages]
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(q, timeout=None):
+            deadline = None if timeout is None else time.time()+timeout
+            while not stop.is_set():
+                wait = 0.1 if deadline is None else min(0.1, deadline-time.time())
+                if wait <= 0:
+                    break
+                try:
+                    return q.get(timeout=wait)
+                except queue.Empty:
+                    continue
+            return None
+
+        def fail(exception):
+            put(queues[-1], _Failure(exception))
+            stop.set()
+
+        def feed():
+            try:
+                for item in items:
+                    put(queues[0], item)
+                    if stop.is_set():
+                        return
+            except Exception as e:
+                fail(e)
+                return
+            for _ in range(self.stages[0].num_workers):
+                put(queues[0], _DONE)
+
+        def work(i):
+            stage = self.stages[i]
+            done = False
+            while not done and not stop.is_set():
+                first = get(queues[i])
+                if first is None:
+                    continue
+                if first is _DONE:
+                    break
+                batch = [first]
+                deadline = time.time()+stage.max_wait
+                while len(batch) < stage.batch_size:
+                    item = get(queues[i], timeout=deadline-time.time())
+                    if item is None:
+                        break
+                    if item is _DONE:
+                        done = True
+                        break
+                    batch.append(item)
+
+                start = time.time()
+                try:
+                    outputs = stage.fn(batch) if stage.batch_size > 1 else [stage.fn(batch[0])]
+                except Exception as e:
+                    fail(e)
+                    return
+                with self.lock:
+                    self.num_items[stage.name] += len(batch)
+                    self.num_batches[stage.name] += 1
+                    self.busy_seconds[stage.name] += time.time()-start
+                for output in outputs:
+                    if output is not None:
+                        put(queues[i+1], output)
+
+            # the last worker of a stage to finish tells the next stage
+            with self.lock:
+                num_running[i] -= 1
+                last = num_running[i] == 0
+            if last:
+                num_next_workers = self.stages[i+1].num_workers if i+1 < len(self.stages) else 1
+                for _ in range(num_next_workers):
+                    put(queues[i+1], _DONE)
+
+        threads = [threading.Thread(target=feed, name='pipeline feed', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads += [
+                threading.Thread(target=work, args=(i,), name=f'pipeline {stage.name}', daemon=True)
+                for _ in range(stage.num_workers)
+            ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                output = queues[-1].get()
+                if output is _DONE:
+                    break
+                if isinstance(output, _Failure):
+                    raise output.exception
+                yield output
+        finally:
+            stop.set()
+            deadline = time.time()+self.join_timeout
+            for thread in threads:
+                thread.join(timeout=max(0, deadline-time.time()))
@@ -0,0 +1,148 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from .openai_dialogue import OpenaiSequencialDialogue
+
+
+GPT_RERANK_PROMPT = """Look at the following description of a current situation (of a dialogue context), and a set of guidelines that might help in such situation. Response with the id of the single most applicable rule.
+Dialogue Context:
+@state@
+
+Current Situation:
+@client_tom@
+
+Guidelines:
+@rules@
+
+Which rule applies the best in this situation? Answer with a single number only, do not explain anything, do not add punctuation."""
+
+
+def numbered_rules_text(rules):
+    return '\n'.join([str(i+1)+': '+rules[i]+'\n' for i in range(len(rules))])
+
+
+class GPTReranker:
+
+    """
+    asks an llm which of the retrieved rules applies best (one request per state)
+    """
+
+    name = 'gpt'
+
+    def __init__(self, model='gpt-3.5-turbo'):
+        self.model = model
+
+    def rerank(self, state, client_tom, rules):
+        """
+        returns the index of the chosen rule and the cost,
+        the first (best retrieved) rule if the reply has no valid rule number
+        """
+        reranker = OpenaiSequencialDialogue(model=self.model)
+        reranker_prompt = GPT_RERANK_PROMPT.replace('@state@', state).replace('@client_tom@', client_tom).replace('@rules@', numbered_rules_text(rules))
+        model_response = reranker.send_user_message(reranker_prompt)
+        model_response = ''.join([str(i) for i in str(model_response) if i.isnumeric()])
+        index = int(model_response)-1 if model_response != '' else -1
+        if not 0 <= index < len(rules):
+            print(f'reranker replied with no valid rule number ({model_response}), using the best retrieved rule')
+            index = 0
+        return index, reranker.cost()['total']
+
+
+class CrossEncoderReranker:
+
+    """
+    scores every (client tom, rule) pair with a local cross-encoder in one batch, no network round trip
+    """
+
+    name = 'cross_encoder'
+
+    def __init__(self, model_name='cross-encoder/ms-marco-MiniLM-L-6-v2', device='cpu', batch_size=32):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device=device)
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+
+    def score_batch(self, client_toms, rules_lists):
+        """
+        scores of the rules of many states, with a single forward pass over all pairs
+        """
+        pairs = [(client_tom, rule) for client_tom, rules in zip(client_toms, rules_lists) for rule in rules]
+        if len(pairs) == 0:
+            return [np.zeros(0) for _ in rules_lists]
+        with self.lock:
+            scores = np.asarray(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False))
+        splits = np.cumsum([len(rules) for rules in rules_lists])[:-1]
+        return np.split(scores, splits)
+
+    def rerank(self, state, client_tom, rules):
+        scores = self.score_batch([client_tom], [rules])[0]
+        return int(np.argmax(scores)), 0
+
+    def rerank_batch(self, states, client_toms, rules_lists):
+        return [(int(np.argmax(scores)), 0) for scores in self.score_batch(client_toms, rules_lists)]
+
+
+class HybridReranker:
+
+    """
+    cross-encoder first, only asks the llm when the best cross-encoder scores are within margin of each other
+    (and then only about those close candidates)
+
+    num_workers: how many llm requests rerank_batch sends at the same time
+    """
+
+    name = 'hybrid'
+
+    def __init__(self, cross_encoder_reranker, gpt_reranker, margin=1.0, num_workers=8):
+        self.cross_encoder_reranker = cross_encoder_reranker
+        self.gpt_reranker = gpt_reranker
+        self.margin = margin
+        self.num_workers = num_workers
+        self.num_reranked = 0
+        self.num_escalated = 0
+        self.lock = threading.Lock()
+
+    def _choose(self, state, client_tom, rules, scores):
+        order = np.argsort(-scores, kind='stable')
+        close = [int(i) for i in order if scores[order[0]]-scores[i] < self.margin]
+        with self.lock:
+            self.num_reranked += 1
+            self.num_escalated += len(close) > 1
+        if len(close) == 1:
+            return close[0], 0
+        index, cost = self.gpt_reranker.rerank(state, client_tom, [rules[i] for i in close])
+        return close[index], cost
+
+    def rerank(self, state, client_tom, rules):
+        scores = self.cross_encoder_reranker.score_batch([client_tom], [rules])[0]
+        return self._choose(state, client_tom, rules, scores)
+
+    def rerank_batch(self, states, client_toms, rules_lists):
+        """
+        every pair of every state scored in one cross-encoder pass, then the llm only asked about the close ones
+        """
+        all_scores = self.cross_encoder_reranker.score_batch(client_toms, rules_lists)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            return list(executor.map(self._choose, states, client_toms, rules_lists, all_scores))
+
+    def escalation_rate(self):
+        with self.lock:
+            return self.num_escalated / max(self.num_reranked, 1)
+
+
+def build_reranker(
+    name, 
+    gpt_model='gpt-3.5-turbo', 
+    cross_encoder_name='cross-encoder/ms-marco-MiniLM-L-6-v2', 
+    hybrid_margin=1.0, 
+    hybrid_workers=8
+):
+    """
+    reranker from command line options
+    """
+    assert name in {'gpt', 'cross_encoder', 'hybrid'}
+    if name == 'gpt':
+        return GPTReranker(gpt_model)
+    if name == 'cross_encoder':
+        return CrossEncoderReranker(cross_encoder_name)
+    return HybridReranker(CrossEncoderReranker(cross_encoder_name), GPTReranker(gpt_model), margin=hybrid_margin, num_workers=hybrid_workers)
@@ -0,0 +1,235 @@
+import asyncio
+import random
+import threading
+import time
+from collections import defaultdict
+
+import openai
+
+
+# errors that will not go away by asking again
+NON_RETRYABLE_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError
+)
+
+
+class RetryTimeExceeded(Exception):
+    """
+    raised when a request keeps failing for longer than the policy's max_retry_time
+    """
+
+
+class RetryMetrics:
+    """
+    thread-safe counters of retries, time spent waiting and circuit breaker trips, per model
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.retries = defaultdict(lambda: defaultdict(int))
+        self.retry_wait_seconds = defaultdict(float)
+        self.breaker_trips = defaultdict(int)
+
+    def record_retry(self, model, error, wait):
+        with self.lock:
+            self.retries[model][type(error).__name__] += 1
+            self.retry_wait_seconds[model] += wait
+
+    def record_breaker_trip(self, model):
+        with self.lock:
+            self.breaker_trips[model] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'retries': {model: dict(errors) for model, errors in self.retries.items()},
+                'retry wait seconds': dict(self.retry_wait_seconds),
+                'breaker trips': dict(self.breaker_trips)
+            }
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a model after `failure_threshold` consecutive failures.
+
+    After `cooldown` seconds a single probe request is let through (half-open),
+    success closes the breaker again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def wait_time(self):
+        """
+        how long to wait before asking again (0 if a request may be sent now),
+        and whether that request is the half-open probe (the caller must release_probe() once it is answered)
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0, False
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                return remaining, False
+            if self.probe_in_flight:
+                return 1, False
+            self.probe_in_flight = True
+            return 0, True
+
+    def release_probe(self):
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        """
+        returns True if this failure tripped the breaker
+        """
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.probe_in_flight or (self.opened_at is None and self.consecutive_failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+                return True
+            return False
+
+
+def retry_after_seconds(error):
+    """
+    the Retry-After header of an api error, if the server sent one
+    """
+    headers = getattr(error, 'headers', None) or dict()
+    for key in ('retry-after', 'Retry-After'):
+        if key in headers:
+            try:
+                return float(headers[key])
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+class RetryPolicy:
+
+    """
+    Retries failed requests with exponential backoff and full jitter (or the server's Retry-After),
+    behind a circuit breaker per model. Gives up with RetryTimeExceeded once a request
+    has been retried for more than max_retry_time seconds.
+
+    Works from any thread (call) and from asyncio (acall).
+    """
+
+    def __init__(
+            self,
+            base_delay=1,
+            max_delay=60,
+            max_retry_time=600,
+            failure_threshold=5,
+            cooldown=30
+            ):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_time = max_retry_time
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.breakers = dict()
+        self.breakers_lock = threading.Lock()
+        self.metrics = RetryMetrics()
+
+    def breaker(self, model):
+        with self.breakers_lock:
+            if model not in self.breakers:
+                self.breakers[model] = CircuitBreaker(self.failure_threshold, self.cooldown)
+            return self.breakers[model]
+
+    def backoff(self, attempt, error):
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _next_wait(self, model, attempt, error, started):
+        """
+        book-keeping after a failed attempt, returns how long to sleep before the next one
+        """
+        if isinstance(error, NON_RETRYABLE_ERRORS):
+            # the endpoint answered, only this request is bad
+            self.breaker(model).record_success()
+            raise error
+        if self.breaker(model).record_failure():
+            self.metrics.record_breaker_trip(model)
+        wait = self.backoff(attempt, error)
+        if time.monotonic() - started + wait > self.max_retry_time:
+            raise RetryTimeExceeded(f'{model}: gave up after {attempt+1} attempts, last error: {error!r}') from error
+        print("API error:", type(error), f'retrying in {wait:.1f}s')
+        self.metrics.record_retry(model, error, wait)
+        return wait
+
+    def _breaker_wait(self, model, started):
+        wait, probe = self.breaker(model).wait_time()
+        if wait > 0 and time.monotonic() - started + wait > self.max_retry_time:
+            raise RetryTimeExceeded(f'{model}: circuit breaker still open')
+        return wait, probe
+
+    def call(self, model, send_request):
+        """
+        blocking: return send_request() once it succeeds
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            wait, probe = self._breaker_wait(model, started)
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                response = send_request()
+            except Exception as e:
+                wait = self._next_wait(model, attempt, e, started)
+            else:
+                self.breaker(model).record_success()
+                return response
+            finally:
+                # whatever happened, the probe is not in flight anymore
+                if probe:
+                    self.breaker(model).release_probe()
+            time.sleep(wait)
+            attempt += 1
+
+    async def acall(self, model, send_request):
+        """
+        asyncio: return await send_request() once it succeeds
+        """
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            wait, probe = self._breaker_wait(model, started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                response = await send_request()
+            except Exception as e:
+                wait = self._next_wait(model, attempt, e, started)
+            else:
+                self.breaker(model).record_success()
+                return response
+            finally:
+                if probe:
+                    self.breaker(model).release_probe()
+            await asyncio.sleep(wait)
+            attempt += 1
+
+
+# shared by all dialogues unless they are given their own
+default_retry_policy = RetryPolicy()
@@ -1,3 +1,4 @@
+from collections import deque
 
 
 # def assemble_dialogue_turns(dialogue_turns, turn_sep='\n',max_num_turns=100):
@@ -89,6 +90,30 @@ class Session:
         )
     
 
+def iter_state_actions(sessions, session_ids=None, min_action_length=35, max_prev_turns=4, start_turn=3):
+    """
+    Lazily yield (session id, turn index, state, gold action) for every therapist turn
+    after start_turn whose gold action is longer than min_action_length characters.
+
+    Same pairs as walking Session.skip_to_next_utt_by('therapist') from start_turn, 
+    but the context window (max_prev_turns turns) is kept incrementally and states are
+    only assembled for pairs that pass the length filter.
+
+    session_ids: ids reported for the sessions, defaults to their position
+    """
+    if session_ids is None:
+        session_ids = range(len(sessions))
+    for session_id, session in zip(session_ids, sessions):
+        window = deque(session.turns[max(0, start_turn+1-max_prev_turns):start_turn+1], maxlen=max_prev_turns)
+        for turn_index in range(start_turn+1, len(session.turns)):
+            turn = session.turns[turn_index]
+            if turn['role'] == 'therapist':
+                gold_action = assemble_dialogue_turns([turn]).strip()
+                if len(gold_action) > min_action_length:
+                    state = 'Topic: '+session.topic+'\n'+assemble_dialogue_turns(window)
+                    yield session_id, turn_index, state, gold_action
+            window.append(turn)
+
 def assemble_state_with_instructions(raw_state, guideline=''):
     output = raw_state
     output += '\n'+ """Predict what the therapist would say."""
@@ -0,0 +1,71 @@
+import ast
+import json
+import re
+
+
+def _normalize_key(key):
+    return re.sub(r'[\s_\-]+', ' ', str(key)).strip().lower()
+
+
+def parse_json_object(text):
+    """
+    Parse the (first) JSON object in an LLM reply, without eval.
+
+    Repairs common problems: code fences, text around the object, a missing closing brace,
+    smart quotes, trailing commas, and python-style dicts with single quotes.
+    Returns a dict, or None if nothing parses.
+    """
+    text = re.sub(r'```(?:json)?', '', text)
+    if '{' not in text:
+        return None
+    text = text[text.index('{'):]
+    text = text[:text.rindex('}')+1] if '}' in text else text+'}'
+
+    repaired = text.replace('“', '"').replace('”', '"').replace('‘', "'").replace('’', "'")
+    repaired = re.sub(r',\s*([}\]])', r'\1', repaired)
+    for candidate in (text, repaired):
+        for parse in (json.loads, ast.literal_eval):
+            try:
+                parsed = parse(candidate)
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            if isinstance(parsed, dict):
+                return parsed
+    return None
+
+
+def validate_fields(parsed, schema):
+    """
+    Check a parsed object against a schema {field: allowed values, or None for any non-empty string}.
+
+    Keys are matched ignoring case, spaces and underscores, and values are matched to
+    the allowed values ignoring case (an allowed value appearing as a word in the answer also counts).
+    Returns {field: value} with the schema's field names, or None if anything is missing or invalid.
+    """
+    if not isinstance(parsed, dict):
+        return None
+    by_key = {_normalize_key(k): v for k, v in parsed.items()}
+    out = dict()
+    for field, allowed in schema.items():
+        value = by_key.get(_normalize_key(field))
+        if not isinstance(value, str) or value.strip() == '':
+            return None
+        value = value.strip()
+        if allowed is not None:
+            matches = [a for a in allowed if a.lower() == value.lower()]
+            matches = matches or [a for a in allowed if re.search(r'\b'+re.escape(a.lower())+r'\b', value.lower())]
+            if len(matches) != 1:
+                return None
+            value = matches[0]
+        out[field] = value
+    return out
+
+
+def parse_prediction(text):
+    """
+    the 'prediction' of a reply formatted as {'prediction': "your answer"}, None if it cannot be parsed
+    """
+    parsed = parse_json_object(text)
+    if parsed is None or not isinstance(parsed.get('prediction'), str):
+        return None
+    return parsed['prediction']
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def snippet_key(llm_name, prompt, *texts):
+    """
+    hash of the model name, the prompt variant (e.g. 'inference/single')
+    and whitespace-normalized texts (dialogue snippet, therapist response...)
+    """
+    normalized = [' '.join(t.split()) for t in texts]
+    return hashlib.sha256(json.dumps([llm_name, prompt]+normalized).encode('utf-8')).hexdigest()
+
+
+class TomStore:
+
+    """
+    Persistent (SQLite) store of inferred TOMs, shared by training and inference runs.
+
+    client toms are only ever filled from inference-mode prompts (no therapist response), the client fields
+    of full training TOMs come from a prompt that sees the gold response and must not reach test time.
+    Entries are keyed by model, prompt variant (tom mode) and texts, so the two kinds never collide.
+    Safe to share across threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS client_toms (key TEXT PRIMARY KEY, toms TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS full_toms (key TEXT PRIMARY KEY, toms TEXT)')
+        self.conn.commit()
+
+    def _get(self, table, key):
+        with self.lock:
+            row = self.conn.execute(f'SELECT toms FROM {table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def _put(self, table, key, toms):
+        with self.lock:
+            self.conn.execute(f'INSERT OR REPLACE INTO {table} VALUES (?, ?)', (key, json.dumps(toms)))
+            self.conn.commit()
+
+    def get_client_toms(self, dialog_snippet, llm_name, mode='multi_turn'):
+        """
+        {'client stage', 'client tom'} inferred without the therapist response, or None
+        """
+        return self._get('client_toms', snippet_key(llm_name, 'inference/'+mode, dialog_snippet))
+
+    def put_client_toms(self, dialog_snippet, llm_name, client_stage, client_tom, mode='multi_turn'):
+        self._put('client_toms', snippet_key(llm_name, 'inference/'+mode, dialog_snippet),
+                  {'client stage': client_stage, 'client tom': client_tom})
+
+    def get_full_toms(self, dialog_snippet, therapist_response, llm_name, mode='multi_turn'):
+        """
+        {'client stage', 'client tom', 'therapist tom', 'contextual instruction'} or None
+        """
+        return self._get('full_toms', snippet_key(llm_name, 'training/'+mode, dialog_snippet, therapist_response))
+
+    def put_full_toms(self, dialog_snippet, therapist_response, llm_name, client_stage, client_tom, therapist_tom, contextual_instruction, mode='multi_turn'):
+        # training only, the client fields here were inferred with the gold response in the prompt
+        self._put('full_toms', snippet_key(llm_name, 'training/'+mode, dialog_snippet, therapist_response), {
+            'client stage': client_stage,
+            'client tom': client_tom,
+            'therapist tom': therapist_tom,
+            'contextual instruction': contextual_instruction
+        })
+
+    def stats(self):
+        with self.lock:
+            num_client = self.conn.execute('SELECT COUNT(*) FROM client_toms').fetchone()[0]
+            num_full = self.conn.execute('SELECT COUNT(*) FROM full_toms').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'client toms': num_client, 'full toms': num_full}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# optional store used by tom_detector, like the llm response cache
+_tom_store = None
+
+def set_tom_store(store):
+    """
+    install (or remove, with None) the store used by determine_toms / determine_toms_inference_mode
+    """
+    global _tom_store
+    _tom_store = store
+
+def get_tom_store():
+    return _tom_store